@@ -1,23 +1,46 @@
 import streamlit as st
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, BackgroundTasks, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import sqlite3
-from passlib.context import CryptContext
+import passwords
+from passwords import pwd_context
 import shutil
 import secrets
 import os
 import io
 import csv
+import zlib
+import functools
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 import json
-import requests as http_requests
+import re
+import base64
+import unicodedata
+import math
+import httpx
 import logging
+import sys
+import threading
+import time
+import queue
+import hmac
+import hashlib
+import asyncio
+import multiprocessing
+import weakref
+from collections import OrderedDict
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 # 載入 .env 文件中的環境變數
@@ -28,15 +51,430 @@ logger = logging.getLogger(__name__)
 # --- Database Setup ---
 DATABASE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "community_app.db")
 
+# 連線池設定：預設大小與 FastAPI/anyio threadpool 的 40 個 worker 對齊
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "40"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # 等待可用連線的秒數
+DB_POOL_HEALTH_CHECK_SECONDS = float(os.getenv("DB_POOL_HEALTH_CHECK_SECONDS", "30"))
+DB_POOL_LEAK_SECONDS = float(os.getenv("DB_POOL_LEAK_SECONDS", "30"))
+
+# 儲存設定檔：production 使用 WAL，讀取不會被寫入阻塞；default 保留 SQLite 預設值
+# 個別 PRAGMA 可用 DB_PRAGMA_<名稱> 覆寫，例如 DB_PRAGMA_MMAP_SIZE=0
+DB_STORAGE_PROFILE = os.getenv("DB_STORAGE_PROFILE", "production")
+STORAGE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,  # ms
+        "cache_size": -16000,  # 負值單位為 KiB，約 16MB
+        "mmap_size": 128 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def storage_pragmas():
+    if DB_STORAGE_PROFILE not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown DB_STORAGE_PROFILE: {DB_STORAGE_PROFILE}")
+    pragmas = dict(STORAGE_PROFILES[DB_STORAGE_PROFILE])
+    for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "temp_store"):
+        override = os.getenv(f"DB_PRAGMA_{name.upper()}")
+        if override:
+            pragmas[name] = override
+    return pragmas
+
+
+def apply_storage_profile(conn):
+    for name, value in storage_pragmas().items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+class PooledConnection:
+    """Proxy around a pooled sqlite3 connection; close() returns it to the pool."""
+
+    def __init__(self, pool, conn, owner):
+        self._pool = pool
+        self._conn = conn
+        self.owner = owner
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool._release(self._conn, self)
+
+    def __del__(self):
+        # Handler dropped the connection without close(): reclaim it and log who leaked it
+        if not getattr(self, "_released", True):
+            self._released = True
+            self._pool._release(self._conn, self, leaked=True)
+
+
+class ConnectionPool:
+    """Bounded pool of reusable SQLite connections shared by the API worker threads.
+
+    Idle connections remember the thread that last used them, so a threadpool
+    worker usually gets its own connection (and warm page cache) back.
+    """
+
+    def __init__(self, database, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 health_check_seconds=DB_POOL_HEALTH_CHECK_SECONDS, leak_seconds=DB_POOL_LEAK_SECONDS):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self.leak_seconds = leak_seconds
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, thread_id, last_used)]
+        self._leases = {}  # id(conn) -> lease info (owner, checkout time); never holds the proxy itself
+        self._size = 0
+        self._generation = 0
+        self._conn_generation = {}  # id(conn) -> generation it was opened in
+        self._stats = {"checkouts": 0, "created": 0, "waits": 0, "timeouts": 0, "leaks": 0, "health_check_failures": 0}
+
+    def _connect(self):
+        ensure_schema(self.database)
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # Return rows as dictionary-like objects
+        apply_storage_profile(conn)
+        return conn
+
+    def _discard(self, conn):
+        self._size -= 1
+        self._conn_generation.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _take_idle(self):
+        """Pop an idle connection, preferring the one this thread used last."""
+        thread_id = threading.get_ident()
+        for i in range(len(self._idle) - 1, -1, -1):
+            if self._idle[i][1] == thread_id:
+                return self._idle.pop(i)
+        return self._idle.pop()
+
+    def _owner_name(self):
+        frame = sys._getframe(2)
+        while frame and (frame.f_code.co_name in ("acquire", "connection", "get_db", "db_connection")
+                         or frame.f_code.co_filename.endswith("contextlib.py")):
+            frame = frame.f_back
+        if frame is None:
+            return "unknown"
+        return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+    def _report_stale_leases(self, now):
+        for lease in self._leases.values():
+            if not lease["leak_reported"] and now - lease["checked_out_at"] > self.leak_seconds:
+                lease["leak_reported"] = True
+                logger.warning(
+                    "DB connection held by %s for %.1fs without being returned",
+                    lease["owner"], now - lease["checked_out_at"],
+                )
+
+    def acquire(self):
+        owner = self._owner_name()
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self._report_stale_leases(time.monotonic())
+            conn = None
+            while conn is None:
+                if self._idle:
+                    conn, _, last_used = self._take_idle()
+                    if time.monotonic() - last_used > self.health_check_seconds:
+                        try:
+                            conn.execute("SELECT 1").fetchone()
+                        except sqlite3.Error:
+                            self._stats["health_check_failures"] += 1
+                            self._discard(conn)
+                            conn = None
+                    continue
+                if self._size < self.max_size:
+                    conn = self._connect()
+                    self._size += 1
+                    self._conn_generation[id(conn)] = self._generation
+                    self._stats["created"] += 1
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise sqlite3.OperationalError(f"connection pool exhausted ({self.max_size} connections in use)")
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+            self._leases[id(conn)] = {"owner": owner, "checked_out_at": time.monotonic(), "leak_reported": False}
+            self._stats["checkouts"] += 1
+            return PooledConnection(self, conn, owner)
+
+    def _release(self, conn, lease, leaked=False):
+        if leaked:
+            logger.warning("DB connection checked out by %s was never returned to the pool", lease.owner)
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # 與舊版 close() 行為一致：未 commit 的變更直接丟棄
+            healthy = True
+        except sqlite3.Error:
+            healthy = False
+        with self._cond:
+            if leaked:
+                self._stats["leaks"] += 1
+            self._leases.pop(id(conn), None)
+            if healthy and self._conn_generation.get(id(conn)) == self._generation:
+                self._idle.append((conn, threading.get_ident(), time.monotonic()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with-block."""
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def reset(self):
+        """Close idle connections; connections in use are closed when returned (e.g. after a DB restore)."""
+        with self._cond:
+            self._generation += 1
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._discard(conn)
+
+    def health(self):
+        now = time.monotonic()
+        with self._cond:
+            self._report_stale_leases(now)
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._leases),
+                **self._stats,
+                "leases": [
+                    {"owner": lease["owner"], "held_seconds": round(now - lease["checked_out_at"], 3)}
+                    for lease in self._leases.values()
+                ],
+            }
+
+
+db_pool = ConnectionPool(DATABASE_NAME)
+
+
 def get_db():
-    db = sqlite3.connect(DATABASE_NAME)
-    db.row_factory = sqlite3.Row  # Return rows as dictionary-like objects
-    return db
+    """Check out a pooled connection; callers must db.close() to return it."""
+    return db_pool.acquire()
+
+
+def db_connection():
+    """FastAPI dependency yielding a pooled connection that is returned after the request."""
+    with db_pool.connection() as db:
+        yield db
+
+
+# --- Timestamps ---
+# 所有時間欄位統一存成 UTC 'YYYY-MM-DD HH:MM:SS'（與 CURRENT_TIMESTAMP 相同），
+# 字串排序即時間先後，範圍查詢可直接走索引。沒有時區的值視為 UTC 原樣保存，帶時區的值換算成 UTC。
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# 社團所在時區（UTC 偏移）；舊版 H5 送出的活動時間是這個時區的本地時間，migration 22 據此換算成 UTC
+APP_TIMEZONE = os.getenv("APP_TIMEZONE", "+08:00")
+
+
+def utc_offset_minutes(value):
+    """Minutes east of UTC for an offset like '+08:00', '-0530' or 'Z'; raises ValueError."""
+    text = value.strip()
+    if text in ("Z", "z", "UTC"):
+        return 0
+    match = re.fullmatch(r"([+-])(\d\d):?(\d\d)", text)
+    if not match:
+        raise ValueError(f"invalid UTC offset: {value!r}")
+    sign, hours, minutes = match.groups()
+    return (1 if sign == "+" else -1) * (int(hours) * 60 + int(minutes))
+
+
+def _adapt_datetime(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def _adapt_date(value):
+    return value.strftime("%Y-%m-%d 00:00:00")
+
+
+# datetime.utcnow() 等直接綁定的參數自動轉成標準格式
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_adapter(date, _adapt_date)
+
+
+def normalize_timestamp(value):
+    """Canonical 'YYYY-MM-DD HH:MM:SS' (UTC) for a datetime, date or ISO 8601 string; raises ValueError."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return _adapt_datetime(value)
+    if isinstance(value, date):
+        return _adapt_date(value)
+    text = str(value).strip()
+    if text[-1:] in ("Z", "z"):  # Python 3.11 以前的 fromisoformat 不接受 Z
+        text = text[:-1] + "+00:00"
+    return _adapt_datetime(datetime.fromisoformat(text))
 
-def init_db():
-    db = get_db()
-    cursor = db.cursor()
 
+def timestamp_param(value, name, end_of_day=False):
+    """normalize_timestamp for API input (400 on bad input); end_of_day makes a bare date cover the whole day."""
+    try:
+        normalized = normalize_timestamp(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"{name} 時間格式無效，請使用 YYYY-MM-DD 或 ISO 8601")
+    if normalized and end_of_day and len(str(value).strip()) == 10:
+        normalized = normalized[:10] + " 23:59:59"
+    return normalized
+
+
+def normalize_payload_timestamps(payload, *fields):
+    """Normalize the given request-model fields in place (400 on bad input)."""
+    for field in fields:
+        setattr(payload, field, timestamp_param(getattr(payload, field), field))
+
+
+# --- Single Writer ---
+# 所有寫入（payments / event_registrations / memberships）交給同一條 writer thread 執行，
+# 佇列中累積的多筆寫入合併為一次 COMMIT（group commit），減少 fsync 次數並避免 "database is locked"
+DB_WRITER_MAX_BATCH = int(os.getenv("DB_WRITER_MAX_BATCH", "64"))
+DB_WRITER_GROUP_WAIT_MS = float(os.getenv("DB_WRITER_GROUP_WAIT_MS", "2"))
+
+
+class _WriterConnection:
+    """Connection handed to write jobs: commit() is deferred to the group commit, rollback() undoes only this job."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._conn.execute("ROLLBACK TO write_job")
+
+    def close(self):
+        pass
+
+
+class DatabaseWriter:
+    """Dedicated writer thread; each job runs in its own savepoint and a batch shares one COMMIT."""
+
+    def __init__(self, pool, max_batch=DB_WRITER_MAX_BATCH, group_wait_ms=DB_WRITER_GROUP_WAIT_MS):
+        self._pool = pool
+        self.max_batch = max_batch
+        self.group_wait = group_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._conn = None
+        self._start_lock = threading.Lock()
+        self._stats = {"jobs": 0, "failed_jobs": 0, "commits": 0, "largest_batch": 0}
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+                    thread.start()
+                    self._thread = thread
+
+    def submit(self, fn):
+        """Queue fn(db) for the writer thread; the returned Future resolves after COMMIT."""
+        if threading.current_thread() is self._thread:
+            # 寫入工作內再次呼叫 run()：直接在目前交易中執行，避免死結
+            future = Future()
+            future.set_result(fn(_WriterConnection(self._conn)))
+            return future
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def run(self, fn):
+        return self.submit(fn).result()
+
+    def _loop(self):
+        self._conn = self._pool._connect()
+        self._conn.isolation_level = None  # 交易由 writer 自行控制
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.group_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._run_batch(batch)
+            except Exception as exc:  # 不讓單一批次的意外錯誤終止 writer thread
+                logger.exception("DB writer batch failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def _run_batch(self, batch):
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        outcomes = []
+        for fn, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            conn.execute("SAVEPOINT write_job")
+            try:
+                result = fn(_WriterConnection(conn))
+            except BaseException as exc:
+                conn.execute("ROLLBACK TO write_job")
+                conn.execute("RELEASE write_job")
+                outcomes.append((future, None, exc))
+            else:
+                conn.execute("RELEASE write_job")
+                outcomes.append((future, result, None))
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error as exc:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, _, _ in outcomes:
+                future.set_exception(exc)
+            return
+        self._stats["commits"] += 1
+        self._stats["jobs"] += len(outcomes)
+        self._stats["largest_batch"] = max(self._stats["largest_batch"], len(outcomes))
+        for future, result, exc in outcomes:
+            if exc is not None:
+                self._stats["failed_jobs"] += 1
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def health(self):
+        return {"running": self._thread is not None and self._thread.is_alive(), "queued": self._queue.qsize(), **self._stats}
+
+
+db_writer = DatabaseWriter(db_pool)
+
+# --- Schema Migrations ---
+# 每個 migration 以 (版本號, 名稱, 函式) 登記；已套用的版本記錄在 schema_version 表。
+# 資料庫已是最新版本時，啟動只需一次版本查詢。新增 schema 變更請在 MIGRATIONS 尾端追加。
+
+def _table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _migration_0001_initial_schema(cursor):
+    """Base tables plus the column back-fills older databases may be missing."""
     # Users Table
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -248,12 +686,11 @@ def init_db():
     )
     """)
 
-    # --- New Migration: Add any missing columns to payments ---
-    cursor.execute("PRAGMA table_info(payments)")
-    payment_columns = {row[1] for row in cursor.fetchall()}
-    # created_at may be missing in older versions
+    # --- Add any missing columns to payments ---
+    payment_columns = _table_columns(cursor, "payments")
+    # created_at may be missing in older versions（ALTER TABLE 不接受非常數預設值）
     if "created_at" not in payment_columns:
-        cursor.execute("ALTER TABLE payments ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+        cursor.execute("ALTER TABLE payments ADD COLUMN created_at TIMESTAMP")
     if "due_date" not in payment_columns:
         cursor.execute("ALTER TABLE payments ADD COLUMN due_date TIMESTAMP")
     if "paid_at" not in payment_columns:
@@ -262,39 +699,21 @@ def init_db():
         cursor.execute("ALTER TABLE payments ADD COLUMN note TEXT")
 
     # 為既有資料庫補上 wechat_id 欄位（若不存在）
-    cursor.execute("PRAGMA table_info(users)")
-    existing_columns = {row[1] for row in cursor.fetchall()}
-    if "wechat_id" not in existing_columns:
+    if "wechat_id" not in _table_columns(cursor, "users"):
         cursor.execute("ALTER TABLE users ADD COLUMN wechat_id TEXT")
 
-    # 補上 memberships.role 欄位（若不存在）
-    cursor.execute("PRAGMA table_info(memberships)")
-    membership_columns = {row[1] for row in cursor.fetchall()}
+    # 補上 memberships.role / joined_at 欄位（若不存在）
+    membership_columns = _table_columns(cursor, "memberships")
     if "role" not in membership_columns:
-        # Check if column exists before adding - Wait, if "role" is NOT in columns, we add it.
-        # But wait, checking logic:
-        # The existing code was:
-        # cursor.execute("ALTER TABLE memberships ADD COLUMN role TEXT NOT NULL DEFAULT 'visitor'")
-        # I should keep it.
         cursor.execute("ALTER TABLE memberships ADD COLUMN role TEXT NOT NULL DEFAULT 'visitor'")
+    if "joined_at" not in membership_columns:
+        # ALTER TABLE 不接受非常數預設值，舊資料維持 NULL
+        cursor.execute("ALTER TABLE memberships ADD COLUMN joined_at TIMESTAMP")
 
-    # --- New Migration: Add image_url to events ---
-    cursor.execute("PRAGMA table_info(events)")
-    event_columns = {row[1] for row in cursor.fetchall()}
+    # 補上 events.image_url / price / early_bird 欄位（若不存在）
+    event_columns = _table_columns(cursor, "events")
     if "image_url" not in event_columns:
         cursor.execute("ALTER TABLE events ADD COLUMN image_url TEXT")
-    
-    # --- New Migration: Add early_bird columns to events (If missing from previous step) ---
-    if "early_bird_price" not in event_columns:
-         cursor.execute("ALTER TABLE events ADD COLUMN early_bird_price REAL")
-    if "early_bird_deadline" not in event_columns:
-         cursor.execute("ALTER TABLE events ADD COLUMN early_bird_deadline TIMESTAMP")
-    if "joined_at" not in membership_columns:
-        cursor.execute("ALTER TABLE memberships ADD COLUMN joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-        
-    # 補上 events.price 欄位（若不存在）
-    cursor.execute("PRAGMA table_info(events)")
-    event_columns = {row[1] for row in cursor.fetchall()}
     if "price" not in event_columns:
         cursor.execute("ALTER TABLE events ADD COLUMN price REAL DEFAULT 0")
     if "early_bird_price" not in event_columns:
@@ -302,29 +721,869 @@ def init_db():
     if "early_bird_deadline" not in event_columns:
         cursor.execute("ALTER TABLE events ADD COLUMN early_bird_deadline TIMESTAMP")
 
-    # --- Migration: Add skills & occupation to users ---
-    cursor.execute("PRAGMA table_info(users)")
-    user_columns = {row[1] for row in cursor.fetchall()}
+    # --- Add skills & occupation to users ---
+    user_columns = _table_columns(cursor, "users")
     if "skills" not in user_columns:
         cursor.execute("ALTER TABLE users ADD COLUMN skills TEXT")
     if "occupation" not in user_columns:
         cursor.execute("ALTER TABLE users ADD COLUMN occupation TEXT")
 
-    db.commit()
-    db.close()
 
-init_db()
 
-# --- Password Hashing ---
-# bcrypt 只支援 72 bytes，改用 pbkdf2_sha256 並保留舊 bcrypt 相容
-pwd_context = CryptContext(schemes=["pbkdf2_sha256", "bcrypt_sha256", "bcrypt"], deprecated="auto")
+def _migration_0002_hot_query_indexes(cursor):
+    """Composite / covering indexes for the filters and sort orders the API actually uses."""
+    for statement in (
+        # list_payments / payments_report / 本月應收：community + created_at 範圍，附帶 related_type、amount 可直接覆蓋
+        "CREATE INDEX IF NOT EXISTS idx_payments_community_created ON payments (community_id, created_at, related_type, amount)",
+        # get_payment_stats：本月已收款、待收款
+        "CREATE INDEX IF NOT EXISTS idx_payments_community_status_paid ON payments (community_id, status, paid_at, amount)",
+        # get_payment_stats：逾期未繳
+        "CREATE INDEX IF NOT EXISTS idx_payments_community_status_due ON payments (community_id, status, due_date, amount)",
+        # 會員查看自己的繳費記錄
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments (user_id, created_at)",
+        # generate_due_payments：檢查會籍是否已有待繳帳單
+        "CREATE INDEX IF NOT EXISTS idx_payments_related ON payments (related_type, related_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_events_community_start ON events (community_id, start_at)",
+        "CREATE INDEX IF NOT EXISTS idx_event_registrations_user ON event_registrations (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_photos_album_created ON photos (album_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_posts_community_pinned_created ON posts (community_id, is_pinned, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments (post_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_announcements_community_pinned_created ON announcements (community_id, is_pinned, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_memberships_community_status ON memberships (community_id, status)",
+    ):
+        cursor.execute(statement)
+
+
+# --- Member directory full-text index ---
+# users_fts 是 users 的 external-content FTS5 索引（trigram tokenizer，支援中文與任意子字串），
+# 以 trigger 與 users 同步。trigram 最少需要 3 個字元，較短的查詢仍走 LIKE。
+USERS_FTS_COLUMNS = ("username", "phone", "email", "bio", "skills", "occupation")
+
+
+def _create_users_fts(cursor):
+    """Create users_fts and its sync triggers; returns False if FTS5 trigram is unavailable."""
+    columns = ", ".join(USERS_FTS_COLUMNS)
+    new_values = ", ".join(f"new.{c}" for c in USERS_FTS_COLUMNS)
+    old_values = ", ".join(f"old.{c}" for c in USERS_FTS_COLUMNS)
+    try:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5({columns}, "
+            "content='users', content_rowid='id', tokenize='trigram')"
+        )
+    except sqlite3.OperationalError as e:  # SQLite < 3.34 或未編譯 FTS5
+        logger.warning("users_fts not created, member search falls back to LIKE: %s", e)
+        return False
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, {columns}) VALUES (new.id, {new_values});
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF {columns} ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        INSERT INTO users_fts (rowid, {columns}) VALUES (new.id, {new_values});
+    END
+    """)
+    return True
+
+
+def _migration_0003_users_fts(cursor):
+    """Trigram full-text index over the member directory, populated from existing rows."""
+    if _create_users_fts(cursor):
+        cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+def has_users_fts(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'")
+    return cursor.fetchone() is not None
+
+
+def rebuild_users_fts(database=DATABASE_NAME):
+    """Recreate missing FTS objects and rebuild users_fts from users; returns the indexed row count."""
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        apply_storage_profile(conn)
+        apply_migrations(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.cursor()
+            if not _create_users_fts(cursor):
+                raise RuntimeError("此 SQLite 不支援 FTS5 trigram tokenizer")
+            cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+            cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('optimize')")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _migration_0004_profile_generation(cursor):
+    """app_state counter bumped by trigger whenever a member's searchable profile text changes."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS app_state (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('profile_generation', 0)")
+    bump = "UPDATE app_state SET value = value + 1 WHERE key = 'profile_generation';"
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS users_profile_gen_ai AFTER INSERT ON users BEGIN {bump} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS users_profile_gen_ad AFTER DELETE ON users BEGIN {bump} END")
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS users_profile_gen_au AFTER UPDATE OF bio, skills, occupation ON users "
+        f"BEGIN {bump} END"
+    )
+
+
+def profile_generation(cursor):
+    """Current member profile generation, or None on databases without app_state."""
+    try:
+        cursor.execute("SELECT value FROM app_state WHERE key = 'profile_generation'")
+    except sqlite3.OperationalError:
+        return None
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _migration_0005_smart_search_cache(cursor):
+    """Persistent smart-search recommendation cache (member ids + reasons, rehydrated on read)."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS smart_search_cache (
+        query_key TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL,
+        recommendations TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_smart_search_cache_created ON smart_search_cache (created_at)")
+
+
+def _migration_0006_payments_keyset_indexes(cursor):
+    """(created_at, id) indexes so keyset pages of the payments list read in index order."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_community_keyset ON payments (community_id, created_at, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_keyset ON payments (created_at, id)")
+
+
+def _migration_0007_payments_stats_index(cursor):
+    """Covering index for the single-pass payment stats aggregate (no table lookups per row)."""
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_community_stats "
+        "ON payments (community_id, status, amount, created_at, paid_at, due_date, related_type)"
+    )
+
+
+# payment_rollups：每個社團、月份、related_type、status 的金額與筆數，由 payments 的 trigger 在同一交易中維護。
+# 無法解析的 created_at 記為月份 ''，related_type 為 NULL 記為 ''。created_at 為 NULL 的資料列不計入
+# （migration 17 之後只會短暫出現在 INSERT 與 payments_created_at_ai 補值之間）。
+PAYMENT_ROLLUP_KEY = (
+    "COALESCE({r}.community_id, 0)",
+    "COALESCE(strftime('%Y-%m', {r}.created_at), '')",
+    "COALESCE({r}.related_type, '')",
+    "COALESCE({r}.status, '')",
+)
+PAYMENT_ROLLUP_SELECT = (
+    "SELECT COALESCE(community_id, 0), COALESCE(strftime('%Y-%m', created_at), ''), "
+    "COALESCE(related_type, ''), COALESCE(status, ''), COALESCE(SUM(amount), 0), COUNT(*) "
+    "FROM payments WHERE created_at IS NOT NULL GROUP BY 1, 2, 3, 4"
+)
+
+
+def _rollup_add(row, skip_unset=False):
+    # skip_unset：created_at 為 NULL 的資料列不計入（migration 21 起的 trigger）
+    key = ", ".join(k.format(r=row) for k in PAYMENT_ROLLUP_KEY)
+    values = f"SELECT {key}, COALESCE({row}.amount, 0), 1 WHERE {row}.created_at IS NOT NULL" if skip_unset else (
+        f"VALUES ({key}, COALESCE({row}.amount, 0), 1)"
+    )
+    return (
+        "INSERT INTO payment_rollups (community_id, month, related_type, status, amount, count) "
+        f"{values} "
+        "ON CONFLICT (community_id, month, related_type, status) "
+        "DO UPDATE SET amount = amount + excluded.amount, count = count + 1;"
+    )
+
+
+def _rollup_remove(row, skip_unset=False):
+    match = " AND ".join(
+        f"{col} = {k.format(r=row)}"
+        for col, k in zip(("community_id", "month", "related_type", "status"), PAYMENT_ROLLUP_KEY)
+    )
+    if skip_unset:
+        match += f" AND {row}.created_at IS NOT NULL"
+    return (
+        f"UPDATE payment_rollups SET amount = amount - COALESCE({row}.amount, 0), count = count - 1 WHERE {match};"
+        f"DELETE FROM payment_rollups WHERE {match} AND count <= 0;"
+    )
+
+
+def _migration_0008_payment_rollups(cursor):
+    """Trigger-maintained per community / month / related_type / status payment totals, backfilled."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS payment_rollups (
+        community_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        related_type TEXT NOT NULL,
+        status TEXT NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (community_id, month, related_type, status)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS payments_rollup_ai AFTER INSERT ON payments BEGIN {_rollup_add('new')} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS payments_rollup_ad AFTER DELETE ON payments BEGIN {_rollup_remove('old')} END")
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS payments_rollup_au "
+        "AFTER UPDATE OF community_id, created_at, related_type, status, amount ON payments "
+        f"BEGIN {_rollup_remove('old')} {_rollup_add('new')} END"
+    )
+    cursor.execute("DELETE FROM payment_rollups")
+    cursor.execute(f"INSERT INTO payment_rollups (community_id, month, related_type, status, amount, count) {PAYMENT_ROLLUP_SELECT}")
+
+
+def rebuild_payment_rollups(database=DATABASE_NAME):
+    """Recompute payment_rollups from payments; returns the number of rollup rows."""
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        apply_storage_profile(conn)
+        apply_migrations(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _migration_0008_payment_rollups(conn.cursor())
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return conn.execute("SELECT COUNT(*) FROM payment_rollups").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def verify_payment_rollups(database=DATABASE_NAME):
+    """Compare payment_rollups with a fresh GROUP BY over payments; returns a list of mismatched rows."""
+    conn = sqlite3.connect(database)
+    try:
+        # 同一個讀取交易內比對，避免比對途中有寫入造成誤報
+        conn.execute("BEGIN")
+        expected = {tuple(r[:4]): (r[4], r[5]) for r in conn.execute(PAYMENT_ROLLUP_SELECT)}
+        actual = {
+            tuple(r[:4]): (r[4], r[5])
+            for r in conn.execute("SELECT community_id, month, related_type, status, amount, count FROM payment_rollups")
+        }
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    mismatches = []
+    for key in sorted(set(expected) | set(actual), key=repr):
+        want, got = expected.get(key, (0, 0)), actual.get(key, (0, 0))
+        # amount 是累加的浮點數，容許分以下的誤差
+        if want[1] != got[1] or abs(want[0] - got[0]) >= 0.005:
+            mismatches.append((key, want, got))
+    return mismatches
+
+
+def _migration_0009_pending_membership_guard(cursor):
+    """At most one pending renewal payment per membership (partial unique index)."""
+    cursor.execute(
+        "SELECT COUNT(*) FROM (SELECT related_id FROM payments "
+        "WHERE related_type = 'membership' AND status = 'pending' GROUP BY related_id HAVING COUNT(*) > 1)"
+    )
+    duplicates = cursor.fetchone()[0]
+    if duplicates:
+        # 舊資料已有重複的待繳帳單：不刪除使用者資料，僅略過索引，帳單引擎仍以 NOT EXISTS 避免新增重複
+        logger.warning(
+            "idx_payments_pending_membership not created: %d memberships have several pending payments", duplicates
+        )
+        return
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_pending_membership ON payments (related_id) "
+        "WHERE related_type = 'membership' AND status = 'pending'"
+    )
+
+
+# 各資料表的時間欄位（smart_search_cache.created_at 是 epoch 秒，不在此列）
+TIMESTAMP_COLUMNS = {
+    "users": ("created_at",),
+    "communities": ("created_at",),
+    "community_members": ("joined_at",),
+    "posts": ("created_at",),
+    "comments": ("created_at",),
+    "likes": ("created_at",),
+    "messages": ("sent_at",),
+    "announcements": ("created_at",),
+    "events": ("start_at", "end_at", "early_bird_deadline", "created_at"),
+    "event_registrations": ("registered_at",),
+    "albums": ("created_at",),
+    "photos": ("created_at",),
+    "memberships": ("expires_at", "joined_at"),
+    "payments": ("created_at", "due_date", "paid_at"),
+}
+
+
+def _migration_0010_canonical_timestamps(cursor):
+    """Rewrite stored timestamps ('T', fractions, offsets, bare dates) as UTC 'YYYY-MM-DD HH:MM:SS'."""
+    canonical = "strftime('%Y-%m-%d %H:%M:%S', {c})"
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        existing = _table_columns(cursor, table)
+        for column in columns:
+            if column not in existing:
+                continue
+            value = canonical.format(c=column)
+            # 只處理文字；數字會被 SQLite 當成儒略日，保持原樣
+            cursor.execute(
+                f"UPDATE {table} SET {column} = {value} "
+                f"WHERE typeof({column}) = 'text' AND {value} IS NOT NULL AND {column} <> {value}"
+            )
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} IS NOT NULL AND {value} IS NULL")
+            unparsed = cursor.fetchone()[0]
+            if unparsed:
+                logger.warning("%s.%s: %d values are not timestamps and were left as-is", table, column, unparsed)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memberships_status_expires ON memberships (status, expires_at)")
+
+
+def _migration_0011_users_created_index(cursor):
+    """Keyset index for the member directory's newest-first order."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, id)")
+
+
+# 離線同步的資料表 -> 擁有者欄位（None 表示登入者皆可見；否則一般會員只同步自己的資料）
+SYNC_TABLES = {
+    "events": None,
+    "announcements": None,
+    "payments": "user_id",
+    "memberships": "user_id",
+}
+
+
+def _change_log_row(table, row, op, owner, community=None):
+    """(columns, values) of a change_log INSERT for the trigger row alias `row` ('new' / 'old')."""
+    columns, values = "table_name, row_id, op, user_id", f"'{table}', {row}.id, '{op}', {owner}"
+    if community:
+        columns, values = f"{columns}, community_id", f"{values}, {row}.{community}"
+    return columns, values
+
+
+def _change_log_entry(table, row, op, owner, community=None):
+    # 每列（每個擁有者）只保留最新一筆紀錄，change_log 的大小與資料列數同級
+    columns, values = _change_log_row(table, row, op, owner, community)
+    return (
+        f"DELETE FROM change_log WHERE table_name = '{table}' AND row_id = {row}.id AND user_id IS {owner};"
+        f"INSERT INTO change_log ({columns}) VALUES ({values});"
+    )
+
+
+def _create_sync_triggers(cursor, table, owner_column, community_column=None):
+    """Triggers keeping updated_at and change_log current for one SYNC_TABLES table."""
+    new_owner = f"new.{owner_column}" if owner_column else "NULL"
+    old_owner = f"old.{owner_column}" if owner_column else "NULL"
+    touch = f"UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id;"
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {table}_sync_ai AFTER INSERT ON {table} "
+        f"BEGIN {touch} {_change_log_entry(table, 'new', 'upsert', new_owner, community_column)} END"
+    )
+    # 換了擁有者時，舊擁有者的裝置要收到刪除
+    reassigned = ""
+    if owner_column:
+        columns, values = _change_log_row(table, "old", "delete", old_owner, community_column)
+        reassigned = (
+            f"DELETE FROM change_log WHERE table_name = '{table}' AND row_id = old.id "
+            f"AND user_id IS old.{owner_column} AND old.{owner_column} IS NOT new.{owner_column};"
+            f"INSERT INTO change_log ({columns}) SELECT {values} WHERE old.{owner_column} IS NOT new.{owner_column};"
+        )
+    # updated_at 本身的更新（touch）不再觸發
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {table}_sync_au AFTER UPDATE ON {table} "
+        "WHEN new.updated_at IS old.updated_at "
+        f"BEGIN {touch} {reassigned} {_change_log_entry(table, 'new', 'upsert', new_owner, community_column)} END"
+    )
+    columns, values = _change_log_row(table, "old", "delete", old_owner, community_column)
+    cursor.execute(
+        f"CREATE TRIGGER IF NOT EXISTS {table}_sync_ad AFTER DELETE ON {table} "
+        f"BEGIN DELETE FROM change_log WHERE table_name = '{table}' AND row_id = old.id;"
+        f"INSERT INTO change_log ({columns}) VALUES ({values}); END"
+    )
+
+
+def _migration_0012_change_log(cursor):
+    """updated_at columns plus a trigger-maintained change_log (seq, tombstones) for delta sync."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL CHECK (op IN ('upsert', 'delete')),
+        user_id INTEGER,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log (table_name, row_id)")
+    for table, owner_column in SYNC_TABLES.items():
+        if "updated_at" not in _table_columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP")
+        _create_sync_triggers(cursor, table, owner_column)
+        created = "joined_at" if table == "memberships" else "created_at"
+        # 既有資料補一筆 upsert，讓 since=0 的裝置拿到完整快照
+        cursor.execute(
+            f"UPDATE {table} SET updated_at = COALESCE({created}, CURRENT_TIMESTAMP) WHERE updated_at IS NULL"
+        )
+        cursor.execute(
+            f"INSERT INTO change_log (table_name, row_id, op, user_id) "
+            f"SELECT '{table}', id, 'upsert', {owner_column or 'NULL'} FROM {table} "
+            f"WHERE id NOT IN (SELECT row_id FROM change_log WHERE table_name = '{table}') ORDER BY id"
+        )
+
+
+def _migration_0013_event_registered_count(cursor):
+    """events.registered_count seat counter (backfilled) and the waitlist order index."""
+    if "registered_count" not in _table_columns(cursor, "events"):
+        cursor.execute("ALTER TABLE events ADD COLUMN registered_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(
+        "UPDATE events SET registered_count = (SELECT COUNT(*) FROM event_registrations r "
+        "WHERE r.event_id = events.id AND r.status IN ('registered', 'checked_in'))"
+    )
+    # 候補順序即 id 順序（AUTOINCREMENT 不重複使用）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_event_registrations_waitlist ON event_registrations (event_id, status, id)")
+
+
+def _migration_0014_checkin_scans(cursor):
+    """Idempotency log for batched check-in scans, and event_registrations.checked_in_at."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS checkin_scans (
+        idempotency_key TEXT PRIMARY KEY,
+        event_id INTEGER NOT NULL,
+        membership_no TEXT,
+        user_id INTEGER,
+        status TEXT NOT NULL,
+        message TEXT,
+        scanned_at TIMESTAMP,
+        scanned_by INTEGER,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+    """)
+    if "checked_in_at" not in _table_columns(cursor, "event_registrations"):
+        cursor.execute("ALTER TABLE event_registrations ADD COLUMN checked_in_at TIMESTAMP")
+
+
+def _migration_0015_membership_token_revocations(cursor):
+    """Revocation list for signed membership card tokens."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS membership_token_revocations (
+        membership_no TEXT PRIMARY KEY,
+        revoked_at INTEGER NOT NULL -- epoch 秒；此時間（含）以前簽發的卡片失效
+    ) WITHOUT ROWID
+    """)
+
+
+def _migration_0016_event_status_counts(cursor):
+    """events.checked_in_count / cancelled_count (all counters backfilled) and a start_at index for upcoming / past lists."""
+    columns = _table_columns(cursor, "events")
+    for column in ("checked_in_count", "cancelled_count"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE events ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(
+        "UPDATE events SET "
+        "registered_count = (SELECT COUNT(*) FROM event_registrations r "
+        "WHERE r.event_id = events.id AND r.status IN ('registered', 'checked_in')), "
+        "checked_in_count = (SELECT COUNT(*) FROM event_registrations r WHERE r.event_id = events.id AND r.status = 'checked_in'), "
+        "cancelled_count = (SELECT COUNT(*) FROM event_registrations r WHERE r.event_id = events.id AND r.status = 'cancelled')"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_start ON events (start_at)")
+
+
+def _migration_0017_payments_created_at(cursor):
+    """Backfill payments.created_at left NULL by the migration-1 ALTER, and keep new rows from getting NULL."""
+    # keyset 分頁以 (created_at, id) 比較，NULL 的資料列永遠不會出現在分頁中
+    cursor.execute(
+        "UPDATE payments SET created_at = COALESCE(paid_at, due_date, CURRENT_TIMESTAMP) WHERE created_at IS NULL"
+    )
+    # 舊資料庫以 ALTER 新增的欄位沒有預設值
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS payments_created_at_ai AFTER INSERT ON payments WHEN new.created_at IS NULL "
+        "BEGIN UPDATE payments SET created_at = CURRENT_TIMESTAMP WHERE id = new.id; END"
+    )
+
+
+def _migration_0018_checkin_scans_per_event(cursor):
+    """Key checkin_scans on (event_id, idempotency_key), and drop stored 'invalid' outcomes so corrected resends apply."""
+    # SQLite 無法修改主鍵，重建資料表
+    cursor.execute("""
+    CREATE TABLE checkin_scans_new (
+        idempotency_key TEXT NOT NULL,
+        event_id INTEGER NOT NULL,
+        membership_no TEXT,
+        user_id INTEGER,
+        status TEXT NOT NULL,
+        message TEXT,
+        scanned_at TIMESTAMP,
+        scanned_by INTEGER,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (event_id, idempotency_key)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute(
+        "INSERT INTO checkin_scans_new SELECT idempotency_key, event_id, membership_no, user_id, status, message, "
+        "scanned_at, scanned_by, received_at FROM checkin_scans WHERE status != 'invalid'"
+    )
+    cursor.execute("DROP TABLE checkin_scans")
+    cursor.execute("ALTER TABLE checkin_scans_new RENAME TO checkin_scans")
+
+
+def _migration_0019_change_log_scope(cursor):
+    """change_log.community_id (staff pull only their communities' rows) and a (table_name, seq) index for delta pulls."""
+    if "community_id" not in _table_columns(cursor, "change_log"):
+        cursor.execute("ALTER TABLE change_log ADD COLUMN community_id INTEGER")
+    for table, owner_column in SYNC_TABLES.items():
+        for suffix in ("ai", "au", "ad"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_sync_{suffix}")
+        _create_sync_triggers(cursor, table, owner_column, "community_id")
+        # 已刪除資料列的紀錄補不到社群，維持 NULL
+        cursor.execute(
+            f"UPDATE change_log SET community_id = (SELECT community_id FROM {table} WHERE id = change_log.row_id) "
+            f"WHERE table_name = '{table}'"
+        )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_table_seq ON change_log (table_name, seq)")
+
+
+def _migration_0020_payments_user_due_index(cursor):
+    """Index matching home_bootstrap's outstanding payments order (due_date, NULLs last)."""
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_status_due ON payments (user_id, status, due_date IS NULL, due_date, id)"
+    )
+
+
+def _migration_0021_payment_rollups_skip_unset(cursor):
+    """Rollup triggers ignore rows whose created_at is still NULL, then rebuild payment_rollups.
+
+    On databases where migration 1 added payments.created_at by ALTER (no default),
+    payments_created_at_ai fills the value after the INSERT; its UPDATE already books the row
+    through payments_rollup_au, so payments_rollup_ai must not book it again under month ''.
+    """
+    for name in ("payments_rollup_ai", "payments_rollup_ad", "payments_rollup_au"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cursor.execute(
+        "CREATE TRIGGER payments_rollup_ai AFTER INSERT ON payments WHEN new.created_at IS NOT NULL "
+        f"BEGIN {_rollup_add('new')} END"
+    )
+    cursor.execute(f"CREATE TRIGGER payments_rollup_ad AFTER DELETE ON payments BEGIN {_rollup_remove('old', True)} END")
+    cursor.execute(
+        "CREATE TRIGGER payments_rollup_au "
+        "AFTER UPDATE OF community_id, created_at, related_type, status, amount ON payments "
+        f"BEGIN {_rollup_remove('old', True)} {_rollup_add('new', True)} END"
+    )
+    cursor.execute("DELETE FROM payment_rollups")
+    cursor.execute(f"INSERT INTO payment_rollups (community_id, month, related_type, status, amount, count) {PAYMENT_ROLLUP_SELECT}")
+
+
+def _migration_0022_event_times_to_utc(cursor):
+    """Convert event times saved by the old H5 editor (zone-less local time in APP_TIMEZONE) to UTC.
+
+    Migration 10 kept zone-less values as-is and labelled them UTC; until the editor sent an
+    offset, start_at / end_at / early_bird_deadline were the organiser's local wall-clock time.
+    """
+    offset = utc_offset_minutes(APP_TIMEZONE)
+    if not offset:
+        return
+    shift = f"{-offset} minutes"
+    # 活動費的繳費期限複製自當時的 start_at，一併換算
+    cursor.execute(
+        "UPDATE payments SET due_date = COALESCE(datetime(due_date, ?), due_date) "
+        "WHERE related_type = 'event' AND due_date = (SELECT start_at FROM events WHERE events.id = payments.related_id)",
+        (shift,),
+    )
+    for column in ("start_at", "end_at", "early_bird_deadline"):
+        # 無法解析的值 datetime() 回傳 NULL，保留原值
+        cursor.execute(
+            f"UPDATE events SET {column} = COALESCE(datetime({column}, ?), {column}) WHERE {column} IS NOT NULL",
+            (shift,),
+        )
+
+
+MIGRATIONS = [
+    (1, "initial schema", _migration_0001_initial_schema),
+    (2, "hot query indexes", _migration_0002_hot_query_indexes),
+    (3, "member directory fts", _migration_0003_users_fts),
+    (4, "profile generation counter", _migration_0004_profile_generation),
+    (5, "smart search cache", _migration_0005_smart_search_cache),
+    (6, "payments keyset indexes", _migration_0006_payments_keyset_indexes),
+    (7, "payments stats covering index", _migration_0007_payments_stats_index),
+    (8, "payment rollups", _migration_0008_payment_rollups),
+    (9, "pending membership payment guard", _migration_0009_pending_membership_guard),
+    (10, "canonical timestamps", _migration_0010_canonical_timestamps),
+    (11, "users created_at index", _migration_0011_users_created_index),
+    (12, "change log for delta sync", _migration_0012_change_log),
+    (13, "event registered_count", _migration_0013_event_registered_count),
+    (14, "check-in scan log", _migration_0014_checkin_scans),
+    (15, "membership token revocations", _migration_0015_membership_token_revocations),
+    (16, "event status counters", _migration_0016_event_status_counts),
+    (17, "payments created_at backfill", _migration_0017_payments_created_at),
+    (18, "check-in scans keyed per event", _migration_0018_checkin_scans_per_event),
+    (19, "change log community scope", _migration_0019_change_log_scope),
+    (20, "payments user due index", _migration_0020_payments_user_due_index),
+    (21, "payment rollups skip unset created_at", _migration_0021_payment_rollups_skip_unset),
+    (22, "legacy event times to UTC", _migration_0022_event_times_to_utc),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_schema_version(conn):
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:  # schema_version 表尚未建立
+        return 0
+    return row[0] or 0
+
+
+def apply_migrations(conn):
+    """Apply pending migrations on an autocommit connection in a single transaction."""
+    if current_schema_version(conn) >= SCHEMA_VERSION:
+        return []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 取得寫入鎖後重新確認，避免多個 worker 同時啟動時重複套用
+        version = current_schema_version(conn)
+        cursor = conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        applied = []
+        for number, name, upgrade in MIGRATIONS:
+            if number <= version:
+                continue
+            upgrade(cursor)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (number, name))
+            applied.append(number)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    for number in applied:
+        logger.info("Applied schema migration %s", number)
+    return applied
+
+
+def migrate(database=DATABASE_NAME):
+    """Apply pending migrations to database; returns the list of applied versions."""
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        apply_storage_profile(conn)
+        return apply_migrations(conn)
+    finally:
+        conn.close()
+
+
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+
+def ensure_schema(database=DATABASE_NAME, force=False):
+    """Run migrations once per process, the first time a connection to database is opened.
+
+    force reruns them, for a file whose contents were replaced (DB restore).
+    """
+    if database in _schema_ready and not force:
+        return
+    with _schema_lock:
+        if force:
+            _schema_ready.discard(database)
+        if database not in _schema_ready:
+            migrate(database)
+            _schema_ready.add(database)
+
+
+# --- Query Plan Checks ---
+# 熱門查詢的形狀（與各端點組出的 SQL 一致）。`python app.py explain` 會在套用全部 migration 的
+# 空白資料庫上跑 EXPLAIN QUERY PLAN，任何一條退化成 SCAN 或需要暫存 B-tree 排序就以非零狀態結束。
+# 新增或修改熱門路徑的查詢時，請同步更新這份清單（動態組出的統計查詢在定義處以 HOT_QUERIES += 登記）。
+HOT_QUERIES = [
+    ("member directory search",
+     "SELECT u.id, u.username FROM users_fts JOIN users u ON u.id = users_fts.rowid "
+     "WHERE users_fts MATCH ? ORDER BY bm25(users_fts), u.id LIMIT ? OFFSET ?", ('"alice"', 21, 0)),
+    ("list_payments by community",
+     "SELECT p.*, u.username, u.profile_picture FROM payments p LEFT JOIN users u ON p.user_id = u.id "
+     "WHERE 1=1 AND p.community_id = ? ORDER BY p.created_at DESC", (1,)),
+    ("list_payments by user",
+     "SELECT p.*, u.username, u.profile_picture FROM payments p LEFT JOIN users u ON p.user_id = u.id "
+     "WHERE 1=1 AND p.user_id = ? ORDER BY p.created_at DESC", (1,)),
+    ("list_payments keyset page",
+     "SELECT p.id, p.created_at, u.username FROM payments p LEFT JOIN users u ON p.user_id = u.id "
+     "WHERE p.community_id = ? AND p.status = ? AND (p.created_at, p.id) < (?, ?) "
+     "ORDER BY p.created_at DESC, p.id DESC LIMIT ?", (1, "pending", "2030-01-01 00:00:00", 10, 51)),
+    ("payments_report details",
+     "SELECT p.*, u.username FROM payments p LEFT JOIN users u ON p.user_id = u.id "
+     "WHERE 1=1 AND p.community_id = ? AND p.created_at >= ? ORDER BY p.created_at DESC", (1, "2025-01-01")),
+    ("list_events by community",
+     "SELECT * FROM events WHERE 1=1 AND community_id = ? ORDER BY start_at DESC", (1,)),
+    ("event registration lookup",
+     "SELECT * FROM event_registrations WHERE event_id = ? AND user_id = ?", (1, 1)),
+    ("list_announcements by community",
+     "SELECT * FROM announcements WHERE 1=1 AND community_id = ? ORDER BY is_pinned DESC, created_at DESC", (1,)),
+    ("list_photos",
+     "SELECT * FROM photos WHERE album_id = ? ORDER BY created_at DESC", (1,)),
+    ("permission roles load",
+     "SELECT community_id, role FROM memberships WHERE user_id = ? "
+     "UNION ALL SELECT community_id, role FROM community_members WHERE user_id = ?", (1, 1)),
+    ("render_community_view posts",
+     "SELECT p.*, u.username FROM posts p JOIN users u ON p.user_id = u.id "
+     "WHERE p.community_id = ? ORDER BY p.is_pinned DESC, p.created_at DESC", (1,)),
+    ("render_post likes",
+     "SELECT COUNT(*) FROM likes WHERE post_id = ?", (1,)),
+    ("render_post comments",
+     "SELECT c.*, u.username FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC", (1,)),
+    ("check_in member lookup",
+     "SELECT user_id, username FROM memberships m JOIN users u ON m.user_id = u.id WHERE m.membership_no = ?", ("M1",)),
+]
+
+
+# 無法由索引順序提供的排序 / 分組（查詢名稱 -> 原因），其餘熱門查詢出現 TEMP B-TREE 即失敗
+HOT_QUERY_TEMP_SORTS = {
+    "member directory search": "依 bm25 分數排序，只排序 MATCH 命中的列",
+    "payments_report months x categories": "依 strftime 月份分組，索引只能提供 created_at 範圍",
+    "generate_due_payments all communities": "依社群分組，索引用於 status / expires_at 範圍",
+}
+
+
+def _plan_line_ok(line, temp_sort_ok=False):
+    # FTS5 的 MATCH 在計畫中顯示為 "SCAN users_fts VIRTUAL TABLE INDEX 0:M..."，那是索引查詢
+    if line.startswith("SCAN ") and "VIRTUAL TABLE INDEX" in line:
+        return ":M" in line
+    if "TEMP B-TREE" in line:
+        return temp_sort_ok
+    return not line.startswith("SCAN ")
+
+
+def check_query_plans(conn=None):
+    """Return [(name, plan_lines, ok)] for HOT_QUERIES; a SCAN or TEMP B-TREE plan line fails the query.
+
+    TEMP B-TREE is accepted only for the queries listed in HOT_QUERY_TEMP_SORTS.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        apply_migrations(conn)
+    try:
+        results = []
+        for name, sql, params in HOT_QUERIES:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+            ok = all(_plan_line_ok(line, name in HOT_QUERY_TEMP_SORTS) for line in plan)
+            results.append((name, plan, ok))
+        return results
+    finally:
+        if own_conn:
+            conn.close()
 
+
+# --- Password Hashing ---
+# Streamlit 頁面與腳本使用同步版本；API 端點改用下方的 password_hasher（process pool）
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+
+# pbkdf2 是純 CPU 工作，在 request thread 內執行會佔住 threadpool（簽到請求也在同一個 pool）。
+# 交給獨立的 process pool 計算，不受 GIL 限制；等待中的工作有上限，超過即回 503。
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(2, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+
+
+class PasswordHasher:
+    """Async facade over a hashing process pool with a bounded queue and basic metrics."""
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                 queue_timeout=PASSWORD_HASH_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+        self._stats = {"completed": 0, "rejected": 0, "failed": 0, "pending": 0, "total_seconds": 0.0}
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                # spawn：worker 只 import passwords.py，不複製主程序的 thread 與連線
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+        return semaphore
+
+    async def _run(self, job, *args):
+        semaphore = self._get_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="系統繁忙，請稍後再試。")
+        self._stats["pending"] += 1
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(self._get_executor(), job, *args)
+            except BrokenProcessPool:
+                # worker 意外終止：重建 pool，這次先在 thread 中完成
+                logger.warning("Password hashing pool broke, recreating it")
+                with self._executor_lock:
+                    self._executor = None
+                result = await run_in_threadpool(job, *args)
+        except Exception:
+            self._stats["failed"] += 1
+            raise
+        finally:
+            semaphore.release()
+            self._stats["pending"] -= 1
+        self._stats["completed"] += 1
+        self._stats["total_seconds"] += time.monotonic() - started
+        return result
+
+    async def hash(self, password):
+        return await self._run(passwords.hash_job, password)
+
+    async def verify(self, password, hashed_password):
+        """Return (matches, needs_rehash)."""
+        return await self._run(passwords.verify_job, password, hashed_password)
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self):
+        completed = self._stats["completed"]
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self._stats["pending"],
+            "completed": completed,
+            "rejected": self._stats["rejected"],
+            "failed": self._stats["failed"],
+            "avg_ms": round(self._stats["total_seconds"] / completed * 1000, 2) if completed else 0,
+        }
+
+
+password_hasher = PasswordHasher()
+
 # --- Pydantic Models ---
 class UserCreate(BaseModel):
     email: str
@@ -431,6 +1690,15 @@ class PaymentUpdate(BaseModel):
     related_id: Optional[int] = None
     note: Optional[str] = None
 
+class PaymentBulkItem(BaseModel):
+    id: int
+    action: str = "update"  # "update"（狀態 / 支付方式）或 "delete"
+    status: Optional[str] = None
+    method: Optional[str] = None
+
+class PaymentBulkRequest(BaseModel):
+    items: List[PaymentBulkItem]
+
 class Membership(BaseModel):
     id: int
     user_id: int
@@ -493,6 +1761,9 @@ class Event(BaseModel):
     early_bird_price: Optional[float] = None
     early_bird_deadline: Optional[str] = None
     created_by: int
+    registered_count: int = 0
+    checked_in_count: int = 0
+    cancelled_count: int = 0
 
     created_at: str
 
@@ -503,12 +1774,16 @@ class EventRegistrationCreate(BaseModel):
     event_id: int
     user_id: int
     status: Optional[str] = "registered"
+    method: Optional[str] = None  # 付費活動的付款方式，寫入待繳帳單
+
+class EventRegistrationCancel(BaseModel):
+    user_id: Optional[int] = None  # 預設為目前登入者；取消他人報名需管理權限
 
 class EventRegistration(BaseModel):
     id: int
     event_id: int
     user_id: int
-    status: str
+    status: str  # registered / waitlisted / checked_in / cancelled
     registered_at: str
 
     class Config:
@@ -601,6 +1876,12 @@ class Message(BaseModel):
 # --- FastAPI App ---
 app = FastAPI()
 
+@app.on_event("shutdown")
+async def shutdown_background_workers():
+    password_hasher.shutdown()
+    await llm_gateway.aclose()
+
+
 # --- CORS ---
 # 允許的來源：從環境變數讀取，預設允許所有（開發環境）
 # 生產環境建議設置：ALLOWED_ORIGINS=https://your-domain.onrender.com,https://www.your-domain.com
@@ -630,27 +1911,68 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # jti 讓每張 token 各自對應一筆使用者快取
+    to_encode.update({"exp": expire, "jti": secrets.token_hex(8)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# --- Authenticated User Cache ---
+# 幾乎每個 H5 請求都帶 token，快取驗證後的 User，省去每次查 users 表。
+# 快取只在單一 process 內有效；多 worker 部署時其他 worker 最多在 TTL 內讀到舊資料。
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+
+class UserCache:
+    """Bounded LRU cache of User objects keyed by (user id, token jti), with a TTL per entry."""
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (user_id, jti) -> (expires_at, User)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, jti):
+        key = (user_id, jti)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, jti, user):
+        with self._lock:
+            self._entries[(user_id, jti)] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end((user_id, jti))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop every cached entry of user_id (all of their tokens)."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache()
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
-    # 1. Try Streamlit session first (for monolithic app usage)
-    # Note: accessing st.session_state from a different thread (Uvicorn worker) might not work as expected
-    # but we keep it for the Streamlit runner.
-    try:
-        if "user_id" in st.session_state and st.session_state.user_id:
-             db = get_db()
-             cursor = db.cursor()
-             cursor.execute("SELECT * FROM users WHERE id = ?", (st.session_state.user_id,))
-             user_data = cursor.fetchone()
-             db.close()
-             if user_data:
-                 return User(**dict(user_data))
-    except Exception:
-        pass # Ignore Streamlit session errors in API context
-
-    # 2. Try JWT token (for Vue/API usage)
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -661,20 +1983,169 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         user_id_str: str = payload.get("sub")
         if user_id_str is None:
             raise credentials_exception
-    except JWTError:
+        user_id = int(user_id_str)
+    except (JWTError, ValueError):
         raise credentials_exception
-        
+
+    jti = payload.get("jti")  # 舊版 token 沒有 jti，以 None 作為 key
+    user = user_cache.get(user_id, jti)
+    if user is not None:
+        return user
+
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (int(user_id_str),))
+    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
     user_data = cursor.fetchone()
     db.close()
-    
-    if user_data is None:
-        raise credentials_exception
+
     if user_data is None:
         raise credentials_exception
-    return User(**dict(user_data))
+    user = User(**dict(user_data))
+    user_cache.put(user_id, jti, user)
+    return user
+
+
+# --- Permissions ---
+# 角色來自 memberships（H5 會籍）與 community_members（Streamlit 社團），依社群合併後快取。
+# 權限檢查幾乎每個管理請求都會跑；會籍變更時主動失效，TTL 只是多 worker 部署時的上限。
+STAFF_ROLES = ("admin", "staff", "moderator")
+ADMIN_ROLES = ("admin",)
+PERMISSION_CACHE_SIZE = int(os.getenv("PERMISSION_CACHE_SIZE", "4096"))
+PERMISSION_CACHE_TTL = float(os.getenv("PERMISSION_CACHE_TTL", "60"))
+
+
+def _load_roles(user_id):
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT community_id, role FROM memberships WHERE user_id = ? "
+            "UNION ALL SELECT community_id, role FROM community_members WHERE user_id = ?",
+            (user_id, user_id),
+        )
+        roles = {}
+        for row in cursor.fetchall():
+            roles.setdefault(row["community_id"], set()).add(row["role"])
+    finally:
+        db.close()
+    return {community_id: frozenset(names) for community_id, names in roles.items()}
+
+
+class PermissionCache:
+    """Bounded LRU cache of each user's roles ({community_id: frozenset of roles}), with a TTL per entry."""
+
+    def __init__(self, max_size=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, roles)
+        self._generation = 0  # 每次失效加一；載入期間發生失效時不寫入快取，避免存回舊角色
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def roles(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            generation = self._generation
+        roles = _load_roles(user_id)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (time.monotonic() + self.ttl, roles)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return roles
+
+    def invalidate(self, user_id=None):
+        """Drop the cached roles of user_id (of everyone when None)."""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+permission_cache = PermissionCache()
+
+
+def has_role(user_id, roles=STAFF_ROLES, community_id=None):
+    """Whether user_id holds one of roles in community_id (in any community when None)."""
+    granted = permission_cache.roles(user_id)
+    if community_id is None:
+        return any(not names.isdisjoint(roles) for names in granted.values())
+    return not granted.get(community_id, frozenset()).isdisjoint(roles)
+
+
+def role_communities(user_id, roles=STAFF_ROLES):
+    """Sorted ids of the communities where user_id holds one of roles."""
+    return sorted(community_id for community_id, names in permission_cache.roles(user_id).items()
+                  if not names.isdisjoint(roles))
+
+
+def community_param(name, default=None):
+    """Community resolver for require_role: the int path / query parameter name, default when absent.
+
+    Without a default the parameter is required (422), so an omitted community never widens
+    the check to "staff of any community".
+    """
+    def resolve(request: Request):
+        value = request.path_params.get(name, request.query_params.get(name))
+        if value is None:
+            if default is None:
+                raise HTTPException(status_code=422, detail=f"缺少 {name}")
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"{name} 必須是整數")
+    return resolve
+
+
+def require_role(community=None, roles=STAFF_ROLES):
+    """Dependency factory guarding an endpoint; resolves to the current user or raises 403.
+
+    community scopes the check: None for any community, a required parameter name (see
+    community_param) or a callable(request) returning the community id.
+    """
+    if isinstance(community, str):
+        community = community_param(community)
+
+    def dependency(request: Request, current_user: User = Depends(get_current_user)):
+        community_id = community(request) if community is not None else None
+        if not has_role(current_user.id, roles, community_id):
+            raise HTTPException(status_code=403, detail="權限不足")
+        return current_user
+    return dependency
+
+
+@functools.lru_cache(maxsize=4096)
+def _event_community_id(event_id):
+    """Community of an event (never changes once created); 404 when the event does not exist."""
+    db = get_db()
+    try:
+        row = db.execute("SELECT community_id FROM events WHERE id = ?", (event_id,)).fetchone()
+    finally:
+        db.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="活動不存在")
+    return row["community_id"]
+
+
+def event_community(request: Request):
+    """require_role community resolver for /api/events/{event_id}/... routes."""
+    return _event_community_id(community_param("event_id")(request))
 
 
 def generate_membership_no():
@@ -686,18 +2157,17 @@ def generate_membership_no():
 
 # --- Auth API Endpoints (for Streamlit UI) ---
 @app.post("/api/auth/register")
-def api_register(payload: ApiRegisterRequest):
-    db = get_db()
-    cursor = db.cursor()
-    hashed_password = get_password_hash(payload.password)
-    try:
+async def api_register(payload: ApiRegisterRequest):
+    hashed_password = await password_hasher.hash(payload.password)
+
+    def _register(db):
+        cursor = db.cursor()
         cursor.execute(
             "INSERT INTO users (email, phone, username, hashed_password) VALUES (?, ?, ?, ?)",
             (payload.email, payload.phone_number, payload.username, hashed_password),
         )
-        db.commit()
 
-        # Generate Membership
+        # Generate Membership（與建立使用者在同一個交易中）
         user_id = cursor.lastrowid
         membership_no = generate_membership_no()
         try:
@@ -705,37 +2175,58 @@ def api_register(payload: ApiRegisterRequest):
                 "INSERT INTO memberships (user_id, community_id, membership_no, level, status, role, joined_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (user_id, 1, membership_no, 'friend', 'active', 'member', datetime.utcnow()),
             )
-            db.commit()
         except sqlite3.Error as e:
-            # Log error but don't fail registration completely if membership fails? 
-            # Ideally should rollback user creation too.
+            # 會籍建立失敗不影響註冊本身
             print(f"Failed to create membership: {e}")
-            # db.rollback() # Cannot rollback committed user?
-            # Ideally we should do both in one transaction without intermediate commit.
-            # But the code above commits user first.
-            pass
 
+    try:
+        await asyncio.wrap_future(db_writer.submit(_register))
     except sqlite3.IntegrityError as exc:
-        db.rollback()
         raise HTTPException(status_code=400, detail=f"註冊失敗: {exc}") from exc
-    finally:
-        db.close()
     return {"message": "註冊成功"}
 
 
-@app.post("/api/auth/login")
-def api_login(payload: ApiLoginRequest):
+def _find_login_user(identifier):
     db = get_db()
     cursor = db.cursor()
     cursor.execute(
         "SELECT * FROM users WHERE email = ? OR phone = ? OR username = ?",
-        (payload.identifier, payload.identifier, payload.identifier),
+        (identifier, identifier, identifier),
     )
     user_data = cursor.fetchone()
     db.close()
+    return dict(user_data) if user_data else None
+
 
-    if not user_data or not verify_password(payload.password, user_data["hashed_password"]):
+async def _rehash_password(user_id, old_hash, password):
+    """Background task: migrate a legacy (e.g. bcrypt) hash to the current scheme after login."""
+    try:
+        new_hash = await password_hasher.hash(password)
+
+        def _update(db):
+            # 只在密碼未被同時修改的情況下覆蓋
+            db.execute(
+                "UPDATE users SET hashed_password = ? WHERE id = ? AND hashed_password = ?",
+                (new_hash, user_id, old_hash),
+            )
+
+        await asyncio.wrap_future(db_writer.submit(_update))
+    except Exception as e:
+        logger.warning("Password rehash for user %s skipped: %s", user_id, e)
+
+
+@app.post("/api/auth/login")
+async def api_login(payload: ApiLoginRequest, background_tasks: BackgroundTasks):
+    user_data = await run_in_threadpool(_find_login_user, payload.identifier)
+    matches, needs_rehash = False, False
+    if user_data:
+        matches, needs_rehash = await password_hasher.verify(payload.password, user_data["hashed_password"])
+
+    if not matches:
         raise HTTPException(status_code=401, detail="無效的帳號或密碼，請確認後重試。")
+    if needs_rehash:
+        # 回應送出後才重新雜湊，不拖慢登入
+        background_tasks.add_task(_rehash_password, user_data["id"], user_data["hashed_password"], payload.password)
 
     user_info = {
         "id": user_data["id"],
@@ -785,7 +2276,7 @@ def forgot_password(payload: ForgotPasswordRequest):
 
 
 @app.post("/api/auth/reset-password")
-def reset_password(payload: ResetPasswordRequest):
+async def reset_password(payload: ResetPasswordRequest):
     token_data = _password_reset_tokens.get(payload.token)
     if not token_data:
         raise HTTPException(status_code=400, detail="重置連結無效或已過期。")
@@ -797,78 +2288,88 @@ def reset_password(payload: ResetPasswordRequest):
     if len(payload.new_password) < 6:
         raise HTTPException(status_code=400, detail="密碼長度至少 6 個字元。")
 
-    db = get_db()
-    cursor = db.cursor()
-    hashed = get_password_hash(payload.new_password)
-    cursor.execute("UPDATE users SET hashed_password = ? WHERE id = ?", (hashed, token_data["user_id"]))
-    db.commit()
-    db.close()
+    hashed = await password_hasher.hash(payload.new_password)
+
+    def _update(db):
+        db.execute("UPDATE users SET hashed_password = ? WHERE id = ?", (hashed, token_data["user_id"]))
+
+    await asyncio.wrap_future(db_writer.submit(_update))
+    user_cache.invalidate(token_data["user_id"])
 
     _password_reset_tokens.pop(payload.token, None)
     return {"message": "密碼已成功重置，請使用新密碼登入。"}
 
 
-@app.post("/api/auth/wechat_sso")
-def api_wechat_sso(payload: ApiWeChatSSORequest):
-    wechat_id = payload.wechat_id.strip()
-    if not wechat_id:
-        raise HTTPException(status_code=400, detail="wechat_id 不能為空")
-
+def _find_wechat_user(wechat_id):
     db = get_db()
     cursor = db.cursor()
     cursor.execute("SELECT * FROM users WHERE wechat_id = ?", (wechat_id,))
     user_data = cursor.fetchone()
+    db.close()
+    return dict(user_data) if user_data else None
 
-    if not user_data:
-        base_username = (payload.nickname or f"wechat_{wechat_id[:8]}").strip()
-        username = base_username
-        suffix = 1
-        while True:
-            cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-            if not cursor.fetchone():
-                break
-            username = f"{base_username}_{suffix}"
-            suffix += 1
 
-        email = f"{wechat_id}@wechat.local"
-        email_candidate = email
-        email_suffix = 1
-        while True:
-            cursor.execute("SELECT 1 FROM users WHERE email = ?", (email_candidate,))
-            if not cursor.fetchone():
-                break
-            email_candidate = f"{wechat_id}+{email_suffix}@wechat.local"
-            email_suffix += 1
+def _create_wechat_user(payload, wechat_id, hashed_password):
+    db = get_db()
+    cursor = db.cursor()
+    base_username = (payload.nickname or f"wechat_{wechat_id[:8]}").strip()
+    username = base_username
+    suffix = 1
+    while True:
+        cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
+        if not cursor.fetchone():
+            break
+        username = f"{base_username}_{suffix}"
+        suffix += 1
+
+    email = f"{wechat_id}@wechat.local"
+    email_candidate = email
+    email_suffix = 1
+    while True:
+        cursor.execute("SELECT 1 FROM users WHERE email = ?", (email_candidate,))
+        if not cursor.fetchone():
+            break
+        email_candidate = f"{wechat_id}+{email_suffix}@wechat.local"
+        email_suffix += 1
+    db.close()
 
-        random_password = secrets.token_urlsafe(32)
-        hashed_password = get_password_hash(random_password)
+    def _insert(wdb):
+        wcursor = wdb.cursor()
+        wcursor.execute(
+            "INSERT INTO users (email, phone, username, wechat_id, hashed_password, profile_picture) VALUES (?, ?, ?, ?, ?, ?)",
+            (email_candidate, None, username, wechat_id, hashed_password, payload.avatar_url),
+        )
+
+        # Generate Membership for WeChat User
+        new_user_id = wcursor.lastrowid
+        membership_no = generate_membership_no()
         try:
-            cursor.execute(
-                "INSERT INTO users (email, phone, username, wechat_id, hashed_password, profile_picture) VALUES (?, ?, ?, ?, ?, ?)",
-                (email_candidate, None, username, wechat_id, hashed_password, payload.avatar_url),
+            wcursor.execute(
+                "INSERT INTO memberships (user_id, community_id, membership_no, level, status, role, joined_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (new_user_id, 1, membership_no, 'friend', 'active', 'member', datetime.utcnow()),
             )
-            db.commit()
-            
-            # Generate Membership for WeChat User
-            new_user_id = cursor.lastrowid
-            membership_no = generate_membership_no()
-            try:
-                cursor.execute(
-                    "INSERT INTO memberships (user_id, community_id, membership_no, level, status, role, joined_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (new_user_id, 1, membership_no, 'friend', 'active', 'member', datetime.utcnow()),
-                )
-                db.commit()
-            except sqlite3.Error:
-                pass
+        except sqlite3.Error:
+            pass
+        wcursor.execute("SELECT * FROM users WHERE id = ?", (new_user_id,))
+        return dict(wcursor.fetchone())
 
-        except sqlite3.IntegrityError as exc:
-            db.rollback()
-            raise HTTPException(status_code=400, detail=f"微信註冊失敗: {exc}") from exc
+    try:
+        return db_writer.run(_insert)
+    except sqlite3.IntegrityError as exc:
+        raise HTTPException(status_code=400, detail=f"微信註冊失敗: {exc}") from exc
 
-        cursor.execute("SELECT * FROM users WHERE wechat_id = ?", (wechat_id,))
-        user_data = cursor.fetchone()
 
-    db.close()
+@app.post("/api/auth/wechat_sso")
+async def api_wechat_sso(payload: ApiWeChatSSORequest):
+    wechat_id = payload.wechat_id.strip()
+    if not wechat_id:
+        raise HTTPException(status_code=400, detail="wechat_id 不能為空")
+
+    user_data = await run_in_threadpool(_find_wechat_user, wechat_id)
+    if not user_data:
+        random_password = secrets.token_urlsafe(32)
+        hashed_password = await password_hasher.hash(random_password)
+        user_data = await run_in_threadpool(_create_wechat_user, payload, wechat_id, hashed_password)
 
     user_info = {
         "id": user_data["id"],
@@ -950,6 +2451,7 @@ def create_community(payload: CommunityCreate, created_by: int):
         db.commit()
     except sqlite3.IntegrityError as exc:
         db.rollback()
+        db.close()
         raise HTTPException(status_code=400, detail=f"建立社團失敗: {exc}") from exc
     cursor.execute("SELECT * FROM communities WHERE id = ?", (cursor.lastrowid,))
     row = cursor.fetchone()
@@ -964,9 +2466,9 @@ def create_community(payload: CommunityCreate, created_by: int):
 def api_list_memberships(
     user_id: Optional[int] = None, 
     community_id: Optional[int] = None,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    db=Depends(db_connection),
 ):
-    db = get_db()
     cursor = db.cursor()
     query = "SELECT * FROM memberships WHERE 1=1"
     params = []
@@ -984,9 +2486,11 @@ def api_list_memberships(
 
 @app.post("/api/memberships", response_model=Membership)
 def api_create_membership(payload: MembershipCreate, current_user: User = Depends(get_current_user)):
-    db = get_db()
-    cursor = db.cursor()
-    try:
+    if not has_role(current_user.id, ADMIN_ROLES if payload.role in STAFF_ROLES else STAFF_ROLES, payload.community_id):
+        raise HTTPException(status_code=403, detail="權限不足")
+    normalize_payload_timestamps(payload, "expires_at", "joined_at")
+    def _insert(db):
+        cursor = db.cursor()
         cursor.execute(
             """
             INSERT INTO memberships (user_id, community_id, membership_no, level, status, role, expires_at, joined_at)
@@ -1003,19 +2507,20 @@ def api_create_membership(payload: MembershipCreate, current_user: User = Depend
                 payload.joined_at,
             ),
         )
-        db.commit()
+        cursor.execute("SELECT * FROM memberships WHERE id = ?", (cursor.lastrowid,))
+        return dict(cursor.fetchone())
+
+    try:
+        row = db_writer.run(_insert)
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="該用戶已是此社群會員")
-    cursor.execute("SELECT * FROM memberships WHERE id = ?", (cursor.lastrowid,))
-    row = cursor.fetchone()
-    db.close()
-    return Membership(**dict(row))
+    permission_cache.invalidate(payload.user_id)
+    return Membership(**row)
 
 
 @app.patch("/api/memberships/{membership_id}", response_model=Membership)
 def api_update_membership(membership_id: int, payload: MembershipUpdate, current_user: User = Depends(get_current_user)):
-    db = get_db()
-    cursor = db.cursor()
+    normalize_payload_timestamps(payload, "expires_at", "joined_at")
     updates = []
     params = []
     
@@ -1037,23 +2542,225 @@ def api_update_membership(membership_id: int, payload: MembershipUpdate, current
         
     if not updates:
         raise HTTPException(status_code=400, detail="沒有要更新的欄位")
-        
+
+    db = get_db()
+    try:
+        target = db.execute("SELECT community_id FROM memberships WHERE id = ?", (membership_id,)).fetchone()
+    finally:
+        db.close()
+    if not target:
+        raise HTTPException(status_code=404, detail="會籍不存在")
+    # 變更角色需要社群管理員；其他欄位幹部即可
+    if not has_role(current_user.id, ADMIN_ROLES if payload.role else STAFF_ROLES, target["community_id"]):
+        raise HTTPException(status_code=403, detail="權限不足")
+
     params.append(membership_id)
-    cursor.execute(f"UPDATE memberships SET {', '.join(updates)} WHERE id = ?", params)
-    db.commit()
-    
-    cursor.execute("SELECT * FROM memberships WHERE id = ?", (membership_id,))
-    row = cursor.fetchone()
-    db.close()
-    
+
+    def _update(db):
+        cursor = db.cursor()
+        cursor.execute(f"UPDATE memberships SET {', '.join(updates)} WHERE id = ?", params)
+        cursor.execute("SELECT * FROM memberships WHERE id = ?", (membership_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    row = db_writer.run(_update)
     if not row:
         raise HTTPException(status_code=404, detail="會籍不存在")
-    return Membership(**dict(row))
+    permission_cache.invalidate(row["user_id"])
+    if payload.status and row["status"] != "active" and row["membership_no"]:
+        # 會籍停用或過期：已簽發的會員卡立即失效
+        revoke_membership_card(row["membership_no"])
+    return Membership(**row)
+
+
+# --- Membership Card Tokens ---
+# 會員卡 QR Code 內容為 HMAC 簽章的 token：MT1.<kid>.<payload>.<signature>
+# payload 為 base64url 的 "user_id|community_id|membership_no|exp|iat|username"，簽到時驗證簽章即可得知會員身分，不必查詢資料庫。
+# MEMBERSHIP_TOKEN_KEYS="kid:secret,..."：第一把用來簽發，其餘只用來驗證（輪替時把新金鑰放在最前面，舊卡片到期後再移除舊金鑰）。
+MEMBERSHIP_TOKEN_PREFIX = "MT1"
+MEMBERSHIP_TOKEN_TTL_DAYS = int(os.getenv("MEMBERSHIP_TOKEN_TTL_DAYS", "30"))
+MEMBERSHIP_TOKEN_REVOCATION_REFRESH_SECONDS = float(os.getenv("MEMBERSHIP_TOKEN_REVOCATION_REFRESH_SECONDS", "30"))
+
+
+def _membership_token_keys(raw):
+    keys = {}
+    for item in raw.split(","):
+        kid, _, secret = item.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret.encode()
+    if not keys:
+        # 未設定時由 SECRET_KEY 衍生一把，與 JWT 金鑰分開
+        keys["k0"] = hmac.new(SECRET_KEY.encode(), b"membership-token", hashlib.sha256).digest()
+    return keys
+
+
+MEMBERSHIP_TOKEN_KEYS = _membership_token_keys(os.getenv("MEMBERSHIP_TOKEN_KEYS", ""))
+
+
+class MembershipTokenError(ValueError):
+    """A card token that must be rejected; status is the check-in outcome (invalid_token / expired / revoked)."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _token_signature(key, signed):
+    # 截成 128 bits，讓 QR Code 維持小而易掃
+    return _b64url(hmac.new(key, signed.encode(), hashlib.sha256).digest()[:16])
+
+
+def is_membership_token(value):
+    return isinstance(value, str) and value.startswith(MEMBERSHIP_TOKEN_PREFIX + ".")
+
+
+def sign_membership_token(user_id, community_id, membership_no, username, expires_at=None, now=None):
+    """Signed card token valid until the membership expires, capped at MEMBERSHIP_TOKEN_TTL_DAYS."""
+    now = int(now if now is not None else time.time())
+    exp = now + MEMBERSHIP_TOKEN_TTL_DAYS * 86400
+    if expires_at:
+        exp = min(exp, int(datetime.strptime(normalize_timestamp(expires_at), TIMESTAMP_FORMAT)
+                           .replace(tzinfo=timezone.utc).timestamp()))
+    kid = next(iter(MEMBERSHIP_TOKEN_KEYS))
+    payload = _b64url(f"{user_id}|{community_id}|{membership_no}|{exp}|{now}|{username}".encode())
+    signed = f"{MEMBERSHIP_TOKEN_PREFIX}.{kid}.{payload}"
+    return f"{signed}.{_token_signature(MEMBERSHIP_TOKEN_KEYS[kid], signed)}", exp
+
+
+class MembershipTokenRevocations:
+    """Process-local copy of membership_token_revocations, reloaded every refresh_seconds.
+
+    Revocations made through this process apply immediately; ones made by another process
+    apply within refresh_seconds. Verification itself never queries the database.
+    """
+
+    def __init__(self, refresh_seconds=MEMBERSHIP_TOKEN_REVOCATION_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._revoked = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        db = get_db()
+        try:
+            rows = db.execute("SELECT membership_no, revoked_at FROM membership_token_revocations").fetchall()
+        finally:
+            db.close()
+        self._revoked = {r["membership_no"]: r["revoked_at"] for r in rows}
+        self._loaded_at = time.monotonic()
+
+    def revoked_at(self, membership_no):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+            with self._lock:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+                    self._refresh()
+        return self._revoked.get(membership_no)
+
+    def add(self, membership_no, revoked_at):
+        self._revoked[membership_no] = revoked_at
+
+    def clear(self):
+        """Reload from the database on the next lookup."""
+        with self._lock:
+            self._loaded_at = None
+
+
+membership_token_revocations = MembershipTokenRevocations()
+
+
+def verify_membership_token(token, now=None):
+    """Claims {user_id, community_id, membership_no, exp, iat, username}; raises MembershipTokenError."""
+    parts = token.split(".")
+    if len(parts) != 4 or parts[0] != MEMBERSHIP_TOKEN_PREFIX:
+        raise MembershipTokenError("invalid_token", "會員卡無效")
+    key = MEMBERSHIP_TOKEN_KEYS.get(parts[1])
+    if key is None or not hmac.compare_digest(_token_signature(key, ".".join(parts[:3])), parts[3]):
+        raise MembershipTokenError("invalid_token", "會員卡無效")
+    try:
+        user_id, community_id, membership_no, exp, iat, username = _b64url_decode(parts[2]).decode().split("|", 5)
+        claims = {"user_id": int(user_id), "community_id": int(community_id), "membership_no": membership_no,
+                  "exp": int(exp), "iat": int(iat), "username": username}
+    except ValueError:
+        raise MembershipTokenError("invalid_token", "會員卡無效")
+    if claims["exp"] < (now if now is not None else time.time()):
+        raise MembershipTokenError("expired", "會員卡已過期，請重新開啟會員卡")
+    revoked_at = membership_token_revocations.revoked_at(membership_no)
+    if revoked_at is not None and claims["iat"] <= revoked_at:
+        raise MembershipTokenError("revoked", "會員卡已停用")
+    return claims
+
+
+def revoke_membership_card(membership_no):
+    """Invalidate every card token issued for membership_no so far; returns the revocation time (epoch seconds)."""
+    revoked_at = int(time.time())
+    db_writer.run(lambda db: db.execute(
+        "INSERT INTO membership_token_revocations (membership_no, revoked_at) VALUES (?, ?) "
+        "ON CONFLICT (membership_no) DO UPDATE SET revoked_at = excluded.revoked_at",
+        (membership_no, revoked_at),
+    ))
+    membership_token_revocations.add(membership_no, revoked_at)
+    return revoked_at
+
+
+def _card_membership(membership_id, current_user):
+    """The membership row joined with its username; only its owner or admin / staff may manage the card."""
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT m.*, u.username FROM memberships m JOIN users u ON u.id = m.user_id WHERE m.id = ?", (membership_id,)
+        )
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="會籍不存在")
+        if row["user_id"] != current_user.id and not has_role(current_user.id, STAFF_ROLES, row["community_id"]):
+            raise HTTPException(status_code=403, detail="權限不足")
+        return dict(row)
+    finally:
+        db.close()
+
+
+@app.get("/api/memberships/{membership_id}/card-token")
+def membership_card_token(membership_id: int, current_user: User = Depends(get_current_user)):
+    """Signed token for the membership card QR code; {token, membership_no, expires_at}."""
+    membership = _card_membership(membership_id, current_user)
+    if membership["status"] != "active" or not membership["membership_no"]:
+        raise HTTPException(status_code=400, detail="會籍未生效，無法產生會員卡")
+    # 撤銷以秒為單位：同一秒內重新產生的卡片要晚於撤銷時間才有效
+    revoked_at = membership_token_revocations.revoked_at(membership["membership_no"]) or 0
+    token, exp = sign_membership_token(
+        membership["user_id"], membership["community_id"], membership["membership_no"],
+        membership["username"], membership["expires_at"], now=max(time.time(), revoked_at + 1),
+    )
+    if exp <= time.time():
+        raise HTTPException(status_code=400, detail="會籍已過期，無法產生會員卡")
+    expires_at = datetime.fromtimestamp(exp, timezone.utc).strftime(TIMESTAMP_FORMAT)
+    return {"token": token, "membership_no": membership["membership_no"], "expires_at": expires_at}
+
+
+@app.post("/api/memberships/{membership_id}/revoke-card")
+def membership_revoke_card(membership_id: int, current_user: User = Depends(get_current_user)):
+    """Invalidate all card tokens issued so far (lost phone, leaked screenshot); a new one can be fetched afterwards."""
+    membership = _card_membership(membership_id, current_user)
+    if not membership["membership_no"]:
+        raise HTTPException(status_code=400, detail="此會籍沒有會員編號")
+    revoked_at = revoke_membership_card(membership["membership_no"])
+    return {"membership_no": membership["membership_no"],
+            "revoked_at": datetime.fromtimestamp(revoked_at, timezone.utc).strftime(TIMESTAMP_FORMAT)}
 
 
 # --- Users API (admin) ---
 @app.get("/api/users", response_model=List[User])
-def api_list_users(current_user: User = Depends(get_current_user)):
+def api_list_users(current_user: User = Depends(require_role())):
     db = get_db()
     cursor = db.cursor()
     cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
@@ -1100,6 +2807,7 @@ def api_update_user(user_id: int, payload: UserUpdate, current_user: User = Depe
     params.append(user_id)
     cursor.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", params)
     db.commit()
+    user_cache.invalidate(user_id)
     cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
     db.close()
@@ -1122,6 +2830,7 @@ def api_update_user(user_id: int, payload: UserUpdate, current_user: User = Depe
 #   5. 保存並重新部署
 #
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
 if not OPENROUTER_API_KEY:
     error_msg = (
         "⚠️  OPENROUTER_API_KEY 未設置！\n"
@@ -1136,6 +2845,8 @@ if not OPENROUTER_API_KEY:
 
 class SmartSearchRequest(BaseModel):
     query: str
+    page: int = 1
+    page_size: int = 20
 
 
 class SearchResult(BaseModel):
@@ -1153,54 +2864,210 @@ class SearchResult(BaseModel):
 class SmartSearchResponse(BaseModel):
     results: List[SearchResult]
     is_ai: bool
+    page: int = 1
+    has_more: bool = False
+
+
+# 描述「找人」意圖的字詞，只用來判斷查詢類型，不參與候選排序
+NEED_INTENT_KEYWORDS = ["找人", "需要", "幫忙", "想找", "有沒有人", "誰能", "誰會", "哪位", "推薦"]
+
+# 服務類關鍵字與同義詞：會員資料常寫職稱（「電工」「家教」），需求則常寫動作（「水電」「補習」）
+NEED_SYNONYMS = {
+    "服務": [],
+    "維修": ["修理", "師傅", "技師", "維護"],
+    "修理": ["維修", "師傅", "技師"],
+    "安裝": ["師傅", "技師", "水電", "冷氣"],
+    "清潔": ["打掃", "清掃", "家政", "保潔"],
+    "搬運": ["搬家", "物流", "司機"],
+    "裝修": ["裝潢", "室內設計", "木工", "油漆", "泥水"],
+    "設計": ["設計師", "平面", "室內設計", "美術"],
+    "教學": ["老師", "教師", "家教", "教練"],
+    "補習": ["家教", "老師", "教師", "輔導"],
+    "代購": ["採購", "跑腿"],
+    "殺蟲": ["除蟲", "消毒", "白蟻"],
+    "煮飯": ["廚師", "烹飪", "料理"],
+    "照顧": ["看護", "護理", "保姆", "照護"],
+    "接送": ["司機", "駕駛", "開車"],
+    "翻譯": ["口譯", "筆譯", "英文", "日文"],
+    "攝影": ["攝影師", "拍照", "錄影"],
+    "拍照": ["攝影", "攝影師"],
+    "剪髮": ["理髮", "髮型師", "美髮"],
+    "美容": ["美甲", "化妝", "美髮"],
+    "按摩": ["推拿", "理療"],
+    "水電": ["水電工", "電工", "水管", "電路", "師傅"],
+    "油漆": ["油漆工", "粉刷", "裝修"],
+}
 
 
 def _looks_like_need(query: str) -> bool:
     """Heuristic: if the query contains service/action keywords, treat as a need description."""
-    need_keywords = [
-        "找人", "需要", "幫忙", "服務", "維修", "修理", "安裝", "清潔", "搬運",
-        "裝修", "設計", "教學", "補習", "代購", "殺蟲", "煮飯", "照顧", "接送",
-        "翻譯", "攝影", "拍照", "剪髮", "美容", "按摩", "水電", "油漆",
-        "想找", "有沒有人", "誰能", "誰會", "哪位", "推薦",
-    ]
-    return any(kw in query for kw in need_keywords)
+    return any(kw in query for kw in NEED_INTENT_KEYWORDS) or any(kw in query for kw in NEED_SYNONYMS)
 
 
-def _direct_search(query: str, cursor) -> list:
-    """LIKE search on username / phone / email."""
-    like = f"%{query}%"
-    cursor.execute(
-        "SELECT id, username, phone, email, bio, skills, occupation, profile_picture "
-        "FROM users WHERE username LIKE ? OR phone LIKE ? OR email LIKE ?",
-        (like, like, like),
-    )
-    rows = cursor.fetchall()
-    return [
-        SearchResult(
-            user_id=r["id"], username=r["username"], phone=r["phone"],
-            email=r["email"], bio=r["bio"], skills=r["skills"],
-            occupation=r["occupation"], profile_picture=r["profile_picture"],
-        )
-        for r in rows
-    ]
+# --- Smart search candidate pre-ranking ---
+# 送進 LLM 的會員名單先經本地 BM25 篩選（skills / occupation / bio，中文以雙字詞切分），
+# prompt 大小只跟 SMART_SEARCH_MAX_CANDIDATES 有關，不再隨會員數成長。設為 0 則送出全部會員（舊行為）。
+SMART_SEARCH_MAX_CANDIDATES = int(os.getenv("SMART_SEARCH_MAX_CANDIDATES", "50"))
+SMART_SEARCH_PROFILE_CHARS = int(os.getenv("SMART_SEARCH_PROFILE_CHARS", "120"))  # 每個欄位放進 prompt 的字數上限
+SMART_SEARCH_INDEX_REFRESH_SECONDS = float(os.getenv("SMART_SEARCH_INDEX_REFRESH_SECONDS", "30"))
 
+_TERM_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+|[a-z0-9]+")
 
-def _ai_search(query: str, cursor) -> list:
-    """Use DeepSeek via OpenRouter to match user needs against member profiles."""
-    cursor.execute(
-        "SELECT id, username, bio, skills, occupation FROM users"
-    )
-    members = cursor.fetchall()
-    if not members:
-        return []
 
+def _search_terms(text: str) -> list:
+    """Tokenise into lowercase latin words and CJK bigrams (single CJK characters stay unigrams)."""
+    terms = []
+    for run in _TERM_RE.findall((text or "").lower()):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def _query_terms(query: str) -> dict:
+    """Query term weights: the query's own terms plus synonyms of any need keyword it contains."""
+    text = query
+    for kw in NEED_INTENT_KEYWORDS:
+        text = text.replace(kw, " ")
+    weights = {}
+    for term in _search_terms(text):
+        weights[term] = 1.0
+    for kw, synonyms in NEED_SYNONYMS.items():
+        if kw in query:
+            for synonym in synonyms:
+                for term in _search_terms(synonym):
+                    weights.setdefault(term, 0.5)
+    return weights
+
+
+class MemberRanker:
+    """In-memory BM25 index over users.skills / occupation / bio.
+
+    Rebuilt when the profile_generation counter changes, at most once per refresh interval,
+    so results may lag profile edits by SMART_SEARCH_INDEX_REFRESH_SECONDS.
+    """
+
+    # 技能、職業比自我介紹更能代表會員能提供的服務
+    FIELD_WEIGHTS = (("skills", 2), ("occupation", 2), ("bio", 1))
+
+    def __init__(self, refresh_interval=SMART_SEARCH_INDEX_REFRESH_SECONDS, k1=1.2, b=0.75):
+        self.refresh_interval = refresh_interval
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._postings = {}  # term -> [(user_id, tf)]
+        self._doc_len = {}
+        self._avg_len = 0.0
+        self._generation = None
+        self._built_at = None
+        self.builds = 0
+
+    def _build(self, cursor, generation):
+        postings, doc_len = {}, {}
+        cursor.execute("SELECT id, skills, occupation, bio FROM users")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                counts = {}
+                for field, weight in self.FIELD_WEIGHTS:
+                    for term in _search_terms(row[field]):
+                        counts[term] = counts.get(term, 0) + weight
+                doc_len[row["id"]] = sum(counts.values())
+                for term, tf in counts.items():
+                    postings.setdefault(term, []).append((row["id"], tf))
+        self._postings = postings
+        self._doc_len = doc_len
+        self._avg_len = (sum(doc_len.values()) / len(doc_len)) if doc_len else 0.0
+        self._generation = generation
+        self._built_at = time.monotonic()
+        self.builds += 1
+
+    def _ensure_fresh(self, cursor):
+        generation = profile_generation(cursor)
+        with self._lock:
+            if self._built_at is None:
+                self._build(cursor, generation)
+            elif generation != self._generation and (
+                generation is None or time.monotonic() - self._built_at >= self.refresh_interval
+            ):
+                self._build(cursor, generation)
+            return self._postings, self._doc_len, self._avg_len
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def clear(self):
+        """Forget the index; the next search rebuilds it (e.g. after a DB restore)."""
+        with self._lock:
+            self._built_at = None
+
+    def member_count(self, cursor):
+        return len(self._ensure_fresh(cursor)[1])
+
+    def top(self, query: str, cursor, limit: int) -> list:
+        """Return up to limit (user_id, score) pairs with a positive score, best first."""
+        postings, doc_len, avg_len = self._ensure_fresh(cursor)
+        total = len(doc_len)
+        scores = {}
+        for term, query_weight in _query_terms(query).items():
+            plist = postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (total - len(plist) + 0.5) / (len(plist) + 0.5))
+            for user_id, tf in plist:
+                norm = self.k1 * (1 - self.b + self.b * doc_len[user_id] / avg_len)
+                scores[user_id] = scores.get(user_id, 0.0) + query_weight * idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+    def stats(self):
+        return {
+            "members": len(self._doc_len),
+            "terms": len(self._postings),
+            "generation": self._generation,
+            "builds": self.builds,
+        }
+
+
+member_ranker = MemberRanker()
+
+
+def _clip(text, limit=SMART_SEARCH_PROFILE_CHARS):
+    text = text or ""
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _smart_search_candidates(query: str, cursor, max_candidates=None) -> tuple:
+    """Member rows to put in the LLM prompt, best lexical matches first.
+
+    Returns (rows, ranked_generation); ranked_generation is the ranker index generation the
+    selection came from, or None when every member was read straight from the database.
+    """
+    if max_candidates is None:
+        max_candidates = SMART_SEARCH_MAX_CANDIDATES
+    if max_candidates <= 0 or member_ranker.member_count(cursor) <= max_candidates:
+        cursor.execute("SELECT id, username, bio, skills, occupation FROM users")
+        return cursor.fetchall(), None
+    ids = [user_id for user_id, _ in member_ranker.top(query, cursor, max_candidates)]
+    if not ids:
+        return [], member_ranker.generation
+    placeholders = ",".join("?" * len(ids))
+    cursor.execute(f"SELECT id, username, bio, skills, occupation FROM users WHERE id IN ({placeholders})", ids)
+    rows = {row["id"]: row for row in cursor.fetchall()}
+    return [rows[i] for i in ids if i in rows], member_ranker.generation
+
+
+def _build_ai_prompt(query: str, members) -> str:
     member_list_text = "\n".join(
-        f"- ID:{m['id']} | 姓名:{m['username']} | 職業:{m['occupation'] or '未填'} "
-        f"| 技能:{m['skills'] or '未填'} | 簡介:{m['bio'] or '未填'}"
+        f"- ID:{m['id']} | 姓名:{m['username']} | 職業:{_clip(m['occupation']) or '未填'} "
+        f"| 技能:{_clip(m['skills']) or '未填'} | 簡介:{_clip(m['bio']) or '未填'}"
         for m in members
     )
-
-    prompt = (
+    return (
         "你是一個社區會員推薦助手。使用者有以下需求：\n"
         f"「{query}」\n\n"
         "以下是社區會員名單：\n"
@@ -1210,142 +3077,671 @@ def _ai_search(query: str, cursor) -> list:
         "如果沒有合適人選，回傳空陣列 []。只回傳 JSON，不要其他文字。"
     )
 
-    try:
-        resp = http_requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": "deepseek/deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.3,
-                "max_tokens": 512,
-            },
-            timeout=30,
-        )
-        resp.raise_for_status()
-        content = resp.json()["choices"][0]["message"]["content"].strip()
-        # Strip markdown fences if present
-        if content.startswith("```"):
-            content = content.split("\n", 1)[1] if "\n" in content else content[3:]
-            if content.endswith("```"):
-                content = content[:-3]
-            content = content.strip()
-        recommendations = json.loads(content)
-    except Exception as e:
-        logger.warning("AI search failed: %s", e)
-        return []
-
-    member_map = {m["id"]: m for m in members}
-    results = []
-    for rec in recommendations[:5]:
-        mid = rec.get("id")
-        if mid and mid in member_map:
-            m = member_map[mid]
-            cursor.execute(
-                "SELECT phone, email, profile_picture FROM users WHERE id = ?",
-                (mid,),
-            )
-            full = cursor.fetchone()
-            results.append(
-                SearchResult(
-                    user_id=mid,
-                    username=m["username"],
-                    phone=full["phone"] if full else None,
-                    email=full["email"] if full else None,
-                    bio=m["bio"],
-                    skills=m["skills"],
-                    occupation=m["occupation"],
-                    profile_picture=full["profile_picture"] if full else None,
-                    match_reason=rec.get("reason", ""),
-                )
-            )
-    return results
 
+SMART_SEARCH_MAX_PAGE_SIZE = 100
+# bm25 欄位權重（順序同 USERS_FTS_COLUMNS）：姓名、電話、Email 命中優先於簡介與技能
+USERS_FTS_WEIGHTS = (10.0, 10.0, 10.0, 1.0, 3.0, 3.0)
 
-@app.post("/api/smart-search", response_model=SmartSearchResponse)
-def api_smart_search(payload: SmartSearchRequest, current_user: User = Depends(get_current_user)):
-    query = payload.query.strip()
-    if not query:
-        raise HTTPException(status_code=400, detail="搜尋內容不能為空")
 
-    db = get_db()
-    cursor = db.cursor()
+def _fts_phrase(query: str) -> str:
+    """Quote the raw query as one FTS5 phrase so user input is never parsed as FTS syntax."""
+    return '"' + query.replace('"', '""') + '"'
 
-    direct_results = _direct_search(query, cursor)
-    if direct_results and not _looks_like_need(query):
-        db.close()
-        return SmartSearchResponse(results=direct_results, is_ai=False)
 
-    ai_results = _ai_search(query, cursor)
-    db.close()
+def _direct_search(query: str, cursor, page: int = 1, page_size: int = 20) -> tuple:
+    """Substring search over the member directory; returns (results, has_more).
+
+    Uses the users_fts trigram index ranked by bm25. Queries shorter than 3 characters
+    (below the trigram size) or databases without users_fts use LIKE on username / phone / email.
+    """
+    offset = (page - 1) * page_size
+    if len(query) >= 3 and has_users_fts(cursor):
+        weights = ", ".join(str(w) for w in USERS_FTS_WEIGHTS)
+        cursor.execute(
+            "SELECT u.id, u.username, u.phone, u.email, u.bio, u.skills, u.occupation, u.profile_picture "
+            "FROM users_fts JOIN users u ON u.id = users_fts.rowid "
+            f"WHERE users_fts MATCH ? ORDER BY bm25(users_fts, {weights}), u.id LIMIT ? OFFSET ?",
+            (_fts_phrase(query), page_size + 1, offset),
+        )
+    else:
+        like = f"%{query}%"
+        cursor.execute(
+            "SELECT id, username, phone, email, bio, skills, occupation, profile_picture "
+            "FROM users WHERE username LIKE ? OR phone LIKE ? OR email LIKE ? ORDER BY id LIMIT ? OFFSET ?",
+            (like, like, like, page_size + 1, offset),
+        )
+    rows = cursor.fetchall()
+    has_more = len(rows) > page_size
+    return [
+        SearchResult(
+            user_id=r["id"], username=r["username"], phone=r["phone"],
+            email=r["email"], bio=r["bio"], skills=r["skills"],
+            occupation=r["occupation"], profile_picture=r["profile_picture"],
+        )
+        for r in rows[:page_size]
+    ], has_more
+
+
+# --- Smart Search Result Cache ---
+# 同一個需求（例如許多會員都輸入「水電」）不必每次都呼叫 OpenRouter。快取存在資料庫（重啟後仍有效，
+# 多個 worker 共用），key 為正規化後的查詢；記錄產生時的 profile_generation，
+# 任何會員的技能、職業、簡介有變動（trigger 會遞增計數）時舊結果即失效。
+SMART_SEARCH_CACHE_TTL = float(os.getenv("SMART_SEARCH_CACHE_TTL", "21600"))
+SMART_SEARCH_CACHE_SIZE = int(os.getenv("SMART_SEARCH_CACHE_SIZE", "1000"))
+
+
+def _normalize_query(query: str) -> str:
+    """Cache key: NFKC (full-width -> half-width), lowercase, whitespace and punctuation removed."""
+    text = unicodedata.normalize("NFKC", query).lower()
+    return re.sub(r"[\W_]+", "", text) or text.strip()
+
+
+class SmartSearchCache:
+    """smart_search_cache table access with in-process hit/miss counters."""
+
+    def __init__(self, ttl=SMART_SEARCH_CACHE_TTL, max_size=SMART_SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "stores": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get(self, query, generation, cursor):
+        """Return cached [{"id", "reason"}] for query at generation, or None."""
+        if generation is None or self.ttl <= 0:
+            return None
+        cursor.execute(
+            "SELECT generation, recommendations, created_at FROM smart_search_cache WHERE query_key = ?",
+            (_normalize_query(query),),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        if row["generation"] != generation or time.time() - row["created_at"] > self.ttl:
+            self._count("stale")
+            self._count("misses")
+            return None
+        self._count("hits")
+        return json.loads(row["recommendations"])
+
+    def put(self, query, generation, recommendations):
+        """Store asynchronously through the writer; evicts expired, outdated and oldest-beyond-size entries."""
+        if generation is None or self.ttl <= 0:
+            return
+        key = _normalize_query(query)
+        payload = json.dumps(recommendations, ensure_ascii=False)
+        now = time.time()
+
+        def _store(db):
+            db.execute(
+                "INSERT OR REPLACE INTO smart_search_cache (query_key, generation, recommendations, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, generation, payload, now),
+            )
+            db.execute(
+                "DELETE FROM smart_search_cache WHERE created_at < ? OR generation < ?",
+                (now - self.ttl, generation),
+            )
+            db.execute(
+                "DELETE FROM smart_search_cache WHERE created_at < "
+                "(SELECT created_at FROM smart_search_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+                (self.max_size - 1,),
+            )
+
+        self._count("stores")
+        future = db_writer.submit(_store)
+        future.add_done_callback(
+            lambda f: f.exception() and logger.warning("Smart search cache store failed: %s", f.exception())
+        )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0
+        stats["ttl"] = self.ttl
+        stats["max_size"] = self.max_size
+        return stats
+
+
+smart_search_cache = SmartSearchCache()
+
+
+def _hydrate_recommendations(recommendations, cursor) -> list:
+    """Turn [{"id", "reason"}] into SearchResults with current profile data, keeping order."""
+    ids = [rec["id"] for rec in recommendations]
+    if not ids:
+        return []
+    placeholders = ",".join("?" * len(ids))
+    cursor.execute(
+        "SELECT id, username, phone, email, bio, skills, occupation, profile_picture "
+        f"FROM users WHERE id IN ({placeholders})",
+        ids,
+    )
+    rows = {r["id"]: r for r in cursor.fetchall()}
+    return [
+        SearchResult(
+            user_id=r["id"], username=r["username"], phone=r["phone"],
+            email=r["email"], bio=r["bio"], skills=r["skills"],
+            occupation=r["occupation"], profile_picture=r["profile_picture"],
+            match_reason=rec["reason"],
+        )
+        for rec in recommendations
+        for r in [rows.get(rec["id"])]
+        if r is not None
+    ]
+
+
+# --- LLM Gateway ---
+# 所有 OpenRouter 呼叫共用一個 keep-alive 的 httpx.AsyncClient（每個 event loop 一個），
+# 同時進行的呼叫數有上限；upstream 連續失敗或逾時時斷路器打開，期間直接回目錄搜尋結果，
+# 不讓少數慢請求拖住整個 API。
+SMART_SEARCH_LLM_TIMEOUT = float(os.getenv("SMART_SEARCH_LLM_TIMEOUT", "20"))
+SMART_SEARCH_MAX_CONCURRENCY = int(os.getenv("SMART_SEARCH_MAX_CONCURRENCY", "8"))
+SMART_SEARCH_QUEUE_TIMEOUT = float(os.getenv("SMART_SEARCH_QUEUE_TIMEOUT", "2"))
+SMART_SEARCH_BREAKER_FAILURES = int(os.getenv("SMART_SEARCH_BREAKER_FAILURES", "5"))
+SMART_SEARCH_BREAKER_RESET_SECONDS = float(os.getenv("SMART_SEARCH_BREAKER_RESET_SECONDS", "30"))
+# 每位使用者的 AI 搜尋額度（token bucket）：每分鐘補充的次數與可累積的上限
+SMART_SEARCH_RATE_PER_MINUTE = float(os.getenv("SMART_SEARCH_RATE_PER_MINUTE", "10"))
+SMART_SEARCH_RATE_BURST = int(os.getenv("SMART_SEARCH_RATE_BURST", "5"))
+
+
+class LLMUnavailable(Exception):
+    """The LLM call was skipped or failed; callers fall back to direct search."""
+
+
+class LLMGateway:
+    """Shared async OpenRouter client with a concurrency limit and a circuit breaker."""
+
+    def __init__(self, url=None, max_concurrency=SMART_SEARCH_MAX_CONCURRENCY, timeout=SMART_SEARCH_LLM_TIMEOUT,
+                 queue_timeout=SMART_SEARCH_QUEUE_TIMEOUT, failure_threshold=SMART_SEARCH_BREAKER_FAILURES,
+                 reset_seconds=SMART_SEARCH_BREAKER_RESET_SECONDS):
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> (httpx.AsyncClient, asyncio.Semaphore)
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._stats = {"calls": 0, "failures": 0, "short_circuited": 0, "queue_timeouts": 0, "in_flight": 0}
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        entry = self._clients.get(loop)
+        if entry is None:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+            entry = self._clients[loop] = (client, asyncio.Semaphore(self.max_concurrency))
+        return entry
+
+    def _allow(self):
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.reset_seconds:
+                    return False
+                self._state = "half_open"
+            if self._state == "half_open":
+                # 半開狀態只放行一個試探請求
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def _release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _record(self, ok):
+        with self._lock:
+            self._trial_in_flight = False
+            if ok:
+                self._state = "closed"
+                self._consecutive_failures = 0
+                return
+            self._stats["failures"] += 1
+            self._consecutive_failures += 1
+            if self._state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self._state != "open":
+                    logger.warning("LLM circuit breaker opened after %s failures", self._consecutive_failures)
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    @staticmethod
+    def _parse(content):
+        content = content.strip()
+        # Strip markdown fences if present
+        if content.startswith("```"):
+            content = content.split("\n", 1)[1] if "\n" in content else content[3:]
+            if content.endswith("```"):
+                content = content[:-3]
+            content = content.strip()
+        recommendations = json.loads(content)
+        if not isinstance(recommendations, list):
+            raise ValueError("LLM reply is not a JSON array")
+        return recommendations
+
+    async def recommend(self, prompt):
+        """Return the parsed recommendation list; raises LLMUnavailable instead of waiting on a sick upstream."""
+        if not self._allow():
+            self._stats["short_circuited"] += 1
+            raise LLMUnavailable("circuit open")
+        client, semaphore = self._client()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            # 排隊逾時代表本機已飽和，不算 upstream 失敗
+            self._release_trial()
+            self._stats["queue_timeouts"] += 1
+            raise LLMUnavailable("too many concurrent LLM calls")
+        except BaseException:
+            # 請求被取消（用戶斷線）：歸還半開試探名額，否則斷路器會永遠拒絕後續呼叫
+            self._release_trial()
+            raise
+        self._stats["calls"] += 1
+        self._stats["in_flight"] += 1
+        try:
+            resp = await client.post(
+                self.url or OPENROUTER_API_URL,
+                headers={
+                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "model": "deepseek/deepseek-chat",
+                    "messages": [{"role": "user", "content": prompt}],
+                    "temperature": 0.3,
+                    "max_tokens": 512,
+                },
+            )
+            resp.raise_for_status()
+            recommendations = self._parse(resp.json()["choices"][0]["message"]["content"])
+        except Exception as e:
+            self._record(False)
+            raise LLMUnavailable(str(e) or type(e).__name__) from e
+        except BaseException:
+            # CancelledError 不是 Exception；取消不代表 upstream 失敗，只歸還試探名額
+            self._release_trial()
+            raise
+        finally:
+            semaphore.release()
+            self._stats["in_flight"] -= 1
+        self._record(True)
+        return recommendations
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        entry = self._clients.pop(loop, None)
+        if entry is not None:
+            await entry[0].aclose()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, state=self._state, consecutive_failures=self._consecutive_failures)
+
+
+llm_gateway = LLMGateway()
+
+
+class RateLimiter:
+    """Per-key token bucket: rate_per_minute refill, up to burst tokens."""
+
+    def __init__(self, rate_per_minute=SMART_SEARCH_RATE_PER_MINUTE, burst=SMART_SEARCH_RATE_BURST, max_keys=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def acquire(self, key):
+        """Take one token; returns 0 on success or the seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                if len(self._buckets) > self.max_keys:
+                    self._prune(now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            self.rejected += 1
+            return (1 - tokens) / self.rate if self.rate > 0 else 60
+
+    def _prune(self, now):
+        # 已回滿的 bucket 與不存在等價，可以丟掉
+        full = [k for k, (tokens, updated_at) in self._buckets.items()
+                if tokens + (now - updated_at) * self.rate >= self.burst]
+        for k in full:
+            del self._buckets[k]
+
+    def stats(self):
+        with self._lock:
+            return {"tracked_users": len(self._buckets), "rejected": self.rejected}
+
+
+smart_search_limiter = RateLimiter()
+
+
+def _ai_search_prepare(query: str, cursor) -> dict:
+    """DB half before the LLM call: cached results, or the prompt plus what finishing needs."""
+    generation = profile_generation(cursor)
+    cached = smart_search_cache.get(query, generation, cursor)
+    if cached is not None:
+        return {"results": _hydrate_recommendations(cached, cursor)}
+
+    members, ranked_generation = _smart_search_candidates(query, cursor)
+    if not members:
+        return {"results": []}
+    return {
+        "prompt": _build_ai_prompt(query, members),
+        "member_ids": {m["id"] for m in members},
+        "generation": generation,
+        # 候選名單若來自尚未重建的排序索引，結果可能漏掉剛更新的會員，不寫入快取
+        "cacheable": ranked_generation is None or ranked_generation == generation,
+    }
+
+
+def _ai_search_finish(query: str, plan: dict, recommendations, cursor) -> list:
+    """Keep recommendations that point at candidates, cache them and load profiles."""
+    picked = [
+        {"id": rec.get("id"), "reason": rec.get("reason", "")}
+        for rec in recommendations[:5]
+        if isinstance(rec, dict) and rec.get("id") in plan["member_ids"]
+    ]
+    if plan["cacheable"]:
+        smart_search_cache.put(query, plan["generation"], picked)
+    return _hydrate_recommendations(picked, cursor)
+
+
+def _with_db(fn, *args):
+    db = get_db()
+    try:
+        return fn(*args, db.cursor())
+    finally:
+        db.close()
+
+
+def _smart_search_local(query: str, page: int, page_size: int) -> tuple:
+    """Directory search plus, when the query needs AI matching, the AI search plan."""
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        direct_results, has_more = _direct_search(query, cursor, page, page_size)
+        # AI 推薦只針對第一頁；翻頁一律是目錄搜尋
+        if (direct_results and not _looks_like_need(query)) or page > 1:
+            return direct_results, has_more, None
+        return direct_results, has_more, _ai_search_prepare(query, cursor)
+    finally:
+        db.close()
+
+
+async def _ai_search(query: str, plan: dict, user_id: int) -> Optional[list]:
+    """Use DeepSeek via OpenRouter to match user needs against pre-ranked member profiles.
+
+    Returns None when the LLM is unavailable so callers can fall back to direct results.
+    """
+    if "results" in plan:
+        return plan["results"]
+    retry_after = smart_search_limiter.acquire(user_id)
+    if retry_after:
+        raise HTTPException(
+            status_code=429, detail="搜尋太頻繁，請稍後再試。",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+    try:
+        recommendations = await llm_gateway.recommend(plan["prompt"])
+    except LLMUnavailable as e:
+        logger.warning("AI search failed: %s", e)
+        return None
+    return await run_in_threadpool(_with_db, _ai_search_finish, query, plan, recommendations)
+
+
+@app.post("/api/smart-search", response_model=SmartSearchResponse)
+async def api_smart_search(payload: SmartSearchRequest, current_user: User = Depends(get_current_user)):
+    query = payload.query.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="搜尋內容不能為空")
+
+    page = max(payload.page, 1)
+    page_size = min(max(payload.page_size, 1), SMART_SEARCH_MAX_PAGE_SIZE)
+
+    direct_results, has_more, plan = await run_in_threadpool(_smart_search_local, query, page, page_size)
+    if plan is None:
+        return SmartSearchResponse(results=direct_results, is_ai=False, page=page, has_more=has_more)
+
+    ai_results = await _ai_search(query, plan, current_user.id)
 
     if ai_results:
         return SmartSearchResponse(results=ai_results, is_ai=True)
 
     if direct_results:
-        return SmartSearchResponse(results=direct_results, is_ai=False)
+        return SmartSearchResponse(results=direct_results, is_ai=False, page=page, has_more=has_more)
 
     return SmartSearchResponse(results=[], is_ai=False)
 
 
 # --- Payments API ---
-@app.get("/api/payments")
-def list_payments(user_id: Optional[int] = None, community_id: Optional[int] = None):
-    db = get_db()
-    cursor = db.cursor()
-    query = """
-        SELECT p.*, u.username, u.profile_picture 
-        FROM payments p
-        LEFT JOIN users u ON p.user_id = u.id
-        WHERE 1=1
-    """
-    params = []
+PAYMENT_PAGE_DEFAULT = 50
+PAYMENT_PAGE_MAX = 200
+# fields 參數可選的欄位；id、created_at 為分頁游標所需，一律回傳
+PAYMENT_FIELDS = {
+    "id": "p.id", "user_id": "p.user_id", "community_id": "p.community_id",
+    "description": "p.description", "amount": "p.amount", "method": "p.method",
+    "status": "p.status", "related_type": "p.related_type", "related_id": "p.related_id",
+    "created_at": "p.created_at", "due_date": "p.due_date", "paid_at": "p.paid_at", "note": "p.note",
+    "username": "u.username", "profile_picture": "u.profile_picture",
+}
+
+
+def _payment_filters(user_id=None, community_id=None, status=None, method=None, related_type=None,
+                     start=None, end=None, q=None, overdue=None):
+    """WHERE clause (over payments p / users u) and params for the payments list filters."""
+    clauses, params = [], []
     if user_id is not None:
-        query += " AND p.user_id = ?"
+        clauses.append("p.user_id = ?")
         params.append(user_id)
     if community_id is not None:
-        query += " AND p.community_id = ?"
+        clauses.append("p.community_id = ?")
         params.append(community_id)
-    query += " ORDER BY p.created_at DESC"
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    db.close()
-    return [dict(row) for row in rows]
+    if status:
+        clauses.append("p.status = ?")
+        params.append(status)
+    if overdue is not None:
+        now = datetime.utcnow()
+        if overdue:
+            clauses.append("p.status = 'pending' AND p.due_date IS NOT NULL AND p.due_date < ?")
+        else:
+            clauses.append("NOT (p.status = 'pending' AND p.due_date IS NOT NULL AND p.due_date < ?)")
+        params.append(now)
+    if method:
+        clauses.append("p.method = ?")
+        params.append(method)
+    if related_type == "other":
+        clauses.append("(p.related_type IS NULL OR p.related_type NOT IN ('membership', 'event'))")
+    elif related_type:
+        clauses.append("p.related_type = ?")
+        params.append(related_type)
+    if start:
+        clauses.append("p.created_at >= ?")
+        params.append(timestamp_param(start, "start"))
+    if end:
+        # 只給日期時包含當天整天
+        clauses.append("p.created_at <= ?")
+        params.append(timestamp_param(end, "end", end_of_day=True))
+    if q and q.strip():
+        like = f"%{q.strip()}%"
+        clauses.append("(u.username LIKE ? OR p.description LIKE ?)")
+        params.extend([like, like])
+    return " AND ".join(clauses) or "1=1", params
 
 
-@app.post("/api/payments")
-def create_payment(payload: PaymentCreate):
+def _encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at, row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(token):
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(created_at, str):
+            raise ValueError("cursor sort key must be a string")
+        return created_at, int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="無效的分頁游標")
+
+
+@app.get("/api/payments")
+def list_payments(
+    user_id: Optional[int] = None,
+    community_id: Optional[int] = None,
+    status: Optional[str] = None,
+    method: Optional[str] = None,
+    related_type: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    q: Optional[str] = None,
+    overdue: Optional[bool] = None,
+    limit: Optional[int] = None,
+    after: Optional[str] = Query(None, alias="cursor"),
+    fields: Optional[str] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user),
+):
+    """List payments, newest first; members may only list their own (user_id = themselves).
+
+    Staff listing without community_id see the communities they manage.
+    Without limit / cursor the full list is returned as before. With them the response is
+    {"items", "next_cursor"[, "total"]}, paginated by keyset on (created_at, id).
+    """
+    managed = None
+    if user_id != current_user.id:
+        if community_id is None:
+            managed = role_communities(current_user.id)
+            if not managed:
+                raise HTTPException(status_code=403, detail="權限不足")
+        elif not has_role(current_user.id, STAFF_ROLES, community_id):
+            raise HTTPException(status_code=403, detail="權限不足")
+    if fields:
+        requested = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in requested if f not in PAYMENT_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知的欄位: {', '.join(unknown)}")
+        columns = ["id", "created_at"] + [f for f in requested if f not in ("id", "created_at")]
+    else:
+        columns = list(PAYMENT_FIELDS)
+    select = ", ".join(f"{PAYMENT_FIELDS[c]} AS {c}" for c in columns)
+    # 只有需要會員欄位或文字搜尋時才 JOIN users
+    join = "LEFT JOIN users u ON p.user_id = u.id" if q or any(PAYMENT_FIELDS[c].startswith("u.") for c in columns) else ""
+    where, params = _payment_filters(user_id, community_id, status, method, related_type, start, end, q, overdue)
+    if managed:
+        where += f" AND p.community_id IN ({', '.join('?' * len(managed))})"
+        params.extend(managed)
+    keyset = _decode_cursor(after) if after else None
+
     db = get_db()
     cursor = db.cursor()
+    if limit is None and after is None:
+        cursor.execute(f"SELECT {select} FROM payments p {join} WHERE {where} ORDER BY p.created_at DESC, p.id DESC", params)
+        rows = cursor.fetchall()
+        db.close()
+        return [dict(row) for row in rows]
+
+    page_size = min(max(limit or PAYMENT_PAGE_DEFAULT, 1), PAYMENT_PAGE_MAX)
+    page_where, page_params = where, list(params)
+    if keyset:
+        page_where += " AND (p.created_at, p.id) < (?, ?)"
+        page_params.extend(keyset)
     cursor.execute(
-        "INSERT INTO payments (user_id, community_id, description, amount, method, status, related_type, related_id, due_date, note) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        (
-            payload.user_id,
-            payload.community_id,
-            payload.description,
-            payload.amount,
-            payload.method,
-            payload.status,
-            payload.related_type,
-            payload.related_id,
-            payload.due_date,
-            payload.note,
-        ),
+        f"SELECT {select} FROM payments p {join} WHERE {page_where} "
+        "ORDER BY p.created_at DESC, p.id DESC LIMIT ?",
+        page_params + [page_size + 1],
     )
-    db.commit()
-    cursor.execute("SELECT * FROM payments WHERE id = ?", (cursor.lastrowid,))
-    row = cursor.fetchone()
+    rows = [dict(row) for row in cursor.fetchall()]
+    result = {"items": rows[:page_size], "next_cursor": None}
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        result["next_cursor"] = _encode_cursor(last["created_at"], last["id"])
+    if include_total:
+        cursor.execute(f"SELECT COUNT(*) FROM payments p {join} WHERE {where}", params)
+        result["total"] = cursor.fetchone()[0]
     db.close()
-    return dict(row)
+    return result
 
 
-@app.patch("/api/payments/{payment_id}")
-def update_payment(payment_id: int, payload: PaymentUpdate):
+# idx_payments_pending_membership 違反時 SQLite 的訊息（partial unique index 以欄位名稱回報）
+PENDING_MEMBERSHIP_CONFLICT = "UNIQUE constraint failed: payments.related_id"
+
+
+def _payment_integrity_error(exc):
+    """Message for an IntegrityError on payments: the duplicate pending bill, or the constraint that failed."""
+    if PENDING_MEMBERSHIP_CONFLICT in str(exc):
+        return "此會籍已有待繳帳單"
+    return f"繳費記錄無效: {exc}"
+
+
+@app.post("/api/payments")
+def create_payment(payload: PaymentCreate, current_user: User = Depends(get_current_user)):
+    """Create a payment; staff of the community may bill anyone, members only open a pending bill for themselves."""
+    if not has_role(current_user.id, STAFF_ROLES, payload.community_id) and (
+        payload.user_id != current_user.id or (payload.status or "pending") != "pending"
+    ):
+        raise HTTPException(status_code=403, detail="權限不足")
+    normalize_payload_timestamps(payload, "due_date")
+    def _insert(db):
+        cursor = db.cursor()
+        cursor.execute(
+            "INSERT INTO payments (user_id, community_id, description, amount, method, status, related_type, related_id, due_date, note) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                payload.user_id,
+                payload.community_id,
+                payload.description,
+                payload.amount,
+                payload.method,
+                payload.status,
+                payload.related_type,
+                payload.related_id,
+                payload.due_date,
+                payload.note,
+            ),
+        )
+        cursor.execute("SELECT * FROM payments WHERE id = ?", (cursor.lastrowid,))
+        return dict(cursor.fetchone())
+
+    try:
+        return db_writer.run(_insert)
+    except sqlite3.IntegrityError as exc:
+        raise HTTPException(status_code=400, detail=_payment_integrity_error(exc)) from exc
+
+
+def payment_community(request: Request):
+    """require_role community resolver for /api/payments/{payment_id}."""
+    payment_id = community_param("payment_id")(request)
     db = get_db()
-    cursor = db.cursor()
+    try:
+        row = db.execute("SELECT community_id FROM payments WHERE id = ?", (payment_id,)).fetchone()
+    finally:
+        db.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="繳費記錄不存在")
+    return row["community_id"]
+
+
+@app.patch("/api/payments/{payment_id}")
+def update_payment(payment_id: int, payload: PaymentUpdate, current_user: User = Depends(require_role(payment_community))):
+    normalize_payload_timestamps(payload, "due_date")
     updates = []
     params = []
 
@@ -1378,184 +3774,491 @@ def update_payment(payment_id: int, payload: PaymentUpdate):
         raise HTTPException(status_code=400, detail="沒有要更新的欄位")
 
     params.append(payment_id)
-    cursor.execute(f"UPDATE payments SET {', '.join(updates)} WHERE id = ?", params)
-    db.commit()
 
-    cursor.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
-    row = cursor.fetchone()
-    db.close()
+    def _update(db):
+        cursor = db.cursor()
+        cursor.execute(f"UPDATE payments SET {', '.join(updates)} WHERE id = ?", params)
+        cursor.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
 
+    try:
+        row = db_writer.run(_update)
+    except sqlite3.IntegrityError as exc:
+        raise HTTPException(status_code=400, detail=_payment_integrity_error(exc)) from exc
     if not row:
         raise HTTPException(status_code=404, detail="繳費記錄不存在")
 
-    return dict(row)
+    return row
 
 
 @app.delete("/api/payments/{payment_id}")
-def delete_payment(payment_id: int):
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute("SELECT id FROM payments WHERE id = ?", (payment_id,))
-    if not cursor.fetchone():
-        db.close()
+def delete_payment(payment_id: int, current_user: User = Depends(require_role(payment_community))):
+    def _delete(db):
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM payments WHERE id = ?", (payment_id,))
+        return cursor.rowcount
+
+    if not db_writer.run(_delete):
         raise HTTPException(status_code=404, detail="繳費記錄不存在")
-    cursor.execute("DELETE FROM payments WHERE id = ?", (payment_id,))
-    db.commit()
-    db.close()
     return {"message": "已刪除", "id": payment_id}
 
 
+PAYMENT_BULK_MAX = 1000
+PAYMENT_BULK_DELETE = "DELETE FROM payments WHERE id = ?"
+# 與 update_payment 相同：改為已繳費時記錄 paid_at，退回待繳時清除
+PAYMENT_BULK_UPDATE = (
+    "UPDATE payments SET status = COALESCE(?, status), method = COALESCE(?, method), "
+    "paid_at = CASE ? WHEN 'paid' THEN ? WHEN 'pending' THEN NULL ELSE paid_at END WHERE id = ?"
+)
+
+
+@app.post("/api/payments/bulk")
+def bulk_payments(payload: PaymentBulkRequest, current_user: User = Depends(require_role())):
+    """Apply a batch of status / method changes and deletions in one transaction; returns per-item results.
+
+    Items in communities the caller does not manage fail with 權限不足.
+    """
+    items = payload.items
+    if len(items) > PAYMENT_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"一次最多處理 {PAYMENT_BULK_MAX} 筆")
+    results = [{"id": item.id, "action": item.action, "ok": False} for item in items]
+    valid, seen = [], set()
+    for i, item in enumerate(items):
+        if item.action not in ("update", "delete"):
+            results[i]["error"] = "不支援的操作"
+        elif item.action == "update" and item.status is None and item.method is None:
+            results[i]["error"] = "沒有要更新的欄位"
+        elif item.id in seen:
+            results[i]["error"] = "同一筆繳費記錄重複出現"
+        else:
+            seen.add(item.id)
+            valid.append(i)
+    now = datetime.utcnow()
+    managed = set(role_communities(current_user.id))
+
+    def _apply(db):
+        cursor = db.cursor()
+        ids = [items[i].id for i in valid]
+        communities = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f"SELECT id, community_id FROM payments WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            communities.update((row[0], row[1]) for row in cursor.fetchall())
+        deletes, updates = [], []
+        for i in valid:
+            if items[i].id not in communities:
+                results[i]["error"] = "繳費記錄不存在"
+            elif communities[items[i].id] not in managed:
+                results[i]["error"] = "權限不足"
+            else:
+                (deletes if items[i].action == "delete" else updates).append(i)
+        # 先刪除再更新：刪掉的待繳帳單不會與同一會籍的「退回待繳」衝突
+        statements = [(i, PAYMENT_BULK_DELETE, (items[i].id,)) for i in deletes]
+        statements += [
+            (i, PAYMENT_BULK_UPDATE, (items[i].status, items[i].method, items[i].status, now, items[i].id))
+            for i in updates
+        ]
+        cursor.execute("SAVEPOINT payments_bulk")
+        try:
+            cursor.executemany(PAYMENT_BULK_DELETE, [params for _, _, params in statements[:len(deletes)]])
+            cursor.executemany(PAYMENT_BULK_UPDATE, [params for _, _, params in statements[len(deletes):]])
+        except sqlite3.IntegrityError:
+            # 有項目違反限制（通常是待繳帳單唯一限制）：整批退回後逐筆執行，找出失敗的項目
+            cursor.execute("ROLLBACK TO payments_bulk")
+            for i, sql, params in statements:
+                try:
+                    cursor.execute(sql, params)
+                except sqlite3.IntegrityError as exc:
+                    results[i]["error"] = _payment_integrity_error(exc)
+                else:
+                    results[i]["ok"] = True
+        else:
+            for i, _, _ in statements:
+                results[i]["ok"] = True
+        cursor.execute("RELEASE payments_bulk")
+
+    if valid:
+        db_writer.run(_apply)
+    done = [r for r in results if r["ok"]]
+    return {
+        "results": results,
+        "updated": sum(1 for r in done if r["action"] == "update"),
+        "deleted": sum(1 for r in done if r["action"] == "delete"),
+        "failed": len(results) - len(done),
+    }
+
+
+PAYMENT_EXPORT_BATCH = 500  # 每次從 cursor 取出並輸出的列數
+PAYMENT_EXPORT_HEADER = ["編號", "會員", "描述", "金額", "支付方式", "狀態", "分類", "繳費期限", "付款時間", "建立時間", "備註"]
+PAYMENT_STATUS_LABELS = {"pending": "待繳費", "paid": "已繳費"}
+PAYMENT_TYPE_LABELS = {"membership": "會費", "event": "活動費"}
+
+
+def _iter_payments_csv(query, params):
+    """Yield UTF-8 CSV chunks (BOM + header first), PAYMENT_EXPORT_BATCH rows at a time."""
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        cursor.execute(query, params)
+        buffer = io.StringIO()
+        buffer.write('\ufeff')
+        writer = csv.writer(buffer)
+        writer.writerow(PAYMENT_EXPORT_HEADER)
+        while True:
+            rows = cursor.fetchmany(PAYMENT_EXPORT_BATCH)
+            for r in rows:
+                writer.writerow([
+                    r["id"], r["username"] or "", r["description"],
+                    r["amount"], r["method"] or "",
+                    PAYMENT_STATUS_LABELS.get(r["status"], r["status"]),
+                    PAYMENT_TYPE_LABELS.get(r["related_type"], r["related_type"] or "其他"),
+                    r["due_date"] or "", r["paid_at"] or "", r["created_at"] or "",
+                    r["note"] or "",
+                ])
+            if buffer.tell():
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+            if not rows:
+                break
+    finally:
+        db.close()
+
+
+def _gzip_stream(chunks):
+    """Compress a byte-chunk iterator into a single gzip member without buffering it."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31：gzip 標頭
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+
 @app.get("/api/payments/export/csv")
 def export_payments_csv(
-    community_id: Optional[int] = None,
+    community_id: int,
     status: Optional[str] = None,
     start: Optional[str] = None,
     end: Optional[str] = None,
+    method: Optional[str] = None,
+    related_type: Optional[str] = None,
+    q: Optional[str] = None,
+    overdue: Optional[bool] = None,
+    gzip: bool = False,
+    current_user: User = Depends(require_role("community_id")),
 ):
-    db = get_db()
-    cursor = db.cursor()
-    query = """
+    """Stream the filtered payments as CSV; gzip=true downloads a .csv.gz instead."""
+    where, params = _payment_filters(
+        community_id=community_id, status=status, method=method, related_type=related_type,
+        start=start, end=end, q=q, overdue=overdue,
+    )
+    query = f"""
         SELECT p.id, u.username, p.description, p.amount, p.method, p.status,
                p.related_type, p.due_date, p.paid_at, p.created_at, p.note
         FROM payments p
         LEFT JOIN users u ON p.user_id = u.id
-        WHERE 1=1
+        WHERE {where}
+        ORDER BY p.created_at DESC, p.id DESC
     """
-    params = []
-    if community_id is not None:
-        query += " AND p.community_id = ?"
-        params.append(community_id)
-    if status:
-        query += " AND p.status = ?"
-        params.append(status)
-    if start:
-        query += " AND p.created_at >= ?"
-        params.append(start)
-    if end:
-        query += " AND p.created_at <= ?"
-        params.append(end)
-    query += " ORDER BY p.created_at DESC"
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    db.close()
-
-    output = io.StringIO()
-    output.write('\ufeff')
-    writer = csv.writer(output)
-    writer.writerow(["編號", "會員", "描述", "金額", "支付方式", "狀態", "分類", "繳費期限", "付款時間", "建立時間", "備註"])
-    status_map = {"pending": "待繳費", "paid": "已繳費"}
-    type_map = {"membership": "會費", "event": "活動費"}
-    for r in rows:
-        writer.writerow([
-            r["id"], r["username"] or "", r["description"],
-            r["amount"], r["method"] or "",
-            status_map.get(r["status"], r["status"]),
-            type_map.get(r["related_type"], r["related_type"] or "其他"),
-            r["due_date"] or "", r["paid_at"] or "", r["created_at"] or "",
-            r["note"] or "",
-        ])
-
-    output.seek(0)
+    chunks = _iter_payments_csv(query, params)
     filename = f"payments_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv"
+    if gzip:
+        return StreamingResponse(
+            _gzip_stream(chunks),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'},
+        )
     return StreamingResponse(
-        iter([output.getvalue()]),
+        chunks,
         media_type="text/csv; charset=utf-8-sig",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
-# --- Dashboard Stats API ---
-@app.get("/api/stats/dashboard")
-def get_dashboard_stats(community_id: Optional[int] = None):
-    db = get_db()
-    cursor = db.cursor()
-    cond = "WHERE community_id = ?" if community_id else ""
+# --- Aggregate Queries ---
+# 統計數字以條件聚合計算：每個資料表只掃一次，每個數字是一個 SUM(CASE WHEN ... END) 欄位。
+def sum_if(expr, cond="1", params=()):
+    """Bucket: SUM(expr) over rows matching cond."""
+    return (expr, cond, tuple(params))
+
+
+def count_if(cond="1", params=()):
+    """Bucket: number of rows matching cond."""
+    return ("1", cond, tuple(params))
+
+
+def aggregate_query(table, buckets, where="1=1", params=(), group_by=None):
+    """Build (sql, params) computing every bucket in one pass; group_by adds a grp column."""
+    columns, select_params = [], []
+    if group_by:
+        columns.append(f"{group_by} AS grp")
+    for name, (expr, cond, cond_params) in buckets.items():
+        columns.append(f"COALESCE(SUM(CASE WHEN {cond} THEN {expr} ELSE 0 END), 0) AS {name}")
+        select_params.extend(cond_params)
+    sql = f"SELECT {', '.join(columns)} FROM {table} WHERE {where}"
+    if group_by:
+        sql += " GROUP BY grp ORDER BY grp"
+    return sql, select_params + list(params)
+
+
+def aggregate(cursor, table, buckets, where="1=1", params=(), group_by=None):
+    """Run aggregate_query; returns one dict, or a list of dicts (with grp) when grouped."""
+    sql, sql_params = aggregate_query(table, buckets, where, params, group_by)
+    cursor.execute(sql, sql_params)
+    if group_by:
+        return [dict(row) for row in cursor.fetchall()]
+    return dict(cursor.fetchone())
+
+
+MEMBERSHIP_STATUS_BUCKETS = {
+    "total": count_if(),
+    "active": count_if("status = 'active'"),
+    "expired": count_if("status = 'expired'"),
+}
+# payments_report 的分類：related_type 不是會費、活動費的都算其他
+PAYMENT_CATEGORY_BUCKETS = {
+    "total": sum_if("amount"),
+    "membership": sum_if("amount", "related_type = 'membership'"),
+    "event": sum_if("amount", "related_type = 'event'"),
+    "other": sum_if("amount", "related_type IS NULL OR related_type NOT IN ('membership', 'event')"),
+}
+
+
+def _payment_stats_buckets(start_of_month, now):
+    return {
+        # 本月應收：本月建立的所有帳單
+        "receivableThisMonth": sum_if("amount", "created_at >= ?", (start_of_month,)),
+        # 本月已收款
+        "paidThisMonth": sum_if("amount", "status = 'paid' AND paid_at >= ?", (start_of_month,)),
+        # 待收款
+        "totalPending": sum_if("amount", "status = 'pending'"),
+        # 逾期未繳：待繳且 due_date 已過（due_date 需為 ISO 8601 字串）
+        "totalOverdue": sum_if("amount", "status = 'pending' AND due_date < ?", (now,)),
+    }
+
+
+def _dashboard_stats(cursor, community_id=None):
+    cond = "community_id = ?" if community_id else "1=1"
     params = [community_id] if community_id else []
+    members = aggregate(cursor, "memberships", MEMBERSHIP_STATUS_BUCKETS, cond, params)
+    # 已收總額由 payment_rollups 讀取，成本與月份數成正比
+    payments = aggregate(cursor, "payment_rollups", {"revenue": sum_if("amount", "status = 'paid'")}, cond, params)
+    events = aggregate(cursor, "events", {"total": count_if()}, cond, params)
+    return {
+        "totalMembers": members["total"],
+        "activeMembers": members["active"],
+        "pendingMembers": members["total"] - members["active"] - members["expired"],
+        "expiredMembers": members["expired"],
+        "totalRevenue": payments["revenue"],
+        "totalEvents": events["total"],
+    }
 
-    cursor.execute(f"SELECT COUNT(*) as cnt FROM memberships {cond}", params)
-    total_members = cursor.fetchone()["cnt"]
 
-    # Calculate conditions for active and expired members
-    active_cond = cond.replace('WHERE', "WHERE status = 'active' AND") if cond else "WHERE status = 'active'"
-    cursor.execute(f"SELECT COUNT(*) as cnt FROM memberships {active_cond}", params)
-    active_members = cursor.fetchone()["cnt"]
+def _payment_stats(cursor, community_id):
+    today = datetime.utcnow()
+    start_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return aggregate(cursor, "payments", _payment_stats_buckets(start_of_month, today), "community_id = ?", [community_id])
+
+
+HOT_QUERIES += [
+    ("get_dashboard_stats memberships", *aggregate_query("memberships", MEMBERSHIP_STATUS_BUCKETS, "community_id = ?", [1])),
+    ("get_payment_stats", *aggregate_query(
+        "payments", _payment_stats_buckets("2025-01-01", "2025-01-15"), "community_id = ?", [1])),
+    ("payments_report rollups", *aggregate_query(
+        "payment_rollups", PAYMENT_CATEGORY_BUCKETS, "community_id = ?", [1], group_by="month")),
+    ("payments_report months x categories", *aggregate_query(
+        "payments", PAYMENT_CATEGORY_BUCKETS, "community_id = ? AND created_at >= ? AND created_at <= ?",
+        [1, "2025-01-01", "2025-12-31"], group_by="strftime('%Y-%m', created_at)")),
+]
+
+
+# --- Member Directory API ---
+MEMBER_PAGE_DEFAULT = 30
+MEMBER_PAGE_MAX = 100
+# 會員 = users LEFT JOIN 該社群的 memberships（每人最多一筆）；沒有會籍的使用者視為待審核的圈友
+MEMBER_FROM = "users u LEFT JOIN memberships m ON m.user_id = u.id AND m.community_id = ?"
+MEMBER_STATUS_SQL = "COALESCE(m.status, 'pending')"
+# 前端的會員級別由 memberships.role 推得
+MEMBER_LEVEL_SQL = (
+    "CASE m.role WHEN 'admin' THEN 'admin' WHEN 'staff' THEN 'committee' "
+    "WHEN 'member' THEN 'citizen' ELSE 'friend' END"
+)
+MEMBER_COLUMNS = (
+    "u.id, u.username, u.email, u.phone, u.profile_picture, u.bio, u.skills, u.occupation, u.created_at, "
+    "m.id AS membership_id, m.membership_no, m.role, m.joined_at, m.expires_at, "
+    f"{MEMBER_STATUS_SQL} AS status, {MEMBER_LEVEL_SQL} AS level"
+)
+# sort 參數 -> (排序鍵, 方向)；兩者都有索引，分頁不需要排序整張表
+MEMBER_SORTS = {
+    "newest": ("u.created_at", "DESC"),
+    "name": ("u.username", "ASC"),
+}
+MEMBER_STATUS_BUCKETS = {
+    "total": count_if(),
+    "active": count_if(f"{MEMBER_STATUS_SQL} = 'active'"),
+    "pending": count_if(f"{MEMBER_STATUS_SQL} = 'pending'"),
+    "expired": count_if(f"{MEMBER_STATUS_SQL} = 'expired'"),
+}
+
+
+def _csv_values(value):
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+
+def _member_filters(status=None, level=None, q=None, user_id=None):
+    """WHERE clause (over users u / memberships m) and params for the member directory filters."""
+    clauses, params = [], []
+    statuses = _csv_values(status)
+    if statuses:
+        clauses.append(f"{MEMBER_STATUS_SQL} IN ({', '.join('?' * len(statuses))})")
+        params.extend(statuses)
+    levels = _csv_values(level)
+    if levels:
+        clauses.append(f"{MEMBER_LEVEL_SQL} IN ({', '.join('?' * len(levels))})")
+        params.extend(levels)
+    if q and q.strip():
+        term = q.strip()
+        like = f"%{term}%"
+        match = "u.username LIKE ? OR u.phone LIKE ? OR m.membership_no LIKE ?"
+        params.extend([like, like, like])
+        if term.isdigit():
+            match += " OR u.id = ?"
+            params.append(int(term))
+        clauses.append(f"({match})")
+    if user_id is not None:
+        clauses.append("u.id = ?")
+        params.append(user_id)
+    return " AND ".join(clauses) or "1=1", params
 
-    expired_cond = cond.replace('WHERE', "WHERE status = 'expired' AND") if cond else "WHERE status = 'expired'"
-    cursor.execute(f"SELECT COUNT(*) as cnt FROM memberships {expired_cond}", params)
-    expired_members = cursor.fetchone()["cnt"]
 
-    pending_members = total_members - active_members - expired_members
+def _member_summary(cursor, community_id):
+    return aggregate(cursor, MEMBER_FROM, MEMBER_STATUS_BUCKETS, "1=1", [community_id])
 
-    cursor.execute(f"SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE status = 'paid'" + (" AND community_id = ?" if community_id else ""), params)
-    total_revenue = cursor.fetchone()["total"]
 
-    cursor.execute(f"SELECT COUNT(*) as cnt FROM events {cond}", params)
-    total_events = cursor.fetchone()["cnt"]
+@app.get("/api/members")
+def list_members(
+    community_id: int = 1,
+    status: Optional[str] = None,
+    level: Optional[str] = None,
+    q: Optional[str] = None,
+    user_id: Optional[int] = None,
+    sort: str = "newest",
+    limit: int = Query(MEMBER_PAGE_DEFAULT, ge=1, le=MEMBER_PAGE_MAX),
+    cursor: Optional[str] = None,
+    include_summary: bool = False,
+    current_user: User = Depends(require_role(community_param("community_id", 1))),
+):
+    """Member directory page: users joined with their membership, filtered and keyset-paginated in SQL.
 
-    db.close()
-    return {
-        "totalMembers": total_members,
-        "activeMembers": active_members,
-        "pendingMembers": pending_members,
-        "expiredMembers": expired_members,
-        "totalRevenue": total_revenue,
-        "totalEvents": total_events,
-    }
+    status / level accept comma-separated values; pass next_cursor back as cursor for the next page.
+    """
+    if sort not in MEMBER_SORTS:
+        raise HTTPException(status_code=400, detail="不支援的排序方式")
+    key, direction = MEMBER_SORTS[sort]
+    where, params = _member_filters(status, level, q, user_id)
+    if cursor:
+        after_key, after_id = _decode_cursor(cursor)
+        op = "<" if direction == "DESC" else ">"
+        where += f" AND ({key}, u.id) {op} (?, ?)"
+        params.extend([after_key, after_id])
 
+    db = get_db()
+    try:
+        cur = db.cursor()
+        cur.execute(
+            f"SELECT {MEMBER_COLUMNS}, {key} AS sort_key FROM {MEMBER_FROM} WHERE {where} "
+            f"ORDER BY {key} {direction}, u.id {direction} LIMIT ?",
+            [community_id, *params, limit + 1],
+        )
+        rows = [dict(r) for r in cur.fetchall()]
+        summary = _member_summary(cur, community_id) if include_summary else None
+    finally:
+        db.close()
 
-@app.get("/api/stats/payments")
-def get_payment_stats(community_id: Optional[int] = 1):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]["sort_key"], rows[-1]["id"])
+    for row in rows:
+        del row["sort_key"]
+    result = {"items": rows, "next_cursor": next_cursor}
+    if summary is not None:
+        result["summary"] = summary
+    return result
+
+
+@app.get("/api/members/summary")
+def members_summary(
+    community_id: int = 1, current_user: User = Depends(require_role(community_param("community_id", 1)))
+):
+    """Member counts by status ({total, active, pending, expired}) in one pass."""
     db = get_db()
-    cursor = db.cursor()
-    
-    today = datetime.utcnow()
-    start_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    
-    base_query = "FROM payments WHERE community_id = ?"
+    try:
+        return _member_summary(db.cursor(), community_id)
+    finally:
+        db.close()
 
-    # 本月應收 (Total Receivable this month): All payments created this month
-    cursor.execute(f"SELECT COALESCE(SUM(amount), 0) as total {base_query} AND created_at >= ?", (community_id, start_of_month))
-    receivable_this_month = cursor.fetchone()["total"]
 
-    # 本月已收款 (Total Paid this month): Payments paid this month
-    cursor.execute(f"SELECT COALESCE(SUM(amount), 0) as total {base_query} AND status = 'paid' AND paid_at >= ?", (community_id, start_of_month))
-    paid_this_month = cursor.fetchone()["total"]
+HOT_QUERIES += [
+    ("list_members newest next page",
+     f"SELECT {MEMBER_COLUMNS} FROM {MEMBER_FROM} WHERE (u.created_at, u.id) < (?, ?) "
+     "ORDER BY u.created_at DESC, u.id DESC LIMIT ?",
+     (1, "2025-01-01 00:00:00", 5, 31)),
+    ("list_members by name next page",
+     f"SELECT {MEMBER_COLUMNS} FROM {MEMBER_FROM} WHERE (u.username, u.id) > (?, ?) "
+     "ORDER BY u.username ASC, u.id ASC LIMIT ?",
+     (1, "m", 5, 31)),
+]
 
-    # 待收款 (Total Pending): All payments with pending status
-    cursor.execute(f"SELECT COALESCE(SUM(amount), 0) as total {base_query} AND status = 'pending'", (community_id,))
-    total_pending = cursor.fetchone()["total"]
-    
-    # 逾期未繳 (Total Overdue): Pending payments where due_date is in the past
-    # Note: Ensure due_date is stored in a compatible format (ISO 8601 string recommended)
-    cursor.execute(f"SELECT COALESCE(SUM(amount), 0) as total {base_query} AND status = 'pending' AND due_date < ?", (community_id, today))
-    total_overdue = cursor.fetchone()["total"]
 
+# --- Dashboard Stats API ---
+@app.get("/api/stats/dashboard")
+def get_dashboard_stats(community_id: int, current_user: User = Depends(require_role("community_id"))):
+    db = get_db()
+    stats = _dashboard_stats(db.cursor(), community_id)
     db.close()
-    
-    return {
-        "receivableThisMonth": receivable_this_month,
-        "paidThisMonth": paid_this_month,
-        "totalPending": total_pending,
-        "totalOverdue": total_overdue,
-    }
+    return stats
+
+
+@app.get("/api/stats/payments")
+def get_payment_stats(
+    community_id: Optional[int] = 1, current_user: User = Depends(require_role(community_param("community_id", 1)))
+):
+    db = get_db()
+    stats = _payment_stats(db.cursor(), community_id)
+    db.close()
+    return stats
 
 
 # --- Reports API ---
 @app.get("/api/reports/payments")
 def payments_report(
-    community_id: Optional[int] = None,
+    community_id: int,
     start: Optional[str] = None,
     end: Optional[str] = None,
+    current_user: User = Depends(require_role("community_id")),
 ):
     """Return simple payment report data.
     - monthlyTotals: [{month: '2025-01', total: 1234}, ...]
     - categoryTotals: {membership: x, event: y, other: z}
     - details: list of payments within range (if start/end specified)
     """
+    start = timestamp_param(start, "start")
+    end = timestamp_param(end, "end", end_of_day=True)
     db = get_db()
-    cursor = db.cursor()
+    report = _payments_report(db.cursor(), community_id, start, end)
+    db.close()
+    return report
+
+
+def _payments_report(cursor, community_id=None, start=None, end=None):
     params = []
-    cond = "WHERE 1=1"
+    cond = "1=1"
     if community_id is not None:
         cond += " AND community_id = ?"
         params.append(community_id)
@@ -1566,31 +4269,25 @@ def payments_report(
         cond += " AND created_at <= ?"
         params.append(end)
 
-    # monthly totals for year surrounding start/end or last 12 months if none
-    # For sqlite we can use strftime to group by YYYY-MM
-    monthly_query = f"SELECT strftime('%Y-%m', created_at) as month, COALESCE(SUM(amount),0) as total FROM payments {cond} GROUP BY month ORDER BY month"
-    cursor.execute(monthly_query, params)
-    monthly_totals = [dict(row) for row in cursor.fetchall()]
-
-    # category totals by related_type
-    cat_query = f"SELECT COALESCE(SUM(amount),0) as total, COALESCE(related_type,'other') as type FROM payments {cond} GROUP BY type"
-    cursor.execute(cat_query, params)
-    cat_rows = cursor.fetchall()
-    category_totals: Dict[str, float] = {'membership':0,'event':0,'other':0}
-    for r in cat_rows:
-        t = r['type'] or 'other'
-        if t not in category_totals:
-            t = 'other'
-        category_totals[t] = r['total']
+    if start or end:
+        # 指定日期區間時月份可能不完整，直接掃描區間內的 payments（明細本來就要讀取）
+        months = aggregate(cursor, "payments", PAYMENT_CATEGORY_BUCKETS, cond, params,
+                           group_by="strftime('%Y-%m', created_at)")
+    else:
+        # 全期報表：每月同時算出各分類金額，分類總計由各月加總
+        months = aggregate(cursor, "payment_rollups", PAYMENT_CATEGORY_BUCKETS, cond, params, group_by="month")
+    monthly_totals = [{"month": m["grp"] or None, "total": m["total"]} for m in months]
+    category_totals: Dict[str, float] = {
+        t: sum(m[t] for m in months) for t in ("membership", "event", "other")
+    }
 
     details = []
     if start or end:
-        det_cond = cond.replace("WHERE 1=1", "WHERE 1=1").replace("community_id", "p.community_id").replace("created_at", "p.created_at")
-        det_query = f"SELECT p.*, u.username FROM payments p LEFT JOIN users u ON p.user_id = u.id {det_cond} ORDER BY p.created_at DESC"
+        det_cond = cond.replace("community_id", "p.community_id").replace("created_at", "p.created_at")
+        det_query = f"SELECT p.*, u.username FROM payments p LEFT JOIN users u ON p.user_id = u.id WHERE {det_cond} ORDER BY p.created_at DESC"
         cursor.execute(det_query, params)
         details = [dict(r) for r in cursor.fetchall()]
 
-    db.close()
     return {
         "monthlyTotals": monthly_totals,
         "categoryTotals": category_totals,
@@ -1598,53 +4295,77 @@ def payments_report(
     }
 
 
-# utility: generate pending payments for memberships expiring soon
-@app.post("/api/maintenance/generate_due_payments")
-def generate_due_payments(community_id: Optional[int] = None):
-    """Create pending payment records for memberships that will expire within 30 days and have no existing pending payment."""
-    db = get_db()
-    cursor = db.cursor()
-    cutoff = datetime.utcnow() + timedelta(days=30)
-    params = []
-    cond = "WHERE expires_at IS NOT NULL AND status = 'active'"
+# --- Billing ---
+DUE_PAYMENT_LEAD_DAYS = 30  # 會籍到期前幾天產生續費帳單
+DUE_PAYMENT_DESCRIPTION = "會籍續費"
+
+
+def _due_memberships_sql(community_id=None, now=None):
+    """FROM/WHERE selecting active memberships expiring within the lead time and without a pending payment."""
+    cutoff = (now or datetime.utcnow()) + timedelta(days=DUE_PAYMENT_LEAD_DAYS)
+    sql = (
+        "FROM memberships m "
+        "WHERE m.status = 'active' AND m.expires_at <= ? "
+        "AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.related_type = 'membership' "
+        "AND p.related_id = m.id AND p.status = 'pending')"
+    )
+    params = [cutoff]
     if community_id is not None:
-        cond += " AND community_id = ?"
+        sql += " AND m.community_id = ?"
         params.append(community_id)
+    return sql, params
 
-    cursor.execute(f"SELECT * FROM memberships {cond}", params)
-    memberships = cursor.fetchall()
-    created = 0
-    for m in memberships:
-        expires = m['expires_at']
-        if expires is None:
-            continue
-        exp_dt = datetime.fromisoformat(expires)
-        if exp_dt <= cutoff:
-            # check existing pending payments for this membership
-            cursor.execute(
-                "SELECT 1 FROM payments WHERE related_type='membership' AND related_id=? AND status='pending'",
-                (m['id'],),
-            )
-            if cursor.fetchone():
-                continue
-            # create a placeholder pending payment
-            cursor.execute(
-                "INSERT INTO payments (user_id, community_id, description, amount, status, related_type, related_id, due_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    m['user_id'],
-                    m['community_id'],
-                    "會籍續費",
-                    0.0,
-                    "pending",
-                    "membership",
-                    m['id'],
-                    expires,
-                ),
-            )
-            created += 1
-    db.commit()
-    db.close()
-    return {"created": created}
+
+def bill_due_memberships(db, community_id=None, dry_run=False, now=None):
+    """Create pending renewal payments set-based; returns {"created", "byCommunity", "dryRun"}.
+
+    Runs two statements however many memberships there are: a per-community count and,
+    unless dry_run, one INSERT ... SELECT. The caller owns the transaction.
+    """
+    cursor = db.cursor()
+    source, params = _due_memberships_sql(community_id, now)
+    cursor.execute(f"SELECT m.community_id, COUNT(*) {source} GROUP BY m.community_id ORDER BY m.community_id", params)
+    by_community = {row[0]: row[1] for row in cursor.fetchall()}
+    created = sum(by_community.values())
+    if not dry_run and created:
+        cursor.execute(
+            "INSERT INTO payments (user_id, community_id, description, amount, status, related_type, related_id, due_date) "
+            f"SELECT m.user_id, m.community_id, ?, 0.0, 'pending', 'membership', m.id, m.expires_at {source} "
+            "ON CONFLICT DO NOTHING",
+            [DUE_PAYMENT_DESCRIPTION, *params],
+        )
+        created = cursor.rowcount
+    return {"created": created, "byCommunity": by_community, "dryRun": dry_run}
+
+
+def run_due_billing(community_id=None, dry_run=False):
+    """Billing engine entry point shared by the API and maintenance.py."""
+    if dry_run:
+        db = get_db()
+        try:
+            return bill_due_memberships(db, community_id, dry_run=True)
+        finally:
+            db.close()
+    return db_writer.run(lambda db: bill_due_memberships(db, community_id))
+
+
+@app.post("/api/maintenance/generate_due_payments")
+def generate_due_payments(
+    community_id: int, dry_run: bool = False, current_user: User = Depends(require_role("community_id"))
+):
+    """Create pending payment records for memberships that will expire within 30 days and have no existing pending payment.
+
+    One community per request; `python maintenance.py due` bills every community.
+    """
+    return run_due_billing(community_id, dry_run)
+
+
+HOT_QUERIES += [
+    ("generate_due_payments", f"SELECT m.community_id, COUNT(*) {_due_memberships_sql(1)[0]} GROUP BY m.community_id",
+     _due_memberships_sql(1)[1]),
+    ("generate_due_payments all communities",
+     f"SELECT m.community_id, COUNT(*) {_due_memberships_sql()[0]} GROUP BY m.community_id", _due_memberships_sql()[1]),
+]
 
 # --- Announcements API ---
 @app.get("/api/announcements", response_model=List[Announcement])
@@ -1676,7 +4397,9 @@ def get_announcement(announcement_id: int):
 
 
 @app.post("/api/announcements", response_model=Announcement)
-def create_announcement(payload: AnnouncementCreate, created_by: int):
+def create_announcement(payload: AnnouncementCreate, created_by: int, current_user: User = Depends(get_current_user)):
+    if not has_role(current_user.id, STAFF_ROLES, payload.community_id):
+        raise HTTPException(status_code=403, detail="權限不足")
     db = get_db()
     cursor = db.cursor()
     cursor.execute(
@@ -1693,8 +4416,23 @@ def create_announcement(payload: AnnouncementCreate, created_by: int):
     return Announcement(**dict(row))
 
 
+def announcement_community(request: Request):
+    """require_role community resolver for /api/announcements/{announcement_id}."""
+    announcement_id = community_param("announcement_id")(request)
+    db = get_db()
+    try:
+        row = db.execute("SELECT community_id FROM announcements WHERE id = ?", (announcement_id,)).fetchone()
+    finally:
+        db.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="公告不存在")
+    return row["community_id"]
+
+
 @app.put("/api/announcements/{announcement_id}", response_model=Announcement)
-def update_announcement(announcement_id: int, payload: AnnouncementCreate):
+def update_announcement(
+    announcement_id: int, payload: AnnouncementCreate, current_user: User = Depends(require_role(announcement_community))
+):
     db = get_db()
     cursor = db.cursor()
     cursor.execute(
@@ -1715,7 +4453,7 @@ def update_announcement(announcement_id: int, payload: AnnouncementCreate):
 
 
 @app.delete("/api/announcements/{announcement_id}")
-def delete_announcement(announcement_id: int):
+def delete_announcement(announcement_id: int, current_user: User = Depends(require_role(announcement_community))):
     db = get_db()
     cursor = db.cursor()
     cursor.execute("DELETE FROM announcements WHERE id = ?", (announcement_id,))
@@ -1726,7 +4464,11 @@ def delete_announcement(announcement_id: int):
 
 # --- Events API ---
 @app.get("/api/events", response_model=List[Event])
-def list_events(community_id: Optional[int] = None):
+def list_events(background_tasks: BackgroundTasks, community_id: Optional[int] = None, when: Optional[str] = None):
+    """Events with their attendance counters; when=upcoming (soonest first) or past (latest first) filters by start_at."""
+    if when not in (None, "upcoming", "past"):
+        raise HTTPException(status_code=400, detail="when 只能是 upcoming 或 past")
+    schedule_event_count_reconcile(background_tasks)
     db = get_db()
     cursor = db.cursor()
     query = "SELECT * FROM events WHERE 1=1"
@@ -1734,7 +4476,10 @@ def list_events(community_id: Optional[int] = None):
     if community_id is not None:
         query += " AND community_id = ?"
         params.append(community_id)
-    query += " ORDER BY start_at DESC"
+    if when is not None:
+        query += " AND start_at >= ?" if when == "upcoming" else " AND start_at < ?"
+        params.append(datetime.utcnow().strftime(TIMESTAMP_FORMAT))
+    query += " ORDER BY start_at" if when == "upcoming" else " ORDER BY start_at DESC"
     cursor.execute(query, params)
     rows = cursor.fetchall()
     db.close()
@@ -1755,6 +4500,9 @@ def get_event(event_id: int):
 
 @app.post("/api/events", response_model=Event)
 def create_event(payload: EventCreate, current_user: User = Depends(get_current_user)):
+    if not has_role(current_user.id, STAFF_ROLES, payload.community_id):
+        raise HTTPException(status_code=403, detail="權限不足")
+    normalize_payload_timestamps(payload, "start_at", "end_at", "early_bird_deadline")
     db = get_db()
     cursor = db.cursor()
     cursor.execute(
@@ -1787,154 +4535,782 @@ def create_event(payload: EventCreate, current_user: User = Depends(get_current_
 
 
 @app.put("/api/events/{event_id}", response_model=Event)
-def update_event(event_id: int, payload: EventCreate, current_user: User = Depends(get_current_user)):
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(
-        """
-        UPDATE events
-        SET title = ?, description = ?, start_at = ?, end_at = ?, location = ?, image_url = ?, capacity = ?, is_public = ?, price = ?, early_bird_price = ?, early_bird_deadline = ?
-        WHERE id = ?
-        """,
+def update_event(event_id: int, payload: EventCreate, current_user: User = Depends(require_role(event_community))):
+    normalize_payload_timestamps(payload, "start_at", "end_at", "early_bird_deadline")
 
-        (
-            payload.title,
-            payload.description,
-            payload.start_at,
-            payload.end_at,
-            payload.location,
-            payload.image_url,
-            payload.capacity,
-            True if payload.is_public is None else payload.is_public,
-            payload.price or 0,
-            payload.early_bird_price,
-            payload.early_bird_deadline,
-            event_id,
-        ),
-    )
-
-    db.commit()
-    cursor.execute("SELECT * FROM events WHERE id = ?", (event_id,))
-    row = cursor.fetchone()
-    db.close()
+    def _update(db):
+        cursor = db.cursor()
+        cursor.execute(
+            """
+            UPDATE events
+            SET title = ?, description = ?, start_at = ?, end_at = ?, location = ?, image_url = ?, capacity = ?, is_public = ?, price = ?, early_bird_price = ?, early_bird_deadline = ?
+            WHERE id = ?
+            """,
+            (
+                payload.title,
+                payload.description,
+                payload.start_at,
+                payload.end_at,
+                payload.location,
+                payload.image_url,
+                payload.capacity,
+                True if payload.is_public is None else payload.is_public,
+                payload.price or 0,
+                payload.early_bird_price,
+                payload.early_bird_deadline,
+                event_id,
+            ),
+        )
+        if not cursor.rowcount:
+            return None
+        # 名額增加時在同一個交易中遞補候補名單
+        _promote_waitlist(cursor, event_id)
+        cursor.execute("SELECT * FROM events WHERE id = ?", (event_id,))
+        return dict(cursor.fetchone())
+
+    row = db_writer.run(_update)
     if not row:
         raise HTTPException(status_code=404, detail="活動不存在")
-    return Event(**dict(row))
+    return Event(**row)
 
 
 @app.delete("/api/events/{event_id}")
-def delete_event(event_id: int):
+def delete_event(event_id: int, current_user: User = Depends(require_role(event_community))):
     db = get_db()
     cursor = db.cursor()
     cursor.execute("DELETE FROM events WHERE id = ?", (event_id,))
     db.commit()
     db.close()
+    _event_community_id.cache_clear()  # 刪除後 id 可能被重用
     return {"message": "已刪除"}
 
 
-@app.post("/api/events/{event_id}/register", response_model=EventRegistration)
-def register_event(event_id: int, payload: EventRegistrationCreate):
-    db = get_db()
-    cursor = db.cursor()
-    try:
-        # Check if event has a price
-        cursor.execute("SELECT title, price, community_id, start_at FROM events WHERE id = ?", (event_id,))
-        event_info = cursor.fetchone()
-        if not event_info:
-            db.close()
-            raise HTTPException(status_code=404, detail="活動不存在")
-            
+# --- Event Registration Engine ---
+# 名額以 events.registered_count 計算，用條件式 UPDATE 原子地佔位；額滿時進入候補，
+# 有人取消或名額增加時依報名順序遞補。
+# checked_in_count / cancelled_count 在同一個寫入交易中隨報名狀態變更，活動列表不必逐場 COUNT。
+EVENT_SEATED_STATUSES = ("registered", "checked_in")  # 佔用名額的報名狀態
+EVENT_STATUS_COUNTERS = {"checked_in": "checked_in_count", "cancelled": "cancelled_count"}
+
+
+def _claim_seat(cursor, event_id, force=False):
+    """Take one seat with a conditional UPDATE; False when the event is full. force ignores capacity (on-site check-in)."""
+    condition = "" if force else " AND (COALESCE(capacity, 0) <= 0 OR registered_count < capacity)"
+    cursor.execute(f"UPDATE events SET registered_count = registered_count + 1 WHERE id = ?{condition}", (event_id,))
+    return cursor.rowcount == 1
+
+
+def _release_seat(cursor, event_id):
+    cursor.execute("UPDATE events SET registered_count = MAX(registered_count - 1, 0) WHERE id = ?", (event_id,))
+
+
+def _count_status_changes(cursor, event_id, transitions):
+    """Apply registration status changes [(old_status, new_status)] to the event's status counters; None means no row."""
+    deltas = {}
+    for old_status, new_status in transitions:
+        for status, step in ((old_status, -1), (new_status, 1)):
+            column = EVENT_STATUS_COUNTERS.get(status)
+            if column:
+                deltas[column] = deltas.get(column, 0) + step
+    changes = [(column, delta) for column, delta in deltas.items() if delta]
+    if changes:
+        cursor.execute(
+            f"UPDATE events SET {', '.join(f'{column} = MAX({column} + ?, 0)' for column, _ in changes)} WHERE id = ?",
+            (*[delta for _, delta in changes], event_id),
+        )
+
+
+def _event_price(event):
+    """Early-bird price until its deadline (stored as UTC, like every timestamp), otherwise the regular price."""
+    deadline = event["early_bird_deadline"]
+    if event["early_bird_price"] is not None and deadline and datetime.utcnow().strftime(TIMESTAMP_FORMAT) < deadline:
+        return event["early_bird_price"]
+    return event["price"]
+
+
+def _create_event_payment(cursor, event, user_id, method=None):
+    price = _event_price(event)
+    if price and price > 0:
         cursor.execute(
             """
-            INSERT INTO event_registrations (event_id, user_id, status)
-            VALUES (?, ?, ?)
+            INSERT INTO payments (user_id, community_id, description, amount, method, status, related_type, related_id, due_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (event_id, payload.user_id, payload.status or "registered"),
+            (
+                user_id,
+                event["community_id"],
+                f"活動費: {event['title']}",
+                price,
+                method,  # 未指定時由使用者付款時填寫
+                "pending",
+                "event",
+                event["id"],
+                event["start_at"],  # Set due_date to event start time
+            ),
         )
-        
-        # Create payment if price > 0
-        price = event_info["price"]
-        if price and price > 0:
+
+
+def _registration_event(cursor, event_id):
+    cursor.execute(
+        "SELECT id, title, price, early_bird_price, early_bird_deadline, community_id, start_at FROM events WHERE id = ?",
+        (event_id,),
+    )
+    return cursor.fetchone()
+
+
+def _registration_row(cursor, registration_id):
+    cursor.execute("SELECT * FROM event_registrations WHERE id = ?", (registration_id,))
+    return dict(cursor.fetchone())
+
+
+def _promote_waitlist(cursor, event_id):
+    """Move waitlisted registrations into free seats in sign-up order; returns the promoted user ids."""
+    event = _registration_event(cursor, event_id)
+    promoted = []
+    while event:
+        cursor.execute(
+            "SELECT id, user_id FROM event_registrations WHERE event_id = ? AND status = 'waitlisted' ORDER BY id LIMIT 1",
+            (event_id,),
+        )
+        candidate = cursor.fetchone()
+        if not candidate or not _claim_seat(cursor, event_id):
+            break
+        cursor.execute("UPDATE event_registrations SET status = 'registered' WHERE id = ?", (candidate["id"],))
+        _create_event_payment(cursor, event, candidate["user_id"])
+        promoted.append(candidate["user_id"])
+    if promoted:
+        logger.info("event %s: promoted %d waitlisted registrations", event_id, len(promoted))
+    return promoted
+
+
+def _register(cursor, event_id, user_id, status="registered", method=None):
+    """Register user_id for event_id, or waitlist them when the event is full. Runs inside a writer job."""
+    if status not in EVENT_SEATED_STATUSES:
+        raise HTTPException(status_code=400, detail="無效的報名狀態")
+    event = _registration_event(cursor, event_id)
+    if not event:
+        raise HTTPException(status_code=404, detail="活動不存在")
+    cursor.execute("SELECT id, status FROM event_registrations WHERE event_id = ? AND user_id = ?", (event_id, user_id))
+    existing = cursor.fetchone()
+    if existing and existing["status"] != "cancelled":
+        raise HTTPException(status_code=400, detail="已報名此活動")
+
+    if existing:
+        # 取消後重新報名：以新紀錄（新 id）排到候補名單最後
+        cursor.execute("DELETE FROM event_registrations WHERE id = ?", (existing["id"],))
+    if not _claim_seat(cursor, event_id):
+        status = "waitlisted"
+    cursor.execute(
+        "INSERT INTO event_registrations (event_id, user_id, status) VALUES (?, ?, ?)",
+        (event_id, user_id, status),
+    )
+    _count_status_changes(cursor, event_id, [(existing and existing["status"], status)])
+    registration_id = cursor.lastrowid
+    if status != "waitlisted":
+        _create_event_payment(cursor, event, user_id, method)
+    return _registration_row(cursor, registration_id)
+
+
+def _cancel_registration(cursor, event_id, user_id):
+    """Cancel a registration, drop its unpaid event fee and promote the waitlist. Runs inside a writer job."""
+    cursor.execute("SELECT id, status FROM event_registrations WHERE event_id = ? AND user_id = ?", (event_id, user_id))
+    registration = cursor.fetchone()
+    if not registration:
+        raise HTTPException(status_code=404, detail="找不到報名紀錄")
+    if registration["status"] == "checked_in":
+        raise HTTPException(status_code=400, detail="已簽到，無法取消報名")
+    if registration["status"] != "cancelled":
+        cursor.execute("UPDATE event_registrations SET status = 'cancelled' WHERE id = ?", (registration["id"],))
+        _count_status_changes(cursor, event_id, [(registration["status"], "cancelled")])
+        if registration["status"] in EVENT_SEATED_STATUSES:
+            # 已付款的帳單保留，由管理員處理退款
             cursor.execute(
-                """
-                INSERT INTO payments (user_id, community_id, description, amount, method, status, related_type, related_id, due_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    payload.user_id,
-                    event_info["community_id"],
-                    f"活動費: {event_info['title']}",
-                    price,
-                    None, # Let user fill this when paying
-                    "pending",
-                    "event",
-                    event_id,
-                    event_info["start_at"] # Set due_date to event start time
-                )
+                "DELETE FROM payments WHERE user_id = ? AND related_type = 'event' AND related_id = ? AND status = 'pending'",
+                (user_id, event_id),
             )
-            
-        db.commit()
+            _release_seat(cursor, event_id)
+            _promote_waitlist(cursor, event_id)
+    return _registration_row(cursor, registration["id"])
+
+
+@app.post("/api/events/{event_id}/register", response_model=EventRegistration)
+def register_event(event_id: int, payload: EventRegistrationCreate):
+    """Register for an event; when it is full the registration is waitlisted (status 'waitlisted')."""
+    try:
+        row = db_writer.run(
+            lambda db: _register(db.cursor(), event_id, payload.user_id, payload.status or "registered", payload.method)
+        )
     except sqlite3.IntegrityError as exc:
-        db.rollback()
         raise HTTPException(status_code=400, detail=f"報名失敗: {exc}") from exc
-    cursor.execute("SELECT * FROM event_registrations WHERE id = ?", (cursor.lastrowid,))
-    row = cursor.fetchone()
-    db.close()
-    return EventRegistration(**dict(row))
+    return EventRegistration(**row)
+
+
+@app.post("/api/events/{event_id}/cancel", response_model=EventRegistration)
+def cancel_event_registration(
+    event_id: int, payload: EventRegistrationCancel, current_user: User = Depends(get_current_user)
+):
+    """Cancel the caller's registration (or another member's, for admin / staff); frees the seat for the waitlist."""
+    user_id = payload.user_id or current_user.id
+    if user_id != current_user.id and not has_role(current_user.id, STAFF_ROLES, _event_community_id(event_id)):
+        raise HTTPException(status_code=403, detail="權限不足")
+    row = db_writer.run(lambda db: _cancel_registration(db.cursor(), event_id, user_id))
+    return EventRegistration(**row)
+
+
+HOT_QUERIES += [
+    ("event registration waitlist head",
+     "SELECT id, user_id FROM event_registrations WHERE event_id = ? AND status = 'waitlisted' ORDER BY id LIMIT 1",
+     (1,)),
+]
 
 
 class EventCheckInRequest(BaseModel):
     event_id: int
     membership_no: str
 
+
+class CheckInScan(BaseModel):
+    idempotency_key: str  # 由掃描裝置產生，重送同一筆掃描時回傳第一次的結果
+    membership_no: str
+    scanned_at: Optional[str] = None  # 裝置上的掃描時間，寫入 checked_in_at
+
+
+class CheckInBatchRequest(BaseModel):
+    scans: List[CheckInScan]
+
+
+def _check_in_outcome(registration_status, username):
+    """(status, message, takes_seat) for checking in a member whose registration is registration_status (None: not registered)."""
+    if registration_status == "checked_in":
+        return "already_checked_in", f"{username} 已簽到過", False
+    if registration_status is None:
+        return "checked_in", f"{username} 現場報名並簽到成功", True
+    # 候補或已取消的人到場：現場佔用一個名額（可超過上限）
+    return "checked_in", f"{username} 簽到成功", registration_status not in EVENT_SEATED_STATUSES
+
+
 @app.post("/api/events/checkin")
 def check_in_event(payload: EventCheckInRequest, current_user: User = Depends(get_current_user)):
+    # Check permission (Admin or Staff/Committee of the event's community)
+    if not has_role(current_user.id, STAFF_ROLES, _event_community_id(payload.event_id)):
+        raise HTTPException(status_code=403, detail="權限不足")
+
+    if is_membership_token(payload.membership_no):
+        # 簽章會員卡：驗證即可得知會員，不必查詢（只有報名狀態的寫入會用到資料庫）
+        try:
+            claims = verify_membership_token(payload.membership_no)
+        except MembershipTokenError as exc:
+            raise HTTPException(status_code=400, detail=exc.message)
+        target_user_id = claims['user_id']
+        target_username = claims['username']
+    else:
+        # Find target user
+        db = get_db()
+        try:
+            target = db.execute(
+                "SELECT user_id, username FROM memberships m JOIN users u ON m.user_id = u.id WHERE m.membership_no = ?",
+                (payload.membership_no,),
+            ).fetchone()
+        finally:
+            db.close()
+        if not target:
+            raise HTTPException(status_code=404, detail="找不到該會員")
+        target_user_id = target['user_id']
+        target_username = target['username']
+
+    def _check_in(wdb):
+        wcursor = wdb.cursor()
+        # Check registration
+        wcursor.execute("SELECT * FROM event_registrations WHERE event_id = ? AND user_id = ?", (payload.event_id, target_user_id))
+        registration = wcursor.fetchone()
+
+        status, message, takes_seat = _check_in_outcome(registration['status'] if registration else None, target_username)
+        if status == "checked_in":
+            if takes_seat:
+                _claim_seat(wcursor, payload.event_id, force=True)
+            if registration:
+                wcursor.execute(
+                    "UPDATE event_registrations SET status = 'checked_in', checked_in_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (registration['id'],),
+                )
+            else:
+                # Auto register
+                wcursor.execute(
+                    "INSERT INTO event_registrations (event_id, user_id, status, checked_in_at) VALUES (?, ?, 'checked_in', CURRENT_TIMESTAMP)",
+                    (payload.event_id, target_user_id)
+                )
+            _count_status_changes(wcursor, payload.event_id, [(registration['status'] if registration else None, status)])
+        return {"status": status, "message": message}
+
+    try:
+        return db_writer.run(_check_in)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=400, detail=f"簽到失敗: {str(e)}")
+
+
+# --- Batch Check-in (offline scanner) ---
+CHECKIN_BATCH_MAX = 500  # 單次上傳的掃描筆數上限
+
+
+def _in_chunks(values, size=500):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _check_in_batch(cursor, event_id, scans, members, scanned_by, rejected=None):
+    """Apply queued scans for one event in the current transaction; returns one outcome per scan, in order.
+
+    scans: [(idempotency_key, membership_no, scanned_at)], scanned_at None for server time and False when
+    the client time could not be parsed; members: membership_no -> (user_id, username);
+    rejected: scanned value -> (status, message) for card tokens that failed verification.
+    Keys already in checkin_scans for this event replay their stored outcome with duplicate=True;
+    'invalid' outcomes are not stored, so a corrected resend under the same key is applied.
+    """
+    stored = {}
+    for chunk in _in_chunks({key for key, _, _ in scans}):
+        cursor.execute(
+            f"SELECT idempotency_key, membership_no, status, message FROM checkin_scans "
+            f"WHERE event_id = ? AND idempotency_key IN ({', '.join('?' * len(chunk))})",
+            (event_id, *chunk),
+        )
+        stored.update((r["idempotency_key"], dict(r)) for r in cursor.fetchall())
+
+    registrations = {}
+    for chunk in _in_chunks({user_id for user_id, _ in members.values()}):
+        cursor.execute(
+            f"SELECT id, user_id, status FROM event_registrations WHERE event_id = ? AND user_id IN ({', '.join('?' * len(chunk))})",
+            (event_id, *chunk),
+        )
+        registrations.update((r["user_id"], {"id": r["id"], "status": r["status"]}) for r in cursor.fetchall())
+
+    results, scan_rows, updates, inserts, transitions, seats = [], [], [], [], [], 0
+    for key, membership_no, scanned_at in scans:
+        if key in stored:
+            results.append({**stored[key], "duplicate": True})
+            continue
+        member = members.get(membership_no)
+        user_id = member[0] if member else None
+        if scanned_at is False:
+            status, message = "invalid", "scanned_at 時間格式無效"
+        elif rejected and membership_no in rejected:
+            status, message = rejected[membership_no]
+        elif not member:
+            status, message = "not_found", "找不到該會員"
+        else:
+            registration = registrations.get(user_id)
+            status, message, takes_seat = _check_in_outcome(registration and registration["status"], member[1])
+            if status == "checked_in":
+                seats += takes_seat
+                transitions.append((registration and registration["status"], status))
+                if registration:
+                    updates.append((scanned_at, registration["id"]))
+                else:
+                    inserts.append((event_id, user_id, scanned_at))
+                registrations[user_id] = {"id": registration and registration["id"], "status": "checked_in"}
+        outcome = {"idempotency_key": key, "membership_no": membership_no, "status": status, "message": message}
+        if status == "invalid":
+            results.append({**outcome, "duplicate": False})
+            continue
+        stored[key] = outcome
+        scan_rows.append((key, event_id, membership_no, user_id, status, message, scanned_at or None, scanned_by))
+        results.append({**outcome, "duplicate": False})
+
+    cursor.executemany(
+        "UPDATE event_registrations SET status = 'checked_in', checked_in_at = COALESCE(?, CURRENT_TIMESTAMP) WHERE id = ?",
+        updates,
+    )
+    cursor.executemany(
+        "INSERT INTO event_registrations (event_id, user_id, status, checked_in_at) "
+        "VALUES (?, ?, 'checked_in', COALESCE(?, CURRENT_TIMESTAMP))",
+        inserts,
+    )
+    if seats:
+        cursor.execute("UPDATE events SET registered_count = registered_count + ? WHERE id = ?", (seats, event_id))
+    _count_status_changes(cursor, event_id, transitions)
+    cursor.executemany(
+        "INSERT INTO checkin_scans (idempotency_key, event_id, membership_no, user_id, status, message, scanned_at, scanned_by) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        scan_rows,
+    )
+    return results
+
+
+@app.post("/api/events/{event_id}/checkin/batch")
+def check_in_batch(
+    event_id: int, payload: CheckInBatchRequest, current_user: User = Depends(require_role(event_community))
+):
+    """Apply a queue of offline scans in one transaction; returns {results, checked_in, already, failed}.
+
+    Each scan carries a client idempotency_key, so a queue can be re-sent after a dropped
+    connection: scans already applied return their first outcome with duplicate=True.
+    """
+    if not payload.scans:
+        raise HTTPException(status_code=400, detail="沒有掃描紀錄")
+    if len(payload.scans) > CHECKIN_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"一次最多上傳 {CHECKIN_BATCH_MAX} 筆掃描")
+    if any(not scan.idempotency_key.strip() for scan in payload.scans):
+        raise HTTPException(status_code=400, detail="idempotency_key 不可為空")
+
+    scans, members, rejected = [], {}, {}
+    for scan in payload.scans:
+        try:
+            scanned_at = normalize_timestamp(scan.scanned_at)
+        except (TypeError, ValueError):
+            scanned_at = False  # 逐筆回報，不讓整批失敗
+        membership_no = scan.membership_no.strip()
+        if is_membership_token(membership_no):
+            # 簽章會員卡在記憶體中驗證，只有手動輸入的會員編號需要查詢
+            try:
+                claims = verify_membership_token(membership_no)
+            except MembershipTokenError as exc:
+                rejected[membership_no] = (exc.status, exc.message)
+            else:
+                membership_no = claims["membership_no"]
+                members[membership_no] = (claims["user_id"], claims["username"])
+        scans.append((scan.idempotency_key.strip(), membership_no, scanned_at))
+
     db = get_db()
-    cursor = db.cursor()
-    
-    # Check permission (Admin or Staff/Committee)
-    cursor.execute("SELECT role FROM memberships WHERE user_id = ?", (current_user.id,))
-    current_mem = cursor.fetchone()
-    if not current_mem or current_mem['role'] not in ['admin', 'staff', 'moderator']:
+    try:
+        cursor = db.cursor()
+        lookup = {no for _, no, _ in scans if no not in members and no not in rejected}
+        for chunk in _in_chunks(lookup):
+            cursor.execute(
+                f"SELECT m.membership_no, m.user_id, u.username FROM memberships m JOIN users u ON m.user_id = u.id "
+                f"WHERE m.membership_no IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            members.update((r["membership_no"], (r["user_id"], r["username"])) for r in cursor.fetchall())
+    finally:
         db.close()
-        raise HTTPException(status_code=403, detail="權限不足")
 
-    # Find target user
-    cursor.execute("SELECT user_id, username FROM memberships m JOIN users u ON m.user_id = u.id WHERE m.membership_no = ?", (payload.membership_no,))
-    target = cursor.fetchone()
-    if not target:
+    try:
+        results = db_writer.run(
+            lambda wdb: _check_in_batch(wdb.cursor(), event_id, scans, members, current_user.id, rejected)
+        )
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=400, detail=f"簽到失敗: {str(e)}")
+    return {
+        "results": results,
+        "checked_in": sum(1 for r in results if r["status"] == "checked_in" and not r["duplicate"]),
+        "already": sum(1 for r in results if r["status"] == "already_checked_in" or (r["duplicate"] and r["status"] == "checked_in")),
+        "failed": sum(1 for r in results if r["status"] not in ("checked_in", "already_checked_in")),
+    }
+
+
+@app.get("/api/events/{event_id}/roster")
+def event_roster(event_id: int, current_user: User = Depends(require_role(event_community))):
+    """Members the scanner may check in (the event's community plus every registrant) with their registration status.
+
+    Prefetched by the scanner so scans can be validated while offline.
+    """
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT id, community_id, title, capacity, registered_count, checked_in_count FROM events WHERE id = ?", (event_id,)
+        )
+        event = cursor.fetchone()
+        if not event:
+            raise HTTPException(status_code=404, detail="活動不存在")
+        cursor.execute(
+            "SELECT m.membership_no, m.user_id, u.username, m.status AS membership_status, r.status AS registration_status "
+            "FROM memberships m JOIN users u ON u.id = m.user_id "
+            "LEFT JOIN event_registrations r ON r.event_id = ? AND r.user_id = m.user_id "
+            "WHERE m.membership_no IS NOT NULL "
+            "AND (m.community_id = ? OR m.user_id IN (SELECT user_id FROM event_registrations WHERE event_id = ?))",
+            (event_id, event["community_id"], event_id),
+        )
+        members = [dict(r) for r in cursor.fetchall()]
+    finally:
         db.close()
-        raise HTTPException(status_code=404, detail="找不到該會員")
-    
-    target_user_id = target['user_id']
-    target_username = target['username']
+    return {"event": dict(event), "generated_at": datetime.utcnow().strftime(TIMESTAMP_FORMAT), "members": members}
+
+
+# --- Event Attendance Counters ---
+# 計數器由報名流程在同一交易中維護；reconciler 定期從 event_registrations 重算，修正直接改資料庫等造成的偏差。
+EVENT_COUNTS_RECONCILE_INTERVAL = float(os.getenv("EVENT_COUNTS_RECONCILE_INTERVAL", "900"))  # 秒，0 為停用
+EVENT_COUNTS_DRIFT_SQL = (
+    "SELECT e.id, e.registered_count, e.checked_in_count, e.cancelled_count, "
+    "COALESCE(SUM(r.status IN ('registered', 'checked_in')), 0) AS registered, "
+    "COALESCE(SUM(r.status = 'checked_in'), 0) AS checked_in, "
+    "COALESCE(SUM(r.status = 'cancelled'), 0) AS cancelled "
+    "FROM events e LEFT JOIN event_registrations r ON r.event_id = e.id {where}GROUP BY e.id "
+    "HAVING e.registered_count != registered OR e.checked_in_count != checked_in OR e.cancelled_count != cancelled"
+)
+_event_counts_reconciled_at = None
+_event_counts_lock = threading.Lock()
 
-    # Check registration
-    cursor.execute("SELECT * FROM event_registrations WHERE event_id = ? AND user_id = ?", (payload.event_id, target_user_id))
-    registration = cursor.fetchone()
-    
-    if registration:
-        if registration['status'] == 'checked_in':
-            db.close()
-            return {"status": "already_checked_in", "message": f"{target_username} 已簽到過"}
-        
-        cursor.execute("UPDATE event_registrations SET status = 'checked_in' WHERE id = ?", (registration['id'],))
-        db.commit()
+
+def event_count_drift(cursor, event_ids=None):
+    """Events whose counters differ from event_registrations: rows of (id, stored counts..., recomputed counts...).
+
+    event_ids limits the check to those events; None checks every event.
+    """
+    if event_ids is None:
+        cursor.execute(EVENT_COUNTS_DRIFT_SQL.format(where=""))
+        return [dict(row) for row in cursor.fetchall()]
+    drift = []
+    for chunk in _in_chunks(event_ids):
+        cursor.execute(EVENT_COUNTS_DRIFT_SQL.format(where=f"WHERE e.id IN ({', '.join('?' * len(chunk))}) "), chunk)
+        drift.extend(dict(row) for row in cursor.fetchall())
+    return drift
+
+
+def reconcile_event_counts():
+    """Correct drifted event counters; returns the corrected rows.
+
+    The full aggregate runs on a read connection so it does not hold up writes; the writer job
+    re-checks only the drifted events (a registration may have landed in between) and updates those.
+    """
+    db = get_db()
+    try:
+        suspects = [row["id"] for row in event_count_drift(db.cursor())]
+    finally:
         db.close()
-        return {"status": "checked_in", "message": f"{target_username} 簽到成功"}
-    else:
-        # Auto register
-        try:
+    if not suspects:
+        return []
+
+    def _reconcile(db):
+        cursor = db.cursor()
+        drift = event_count_drift(cursor, suspects)
+        cursor.executemany(
+            "UPDATE events SET registered_count = ?, checked_in_count = ?, cancelled_count = ? WHERE id = ?",
+            [(row["registered"], row["checked_in"], row["cancelled"], row["id"]) for row in drift],
+        )
+        return drift
+
+    drift = db_writer.run(_reconcile)
+    if drift:
+        logger.warning("event counters: corrected %d events %s", len(drift), [row["id"] for row in drift[:20]])
+    return drift
+
+
+def schedule_event_count_reconcile(background_tasks):
+    """Run reconcile_event_counts after the response, at most once per EVENT_COUNTS_RECONCILE_INTERVAL."""
+    global _event_counts_reconciled_at
+    if EVENT_COUNTS_RECONCILE_INTERVAL <= 0:
+        return
+    with _event_counts_lock:
+        now = time.monotonic()
+        if _event_counts_reconciled_at is not None and now - _event_counts_reconciled_at < EVENT_COUNTS_RECONCILE_INTERVAL:
+            return
+        _event_counts_reconciled_at = now
+    background_tasks.add_task(reconcile_event_counts)
+
+
+@app.get("/api/events/{event_id}/stats")
+def event_stats(event_id: int, current_user: User = Depends(require_role(event_community))):
+    """Live door counts for one event, read from the counters on the events row."""
+    db = get_db()
+    try:
+        row = db.execute(
+            "SELECT id, capacity, registered_count, checked_in_count, cancelled_count FROM events WHERE id = ?", (event_id,)
+        ).fetchone()
+    finally:
+        db.close()
+    if not row:
+        raise HTTPException(status_code=404, detail="活動不存在")
+    capacity = row["capacity"] if row["capacity"] and row["capacity"] > 0 else None
+    return {
+        "event_id": row["id"],
+        "capacity": capacity,
+        "registered": row["registered_count"],
+        "checked_in": row["checked_in_count"],
+        "not_arrived": max(row["registered_count"] - row["checked_in_count"], 0),
+        "cancelled": row["cancelled_count"],
+        "remaining": max(capacity - row["registered_count"], 0) if capacity else None,
+    }
+
+
+HOT_QUERIES += [
+    ("list_events upcoming",
+     "SELECT * FROM events WHERE 1=1 AND start_at >= ? ORDER BY start_at", ("2025-01-01 00:00:00",)),
+    ("list_events past by community",
+     "SELECT * FROM events WHERE 1=1 AND community_id = ? AND start_at < ? ORDER BY start_at DESC",
+     (1, "2025-01-01 00:00:00")),
+]
+
+
+HOT_QUERIES += [
+    ("check_in_batch replayed scans",
+     "SELECT idempotency_key, membership_no, status, message FROM checkin_scans WHERE event_id = ? AND idempotency_key IN (?, ?)",
+     (1, "a", "b")),
+    ("check_in_batch registrations",
+     "SELECT id, user_id, status FROM event_registrations WHERE event_id = ? AND user_id IN (?, ?)", (1, 1, 2)),
+    ("check_in_batch members",
+     "SELECT m.membership_no, m.user_id, u.username FROM memberships m JOIN users u ON m.user_id = u.id "
+     "WHERE m.membership_no IN (?, ?)", ("M1", "M2")),
+]
+
+
+# --- Member Home API ---
+HOME_OUTSTANDING_LIMIT = 20  # 首頁最多列出的待繳帳單筆數（總額仍計算全部）
+
+
+@app.get("/api/home/bootstrap")
+def home_bootstrap(
+    community_id: Optional[int] = None,
+    events: int = Query(2, ge=0, le=20),
+    announcements: int = Query(3, ge=0, le=20),
+    current_user: User = Depends(get_current_user),
+):
+    """Everything the member home screen needs in one request, read on one connection.
+
+    membership: the caller's membership card (in community_id, else their latest one);
+    events: the next upcoming events; announcements: pinned first, then newest;
+    payments: the caller's pending payments and their total.
+    """
+    now = datetime.utcnow().strftime(TIMESTAMP_FORMAT)  # start_at / due_date 皆以 UTC 保存
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        # 與 /api/memberships?user_id= 的第一筆相同（joined_at 最新）
+        query = "SELECT * FROM memberships WHERE user_id = ?"
+        params = [current_user.id]
+        if community_id is not None:
+            query += " AND community_id = ?"
+            params.append(community_id)
+        cursor.execute(query + " ORDER BY joined_at DESC LIMIT 1", params)
+        row = cursor.fetchone()
+        membership = Membership(**dict(row)) if row else None
+        community = community_id or (membership.community_id if membership else 1)
+
+        cursor.execute(
+            "SELECT * FROM events WHERE community_id = ? AND start_at >= ? ORDER BY start_at LIMIT ?",
+            (community, now, events),
+        )
+        upcoming = [Event(**dict(r)) for r in cursor.fetchall()]
+
+        cursor.execute(
+            "SELECT * FROM announcements WHERE community_id = ? ORDER BY is_pinned DESC, created_at DESC LIMIT ?",
+            (community, announcements),
+        )
+        latest = [Announcement(**dict(r)) for r in cursor.fetchall()]
+
+        cursor.execute(
+            "SELECT COUNT(*) AS count, COALESCE(SUM(amount), 0) AS total, "
+            "COALESCE(SUM(CASE WHEN due_date < ? THEN 1 ELSE 0 END), 0) AS overdue "
+            "FROM payments WHERE user_id = ? AND status = 'pending'",
+            (now, current_user.id),
+        )
+        outstanding = dict(cursor.fetchone())
+        cursor.execute(
+            "SELECT id, community_id, description, amount, related_type, related_id, due_date, created_at "
+            "FROM payments WHERE user_id = ? AND status = 'pending' "
+            "ORDER BY due_date IS NULL, due_date, id LIMIT ?",
+            (current_user.id, HOME_OUTSTANDING_LIMIT),
+        )
+        outstanding["items"] = [dict(r) for r in cursor.fetchall()]
+    finally:
+        db.close()
+
+    return {
+        "membership": membership,
+        "events": upcoming,
+        "announcements": latest,
+        "payments": outstanding,
+    }
+
+
+HOT_QUERIES += [
+    ("home_bootstrap upcoming events",
+     "SELECT * FROM events WHERE community_id = ? AND start_at >= ? ORDER BY start_at LIMIT ?",
+     (1, "2025-01-01 00:00:00", 2)),
+    ("home_bootstrap announcements",
+     "SELECT * FROM announcements WHERE community_id = ? ORDER BY is_pinned DESC, created_at DESC LIMIT ?", (1, 3)),
+    ("home_bootstrap outstanding payments",
+     "SELECT id, community_id, description, amount, related_type, related_id, due_date, created_at "
+     "FROM payments WHERE user_id = ? AND status = 'pending' ORDER BY due_date IS NULL, due_date, id LIMIT ?", (1, 20)),
+]
+
+
+# --- Delta Sync API ---
+SYNC_PAGE_MAX = 1000  # 單次同步最多回傳的變更筆數
+
+
+@app.get("/api/sync")
+def sync_changes(
+    since: int = Query(0, ge=0),
+    tables: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=SYNC_PAGE_MAX),
+    current_user: User = Depends(get_current_user),
+):
+    """Rows changed after change sequence `since`, for clients keeping a local cache.
+
+    Returns {since, next, has_more, tables: {name: {upserted: [rows], deleted: [ids]}}}.
+    Store `next` and pass it as `since` on the next pull; keep pulling while has_more.
+    Members see their own payments / memberships; admin, staff and moderators also see
+    every payment / membership in the communities they manage.
+    """
+    names = _csv_values(tables) or list(SYNC_TABLES)
+    unknown = [name for name in names if name not in SYNC_TABLES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"不支援同步的資料表: {', '.join(unknown)}")
+
+    # 一般會員看公開資料與自己的資料；管理者另外看到所屬社群的全部資料（含社群不明的舊刪除紀錄）
+    visible = "(user_id IS NULL OR user_id = ?"
+    visibility_params = [current_user.id]
+    staffed = role_communities(current_user.id)
+    if staffed:
+        visible += f" OR community_id IS NULL OR community_id IN ({', '.join('?' * len(staffed))})"
+        visibility_params += staffed
+    visible += ")"
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        # 變更紀錄與資料列在同一個讀取快照中取得，避免讀到一半被寫入
+        cursor.execute("BEGIN")
+
+        # 每張表各自沿 (table_name, seq) 索引讀取，不必為 ORDER BY seq 排序；合併後取前 limit + 1 筆
+        entries = []
+        for name in names:
             cursor.execute(
-                "INSERT INTO event_registrations (event_id, user_id, status) VALUES (?, ?, ?)",
-                (payload.event_id, target_user_id, 'checked_in')
+                f"SELECT seq, table_name, row_id, op FROM change_log WHERE table_name = ? AND seq > ? AND {visible} "
+                "ORDER BY seq LIMIT ?",
+                (name, since, *visibility_params, limit + 1),
             )
-            db.commit()
-            db.close()
-            return {"status": "checked_in", "message": f"{target_username} 現場報名並簽到成功"}
-        except Exception as e:
-            db.close()
-            raise HTTPException(status_code=400, detail=f"簽到失敗: {str(e)}")
+            entries.extend(cursor.fetchall())
+        entries.sort(key=lambda entry: entry["seq"])
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+
+        # 依 seq 順序，每列只取最後一個操作（管理者會同時看到換擁有者的刪除與新擁有者的 upsert）
+        latest = {name: {} for name in names}
+        for entry in entries:
+            latest[entry["table_name"]][entry["row_id"]] = entry["op"]
+        changes = {name: {"upserted": [], "deleted": []} for name in names}
+        for name, ops in latest.items():
+            changes[name]["deleted"] = [row_id for row_id, op in ops.items() if op == "delete"]
+            ids = [row_id for row_id, op in ops.items() if op == "upsert"]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor.execute(f"SELECT * FROM {name} WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+                changes[name]["upserted"].extend(dict(r) for r in cursor.fetchall())
+
+        if has_more:
+            next_seq = entries[-1]["seq"]
+        else:
+            # 已看完全部紀錄：直接跳到目前最大序號，看不到的變更下次不必再掃
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+            next_seq = max(since, cursor.fetchone()[0])
+        db.commit()
+    finally:
+        db.close()
+
+    return {"since": since, "next": next_seq, "has_more": has_more, "tables": changes}
+
+
+HOT_QUERIES += [
+    ("sync_changes member delta",
+     "SELECT seq, table_name, row_id, op FROM change_log WHERE table_name = ? AND seq > ? "
+     "AND (user_id IS NULL OR user_id = ?) ORDER BY seq LIMIT ?", ("payments", 0, 1, 501)),
+    ("sync_changes staff delta",
+     "SELECT seq, table_name, row_id, op FROM change_log WHERE table_name = ? AND seq > ? "
+     "AND (user_id IS NULL OR user_id = ? OR community_id IS NULL OR community_id IN (?)) ORDER BY seq LIMIT ?",
+     ("payments", 0, 1, 1, 501)),
+    ("sync_changes hydrate payments", "SELECT * FROM payments WHERE id IN (?, ?)", (1, 2)),
+]
 
 
 # --- Albums & Photos API ---
@@ -2135,6 +5511,7 @@ def render_profile_page():
         )
         db.commit()
         db.close()
+        user_cache.invalidate(user_id)
         st.success("個人資料已儲存。" )
         st.session_state.username = username # Update session state if username changed
         st.rerun()
@@ -2197,6 +5574,7 @@ def render_create_community_page():
                 (user_id, community_id, 'admin')
             )
             db.commit()
+            permission_cache.invalidate(user_id)
             st.success(f"社團 '{community_name}' 已成功建立！")
             st.session_state.view = "my_communities"
             st.rerun()
@@ -2278,15 +5656,8 @@ def render_community_view():
     st.title(f"社團: {community_name}")
     st.markdown("---")
 
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute("SELECT role FROM community_members WHERE user_id = ? AND community_id = ?", (st.session_state.user_id, community_id))
-    member_role_data = cursor.fetchone()
-    user_role = member_role_data["role"] if member_role_data else 'member'
-    db.close()
-
     # Community Management Options (for admins/moderators)
-    if user_role in ["admin", "moderator"]:
+    if has_role(st.session_state.user_id, ("admin", "moderator"), community_id):
         st.subheader("社團管理")
         if st.button("管理成員"):
             st.session_state.view = "manage_members"
@@ -2586,15 +5957,62 @@ async def debug_upload():
 # --- Debug/Backup Endpoints ---
 ADMIN_SECRET = "mvp_admin_secret_123"  # 簡單的保護機制，正式環境請改用更安全的驗證
 
+def _backup_database_to(target_path, source_path=DATABASE_NAME):
+    """用 SQLite backup API 複製一致的快照（WAL 模式下直接複製檔案會漏掉 -wal 中的資料）"""
+    src = sqlite3.connect(source_path)
+    dst = sqlite3.connect(target_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _reset_after_restore():
+    """Migrate a restored database and drop every process-local copy of the old one's data."""
+    # 還原的備份可能是舊版 schema；_schema_ready 已記錄此檔案，必須強制重跑 migration
+    ensure_schema(DATABASE_NAME, force=True)
+    db_pool.reset()  # 丟棄舊連線的快取狀態，全部重開
+    user_cache.clear()
+    permission_cache.invalidate()
+    _event_community_id.cache_clear()
+    member_ranker.clear()
+    membership_token_revocations.clear()
+    # smart_search_cache 存在資料庫中，隨備份一起還原
+
+
 @app.get("/api/debug/db")
 def download_db(secret: str):
     """下載資料庫備份"""
     if secret != ADMIN_SECRET:
         raise HTTPException(status_code=403, detail="Unauthorized")
     if os.path.exists(DATABASE_NAME):
-        return FileResponse(DATABASE_NAME, filename="community_app.db", media_type="application/x-sqlite3")
+        fd, snapshot_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        _backup_database_to(snapshot_path)
+        return FileResponse(
+            snapshot_path, filename="community_app.db", media_type="application/x-sqlite3",
+            background=BackgroundTask(os.remove, snapshot_path),
+        )
     raise HTTPException(status_code=404, detail="Database not found")
 
+@app.get("/api/debug/metrics")
+def debug_metrics(secret: str):
+    """連線池等執行期指標"""
+    if secret != ADMIN_SECRET:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return {
+        "db_pool": db_pool.health(),
+        "db_writer": db_writer.health(),
+        "user_cache": user_cache.stats(),
+        "permission_cache": permission_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "member_ranker": member_ranker.stats(),
+        "smart_search_cache": smart_search_cache.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "smart_search_limiter": smart_search_limiter.stats(),
+    }
+
 @app.post("/api/debug/db")
 async def upload_db(secret: str, file: UploadFile = File(...)):
     """上傳並覆蓋資料庫 (還原備份)"""
@@ -2602,9 +6020,15 @@ async def upload_db(secret: str, file: UploadFile = File(...)):
         raise HTTPException(status_code=403, detail="Unauthorized")
     
     try:
-        # 寫入新檔案
-        with open(DATABASE_NAME, "wb") as buffer:
+        # 先寫入暫存檔，再透過 backup API 覆蓋（直接覆寫檔案會與 WAL 內容衝突）
+        fd, upload_path = tempfile.mkstemp(suffix=".db")
+        with os.fdopen(fd, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
+        try:
+            _backup_database_to(DATABASE_NAME, source_path=upload_path)
+        finally:
+            os.remove(upload_path)
+        _reset_after_restore()
         return {"message": "Database restored successfully."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -2652,5 +6076,68 @@ else:
         </html>
         """)
 
+def run_cli(args):
+    """Maintenance commands: python app.py <command> [options]"""
+    command = args[0]
+    if command == "migrate":
+        if "--status" in args:
+            conn = sqlite3.connect(DATABASE_NAME)
+            version = current_schema_version(conn)
+            conn.close()
+            print(f"schema version: {version} / {SCHEMA_VERSION}")
+            for number, name, _ in MIGRATIONS:
+                print(f"  [{'x' if number <= version else ' '}] {number:04d} {name}")
+            return 0
+        applied = migrate()
+        print(f"已套用 migration: {applied}" if applied else f"資料庫已是最新版本 ({SCHEMA_VERSION})")
+        return 0
+    if command == "explain":
+        failures = 0
+        for name, plan, ok in check_query_plans():
+            print(f"{'OK  ' if ok else 'SCAN'} {name}")
+            for line in plan:
+                print(f"       {line}")
+            failures += 0 if ok else 1
+        print(f"{len(HOT_QUERIES) - failures}/{len(HOT_QUERIES)} 條查詢使用索引")
+        return 1 if failures else 0
+    if command == "fts-rebuild":
+        count = rebuild_users_fts()
+        print(f"users_fts 已重建，共 {count} 位會員")
+        return 0
+    if command == "rollups":
+        if "--rebuild" in args:
+            count = rebuild_payment_rollups()
+            print(f"payment_rollups 已重建，共 {count} 筆")
+            return 0
+        migrate()
+        mismatches = verify_payment_rollups()
+        for key, want, got in mismatches[:20]:
+            print(f"  {key}: payments={want} rollups={got}")
+        print(f"payment_rollups 有 {len(mismatches)} 筆不一致，請執行 python app.py rollups --rebuild"
+              if mismatches else "payment_rollups 與 payments 一致")
+        return 1 if mismatches else 0
+    if command == "event-counts":
+        migrate()
+        if "--fix" in args:
+            drift = reconcile_event_counts()
+            print(f"已修正 {len(drift)} 場活動的報名計數")
+            return 0
+        db = get_db()
+        try:
+            drift = event_count_drift(db.cursor())
+        finally:
+            db.close()
+        for row in drift[:20]:
+            print(f"  event {row['id']}: registered {row['registered_count']}->{row['registered']} "
+                  f"checked_in {row['checked_in_count']}->{row['checked_in']} cancelled {row['cancelled_count']}->{row['cancelled']}")
+        print(f"{len(drift)} 場活動的計數與報名紀錄不一致，請執行 python app.py event-counts --fix"
+              if drift else "活動計數與報名紀錄一致")
+        return 1 if drift else 0
+    print(f"未知的指令: {command}")
+    return 2
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("migrate", "explain", "fts-rebuild", "rollups", "event-counts"):
+        sys.exit(run_cli(sys.argv[1:]))
     run_streamlit_ui()
@@ -1,4 +1,4 @@
-import shutil
+import sqlite3
 import os
 import datetime
 import glob
@@ -30,9 +30,16 @@ def backup_database():
     dest_filename = f"backup_{timestamp}.db"
     dest_path = os.path.join(DEST_FOLDER, dest_filename)
 
-    # 4. Copy the file
+    # 4. Copy the file (SQLite backup API: the live DB runs in WAL mode, so a plain
+    #    file copy could miss changes that are still in community_app.db-wal)
     try:
-        shutil.copy2(SOURCE_DB, dest_path)
+        src = sqlite3.connect(SOURCE_DB)
+        dst = sqlite3.connect(dest_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
         print(f"Successfully backed up to: {dest_path}")
     except Exception as e:
         print(f"Error copying file: {e}")
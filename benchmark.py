@@ -0,0 +1,431 @@
+"""Performance benchmarks for the community API.
+
+    python benchmark.py smart-search [--sizes 1000,10000,100000] [--ms-per-1k-tokens 2]
+    python benchmark.py stats [--payments 200000]
+    python benchmark.py register [--users 5000] [--capacity 300] [--workers 64]
+
+smart-search: prompt size and end-to-end latency of the AI member search with and
+without local candidate pre-ranking. Uses throwaway SQLite files and a local stub of
+the OpenRouter API, so no API key or network access is needed. Also checks that cancelling
+a half-open circuit-breaker trial (in flight or queued) does not wedge the breaker.
+
+stats: statements, b-tree passes and SQLite VM steps for the admin dashboard, payment
+stats and payments report, comparing the previous one-query-per-number SQL with the
+current implementation.
+
+register: fires --users concurrent sign-ups for one paid event with --capacity seats,
+first through the previous SELECT + INSERT registration (no capacity check), then through
+the registration engine; reports seats taken, waitlist size, throughput and p50 / p99
+latency per wave. The engine run asserts nothing is overbooked and that cancellations
+are back-filled from the waitlist. Also checks that event times sent with a UTC offset
+are compared with the current time correctly.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fastapi import BackgroundTasks
+
+# app 在 import 時讀取設定，必須先指向本機 stub
+STUB_PORT = int(os.getenv("BENCHMARK_STUB_PORT", "18765"))
+os.environ["OPENROUTER_API_URL"] = f"http://127.0.0.1:{STUB_PORT}/v1/chat/completions"
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import app  # noqa: E402
+
+CONTEXT_WINDOW_TOKENS = 64000  # deepseek-chat
+
+OCCUPATIONS = ["水電工", "電工", "老師", "家教", "廚師", "司機", "攝影師", "設計師", "護理師", "會計",
+               "工程師", "業務", "髮型師", "木工", "清潔員", "翻譯", "律師", "退休", "學生", "店長"]
+SKILLS = ["水電", "水管", "冷氣安裝", "油漆", "粉刷", "烹飪", "料理", "英文", "日文", "數學", "鋼琴",
+          "攝影", "錄影", "平面設計", "室內設計", "程式", "看護", "照護", "開車", "搬家", "打掃",
+          "剪髮", "美甲", "推拿", "會計", "法律諮詢", "園藝", "修理電腦", "木工", "烘焙"]
+BIO_TEMPLATES = ["住在社區{n}號，{occ}，平常喜歡{skill}。", "從事{occ}多年，可以幫忙{skill}相關問題。",
+                 "{occ}，假日有空，會一點{skill}。", "大家好，我是{occ}。"]
+QUERIES = ["我家水管漏水需要找人維修", "想找人教小孩英文", "有沒有人會拍照，婚禮需要攝影", "需要搬家幫忙"]
+
+
+def estimate_tokens(text):
+    """Rough tokenizer: one token per CJK character, four characters per token otherwise."""
+    cjk = len(re.findall(r"[\u3400-\u9fff\uf900-\ufaff\u3000-\u303f\uff00-\uffef]", text))
+    return cjk + (len(text) - cjk) // 4
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Answers chat completions with the first five member IDs of the prompt.
+
+    Sleeps in proportion to prompt size to model prefill cost.
+    """
+
+    ms_per_1k_tokens = 2.0
+    extra_delay = 0.0  # 秒；模擬慢回應，讓呼叫端有時間取消
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body["messages"][0]["content"]
+        time.sleep(estimate_tokens(prompt) / 1000 * self.ms_per_1k_tokens / 1000 + self.extra_delay)
+        picks = [{"id": int(i), "reason": "stub"} for i in re.findall(r"ID:(\d+)", prompt)[:5]]
+        payload = json.dumps({"choices": [{"message": {"content": json.dumps(picks)}}]}).encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 呼叫端已取消請求
+
+    def log_message(self, *args):
+        pass
+
+
+def seed_members(path, count, rng):
+    app.migrate(path)
+    conn = sqlite3.connect(path)
+    rows = []
+    for n in range(count):
+        occ = rng.choice(OCCUPATIONS)
+        skills = "、".join(rng.sample(SKILLS, rng.randint(1, 3)))
+        bio = rng.choice(BIO_TEMPLATES).format(n=n, occ=occ, skill=skills.split("、")[0])
+        rows.append((f"m{n}@bench.local", f"member{n}", "x", occ, skills, bio))
+    conn.executemany(
+        "INSERT INTO users (email, username, hashed_password, occupation, skills, bio) VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+def bench_smart_search(sizes, ms_per_1k_tokens):
+    StubLLMHandler.ms_per_1k_tokens = ms_per_1k_tokens
+    server = ThreadingHTTPServer(("127.0.0.1", STUB_PORT), StubLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rng = random.Random(42)
+    app.smart_search_cache = app.SmartSearchCache(ttl=0)  # 量測的是每次都打 upstream 的情況
+    # 不預先排序時 10 萬人的 prompt 很大，放寬逾時並關掉斷路器，量到完整延遲
+    app.llm_gateway = app.LLMGateway(timeout=600, failure_threshold=1000)
+    loop = asyncio.new_event_loop()
+    modes = [("all members", 0), (f"pre-ranked top {app.SMART_SEARCH_MAX_CANDIDATES}", app.SMART_SEARCH_MAX_CANDIDATES)]
+    print(f"{'members':>8}  {'mode':<22} {'prompt tokens':>13} {'index build ms':>14} {'e2e ms':>9}  note")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for size in sizes:
+                path = os.path.join(tmp, f"bench_{size}.db")
+                seed_members(path, size, rng)
+                conn = sqlite3.connect(path)
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+                for label, max_candidates in modes:
+                    app.SMART_SEARCH_MAX_CANDIDATES = max_candidates
+                    app.member_ranker = app.MemberRanker()
+                    started = time.perf_counter()
+                    if max_candidates:
+                        app.member_ranker.member_count(cursor)
+                    build_ms = (time.perf_counter() - started) * 1000
+                    tokens, elapsed = [], []
+                    for query in QUERIES:
+                        started = time.perf_counter()
+                        plan = app._ai_search_prepare(query, cursor)
+                        recommendations = loop.run_until_complete(app.llm_gateway.recommend(plan["prompt"]))
+                        app._ai_search_finish(query, plan, recommendations, cursor)
+                        elapsed.append((time.perf_counter() - started) * 1000)
+                        tokens.append(estimate_tokens(plan["prompt"]))
+                    avg_tokens = sum(tokens) // len(tokens)
+                    note = "exceeds context window" if avg_tokens > CONTEXT_WINDOW_TOKENS else ""
+                    print(f"{size:>8}  {label:<22} {avg_tokens:>13} {build_ms:>14.0f} "
+                          f"{sum(elapsed) / len(elapsed):>9.1f}  {note}")
+                conn.close()
+        check_breaker_cancellation(loop)
+    finally:
+        loop.run_until_complete(app.llm_gateway.aclose())
+        loop.close()
+        server.shutdown()
+
+
+def check_breaker_cancellation(loop):
+    """A half-open trial cancelled mid-request or while queued must free the trial slot."""
+    gateway = app.LLMGateway(max_concurrency=1, failure_threshold=1, reset_seconds=0)
+
+    async def cancel_trial(while_queued):
+        _, semaphore = gateway._client()
+        if while_queued:
+            await semaphore.acquire()  # 佔住唯一的名額，試探請求卡在排隊
+        gateway._record(False)  # 斷路器打開；reset_seconds=0，下一次呼叫就是半開試探
+        task = asyncio.ensure_future(gateway.recommend("ID:1"))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        if while_queued:
+            semaphore.release()
+        return await gateway.recommend("ID:1")
+
+    StubLLMHandler.extra_delay = 1.0
+    try:
+        in_flight = loop.run_until_complete(cancel_trial(False))
+    finally:
+        StubLLMHandler.extra_delay = 0.0
+    queued = loop.run_until_complete(cancel_trial(True))
+    loop.run_until_complete(gateway.aclose())
+    assert in_flight == queued == [{"id": 1, "reason": "stub"}], (in_flight, queued)
+    assert gateway.stats()["state"] == "closed", gateway.stats()
+    print("circuit breaker: cancelled half-open trials release the trial slot")
+
+
+# 改寫前 dashboard / payment stats / payments report 依序執行的查詢（community_id = 1）
+LEGACY_STATS_QUERIES = [
+    ("SELECT COUNT(*) as cnt FROM memberships WHERE community_id = ?", (1,)),
+    ("SELECT COUNT(*) as cnt FROM memberships WHERE status = 'active' AND community_id = ?", (1,)),
+    ("SELECT COUNT(*) as cnt FROM memberships WHERE status = 'expired' AND community_id = ?", (1,)),
+    ("SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE status = 'paid' AND community_id = ?", (1,)),
+    ("SELECT COUNT(*) as cnt FROM events WHERE community_id = ?", (1,)),
+    ("SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE community_id = ? AND created_at >= ?", (1, "2026-10-01 00:00:00")),
+    ("SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE community_id = ? AND status = 'paid' AND paid_at >= ?",
+     (1, "2026-10-01 00:00:00")),
+    ("SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE community_id = ? AND status = 'pending'", (1,)),
+    ("SELECT COALESCE(SUM(amount), 0) as total FROM payments WHERE community_id = ? AND status = 'pending' AND due_date < ?",
+     (1, "2026-10-18 00:00:00")),
+    ("SELECT strftime('%Y-%m', created_at) as month, COALESCE(SUM(amount),0) as total FROM payments "
+     "WHERE 1=1 AND community_id = ? GROUP BY month ORDER BY month", (1,)),
+    ("SELECT COALESCE(SUM(amount),0) as total, COALESCE(related_type,'other') as type FROM payments "
+     "WHERE 1=1 AND community_id = ? GROUP BY type", (1,)),
+]
+
+
+def seed_stats(path, payments, rng):
+    app.migrate(path)
+    conn = sqlite3.connect(path)
+    members = max(payments // 20, 10)
+    conn.executemany("INSERT INTO users (email, username, hashed_password) VALUES (?, ?, 'x')",
+                     [(f"s{n}@bench.local", f"s{n}") for n in range(members)])
+    conn.executemany("INSERT INTO memberships (user_id, community_id, membership_no, status) VALUES (?, ?, ?, ?)",
+                     [(n + 1, rng.choice([1, 2]), f"B{n}", rng.choice(["active", "expired", "pending"])) for n in range(members)])
+    conn.executemany("INSERT INTO events (community_id, title, start_at, created_by) VALUES (?, ?, '2026-01-01', 1)",
+                     [(rng.choice([1, 2]), f"e{n}") for n in range(members // 10)])
+    rows = []
+    for n in range(payments):
+        status = rng.choice(["paid", "pending"])
+        created = f"{rng.choice([2024, 2025, 2026])}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:00"
+        rows.append((rng.randint(1, members), rng.choice([1, 2]), rng.uniform(1, 500), status,
+                     rng.choice(["membership", "event", None]), created, created if status == "paid" else None,
+                     rng.choice([None, "2025-06-01", "2027-01-01"])))
+    conn.executemany(
+        "INSERT INTO payments (user_id, community_id, description, amount, status, related_type, created_at, paid_at, due_date) "
+        "VALUES (?, ?, 'bench', ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+def measure(path, work):
+    """Run work(cursor) and return (statements, b-tree passes, VM steps, ms)."""
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    statements, steps = [], [0]
+    conn.set_trace_callback(statements.append)
+
+    def tick():
+        steps[0] += 1
+        return 0
+
+    conn.set_progress_handler(tick, 100)
+    started = time.perf_counter()
+    work(conn.cursor())
+    elapsed = (time.perf_counter() - started) * 1000
+    conn.set_trace_callback(None)
+    conn.set_progress_handler(None, 0)
+    # 每一行 SCAN / SEARCH 代表走訪一棵 b-tree（資料表或索引）
+    passes = 0
+    for sql in statements:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        passes += sum(1 for row in plan if row[3].startswith(("SCAN", "SEARCH")))
+    conn.close()
+    return len(statements), passes, steps[0] * 100, elapsed
+
+
+def bench_stats(payments):
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench_stats.db")
+        seed_stats(path, payments, rng)
+
+        def legacy(cursor):
+            for sql, params in LEGACY_STATS_QUERIES:
+                cursor.execute(sql, params).fetchall()
+
+        def current(cursor):
+            app._dashboard_stats(cursor, 1)
+            app._payment_stats(cursor, 1)
+            app._payments_report(cursor, 1)
+
+        print(f"{payments} payments; dashboard + payment stats + payments report for one community")
+        print(f"{'':<10} {'statements':>10} {'b-tree passes':>14} {'VM steps':>12} {'ms':>8}")
+        for label, work in (("before", legacy), ("after", current)):
+            measure(path, work)  # 暖身，讓兩者都從 page cache 讀取
+            statements, passes, steps, elapsed = measure(path, work)
+            print(f"{label:<10} {statements:>10} {passes:>14} {steps:>12} {elapsed:>8.1f}")
+
+
+def legacy_register(event_id, user_id):
+    """register_event before the registration engine: no capacity check."""
+    def _register(db):
+        cursor = db.cursor()
+        cursor.execute("SELECT title, price, community_id, start_at FROM events WHERE id = ?", (event_id,))
+        event_info = cursor.fetchone()
+        cursor.execute("INSERT INTO event_registrations (event_id, user_id, status) VALUES (?, ?, 'registered')",
+                       (event_id, user_id))
+        cursor.execute(
+            "INSERT INTO payments (user_id, community_id, description, amount, status, related_type, related_id, due_date) "
+            "VALUES (?, ?, ?, ?, 'pending', 'event', ?, ?)",
+            (user_id, event_info["community_id"], event_info["title"], event_info["price"], event_id, event_info["start_at"]),
+        )
+    app.db_writer.run(_register)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def burst(fn, user_ids, workers, waves=5):
+    """Call fn(user_id) from a thread pool; returns (total seconds, per-wave latencies in ms)."""
+    def timed(user_id):
+        started = time.perf_counter()
+        fn(user_id)
+        return (time.perf_counter() - started) * 1000
+
+    size = max(1, len(user_ids) // waves)
+    latencies = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for offset in range(0, len(user_ids), size):
+            latencies.append(list(executor.map(timed, user_ids[offset:offset + size])))
+    return time.perf_counter() - started, latencies
+
+
+def seat_counts(path, event_id):
+    conn = sqlite3.connect(path)
+    seated = conn.execute("SELECT COUNT(*) FROM event_registrations WHERE event_id = ? AND status IN ('registered', 'checked_in')",
+                          (event_id,)).fetchone()[0]
+    waitlisted = conn.execute("SELECT COUNT(*) FROM event_registrations WHERE event_id = ? AND status = 'waitlisted'",
+                              (event_id,)).fetchone()[0]
+    counter = conn.execute("SELECT registered_count FROM events WHERE id = ?", (event_id,)).fetchone()[0]
+    fees = conn.execute("SELECT COUNT(*) FROM payments WHERE related_type = 'event' AND related_id = ? AND status = 'pending'",
+                        (event_id,)).fetchone()[0]
+    conn.close()
+    return seated, waitlisted, counter, fees
+
+
+def bench_register(users, capacity, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench_register.db")
+        app.migrate(path)
+        conn = sqlite3.connect(path)
+        conn.executemany("INSERT INTO users (email, username, hashed_password) VALUES (?, ?, 'x')",
+                         [(f"r{n}@bench.local", f"r{n}") for n in range(users)])
+        conn.executemany(
+            "INSERT INTO events (id, community_id, title, start_at, capacity, price, created_by) "
+            "VALUES (?, 1, ?, '2030-01-01 10:00:00', ?, 100, 1)",
+            [(1, "legacy", capacity), (2, "engine", capacity)],
+        )
+        conn.commit()
+        conn.close()
+        app.db_pool = app.ConnectionPool(path)
+        app.db_writer = app.DatabaseWriter(app.db_pool)
+        user_ids = list(range(1, users + 1))
+
+        def engine_register(user_id):
+            app.register_event(2, app.EventRegistrationCreate(event_id=2, user_id=user_id))
+
+        print(f"{users} concurrent sign-ups, {capacity} seats, {workers} threads")
+        print(f"{'':<8} {'seated':>7} {'waitlist':>9} {'overbooked':>10} {'req/s':>8}  p50 / p99 ms per wave")
+        for label, event_id, fn in (("before", 1, lambda uid: legacy_register(1, uid)), ("after", 2, engine_register)):
+            seconds, waves = burst(fn, user_ids, workers)
+            seated, waitlisted, _, _ = seat_counts(path, event_id)
+            per_wave = "  ".join(f"{percentile(w, 50):.1f}/{percentile(w, 99):.1f}" for w in waves)
+            print(f"{label:<8} {seated:>7} {waitlisted:>9} {max(0, seated - capacity):>10} {users / seconds:>8.0f}  {per_wave}")
+
+        seated, waitlisted, counter, fees = seat_counts(path, 2)
+        assert seated == counter == min(users, capacity), (seated, counter)
+        assert fees == seated and waitlisted == users - seated, (fees, waitlisted)
+
+        # 取消十分之一的名額，候補名單應依序補上
+        cancelled = user_ids[:max(1, capacity // 10)]
+        seconds, waves = burst(lambda uid: app.db_writer.run(lambda db: app._cancel_registration(db.cursor(), 2, uid)),
+                               cancelled, workers, waves=1)
+        seated, after_waitlist, counter, fees = seat_counts(path, 2)
+        promoted = waitlisted - after_waitlist
+        print(f"cancel   {len(cancelled)} cancellations in {seconds * 1000:.0f} ms, p99 {percentile(waves[0], 99):.1f} ms; "
+              f"{promoted} promoted from the waitlist, {seated} seated")
+        assert seated == counter == min(users - len(cancelled), capacity), (seated, counter)
+        assert fees == seated and promoted == min(len(cancelled), waitlisted), (fees, promoted)
+        db = app.get_db()
+        drift = [row for row in app.event_count_drift(db.cursor()) if row["id"] == 2]  # 舊流程不維護計數
+        db.close()
+        assert not drift, drift
+        print("no overbooking; event counters match the registrations")
+        check_event_time_boundaries(path)
+
+
+def check_event_time_boundaries(path):
+    """Times sent with a +08:00 offset (as the H5 client does) are compared with now in UTC, not as local time."""
+    local = datetime.now(timezone(timedelta(hours=8)))
+    just_passed = app.normalize_timestamp((local - timedelta(minutes=1)).isoformat())
+    coming_up = app.normalize_timestamp((local + timedelta(minutes=1)).isoformat())
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    events = {}
+    for label, when in (("early bird over", just_passed), ("early bird open", coming_up)):  # 開始時間與早鳥截止相同
+        cursor = conn.execute(
+            "INSERT INTO events (community_id, title, start_at, price, early_bird_price, early_bird_deadline, created_by) "
+            "VALUES (1, ?, ?, 100, 80, ?, 1)",
+            (label, when, when),
+        )
+        events[label] = conn.execute("SELECT * FROM events WHERE id = ?", (cursor.lastrowid,)).fetchone()
+    conn.commit()
+    conn.close()
+    assert app._event_price(events["early bird over"]) == 100, dict(events["early bird over"])
+    assert app._event_price(events["early bird open"]) == 80, dict(events["early bird open"])
+    member = app.User(id=1, email="r0@bench.local", username="r0")
+    home = app.home_bootstrap(community_id=1, events=20, announcements=0, current_user=member)
+    upcoming = {event.id for event in home["events"]}
+    assert events["early bird open"]["id"] in upcoming, upcoming  # 一分鐘後開始
+    assert events["early bird over"]["id"] not in upcoming, upcoming  # 一分鐘前已開始
+    for when, expected in (("upcoming", "early bird open"), ("past", "early bird over")):
+        listed = {event.title for event in app.list_events(BackgroundTasks(), community_id=1, when=when)}
+        assert listed & set(events) == {expected}, (when, listed)
+    print("event times: early-bird price, home and when=upcoming/past are right one minute either side of now (+08:00)")
+
+
+def main(args):
+    if not args or args[0] not in ("smart-search", "stats", "register"):
+        print(__doc__)
+        return 2
+    options = dict(zip(args[1::2], args[2::2]))
+    if args[0] == "stats":
+        bench_stats(int(options.get("--payments", "200000")))
+        return 0
+    if args[0] == "register":
+        bench_register(int(options.get("--users", "5000")), int(options.get("--capacity", "300")),
+                       int(options.get("--workers", "64")))
+        return 0
+    sizes = [int(s) for s in options.get("--sizes", "1000,10000,100000").split(",")]
+    bench_smart_search(sizes, float(options.get("--ms-per-1k-tokens", "2")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
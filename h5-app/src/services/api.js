@@ -58,6 +58,17 @@ export const userApi = {
     },
 }
 
+// --- Member Directory API ---
+// 會員列表（users + 會籍）由後端 join、篩選與分頁
+export const memberApi = {
+    list(params = {}) {
+        return api.get('/members', { params })
+    },
+    summary(params = {}) {
+        return api.get('/members/summary', { params })
+    },
+}
+
 // --- Membership API ---
 export const membershipApi = {
     list(params = {}) {
@@ -69,6 +80,12 @@ export const membershipApi = {
     update(id, data) {
         return api.patch(`/memberships/${id}`, data)
     },
+    cardToken(id) {
+        return api.get(`/memberships/${id}/card-token`)
+    },
+    revokeCard(id) {
+        return api.post(`/memberships/${id}/revoke-card`)
+    },
 }
 
 // --- Event API ---
@@ -82,8 +99,21 @@ export const eventApi = {
     create(data, createdBy) {
         return api.post(`/events?created_by=${createdBy}`, data)
     },
-    register(eventId, userId) {
-        return api.post(`/events/${eventId}/register`, { event_id: eventId, user_id: userId })
+    register(eventId, userId, data = {}) {
+        return api.post(`/events/${eventId}/register`, { event_id: eventId, user_id: userId, ...data })
+    },
+    cancelRegistration(eventId, userId = null) {
+        return api.post(`/events/${eventId}/cancel`, { user_id: userId })
+    },
+    roster(eventId) {
+        return api.get(`/events/${eventId}/roster`)
+    },
+    // 現場人數 { registered, checked_in, not_arrived, cancelled, remaining }，讀取活動上的計數
+    stats(eventId) {
+        return api.get(`/events/${eventId}/stats`)
+    },
+    checkinBatch(eventId, scans) {
+        return api.post(`/events/${eventId}/checkin/batch`, { scans })
     },
     update(id, data) {
         return api.put(`/events/${id}`, data)
@@ -93,6 +123,14 @@ export const eventApi = {
     },
 }
 
+// --- Member Home API ---
+// 首頁所需資料（會籍卡、近期活動、公告、待繳帳單）一次取得
+export const homeApi = {
+    bootstrap(params = {}) {
+        return api.get('/home/bootstrap', { params })
+    },
+}
+
 // --- Announcement API ---
 export const announcementApi = {
     list(params = {}) {
@@ -120,16 +158,25 @@ export const paymentApi = {
     delete(id) {
         return api.delete(`/payments/${id}`)
     },
+    // items: [{ id, action: 'update' | 'delete', status?, method? }]，回傳逐筆結果
+    bulk(items) {
+        return api.post('/payments/bulk', { items })
+    },
     getStats(params = {}) {
         return api.get('/stats/payments', { params })
     },
     getReport(params = {}) {
         return api.get('/reports/payments', { params })
     },
-    exportCSV(params = {}) {
-        const query = new URLSearchParams(params).toString()
-        const url = `/api/payments/export/csv${query ? '?' + query : ''}`
-        window.open(url, '_blank')
+    // 匯出需要管理權限，改以帶 token 的請求下載
+    async exportCSV(params = {}) {
+        const blob = await api.get('/payments/export/csv', { params, responseType: 'blob', timeout: 0 })
+        const url = URL.createObjectURL(blob)
+        const link = document.createElement('a')
+        link.href = url
+        link.download = params.gzip ? 'payments.csv.gz' : 'payments.csv'
+        link.click()
+        URL.revokeObjectURL(url)
     },
 }
 
@@ -167,6 +214,13 @@ export const searchApi = {
     },
 }
 
+// --- Delta Sync API ---
+export const syncApi = {
+    pull(params = {}) {
+        return api.get('/sync', { params })
+    },
+}
+
 // --- Common API ---
 export const commonApi = {
     upload(file) {
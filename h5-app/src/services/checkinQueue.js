@@ -0,0 +1,77 @@
+import { eventApi } from './api'
+
+// 掃碼簽到離線佇列：掃描先存進 localStorage，有網路時批次上傳（每筆帶 idempotency_key，重送不會重複簽到）
+const QUEUE_KEY = 'checkin:queue'
+const BATCH_SIZE = 200 // 後端單次上限 500
+const rosterKey = (eventId) => `checkin:roster:${eventId}`
+
+const newKey = () => window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`
+
+function loadQueue() {
+    try { return JSON.parse(localStorage.getItem(QUEUE_KEY) || '[]') } catch { return [] }
+}
+
+function saveQueue(queue) {
+    localStorage.setItem(QUEUE_KEY, JSON.stringify(queue))
+}
+
+export const pendingCount = () => loadQueue().length
+
+// 簽章會員卡（MT1.<kid>.<payload>.<sig>）中的會員編號，只用來查本機名單；簽章由後端驗證
+export function cardMembershipNo(value) {
+    if (!value.startsWith('MT1.')) return value
+    try {
+        const payload = value.split('.')[2].replace(/-/g, '+').replace(/_/g, '/')
+        const bytes = Uint8Array.from(atob(payload + '='.repeat((4 - payload.length % 4) % 4)), c => c.charCodeAt(0))
+        return new TextDecoder().decode(bytes).split('|')[2] || value
+    } catch {
+        return value
+    }
+}
+
+// 活動名單（可簽到的會員與報名狀態），離線時使用上次下載的版本
+export async function prefetchRoster(eventId) {
+    try {
+        const roster = await eventApi.roster(eventId)
+        try { localStorage.setItem(rosterKey(eventId), JSON.stringify(roster)) } catch {}
+        return roster
+    } catch (err) {
+        const cached = JSON.parse(localStorage.getItem(rosterKey(eventId)) || 'null')
+        if (cached) return cached
+        throw err
+    }
+}
+
+export function enqueueScan(eventId, membershipNo) {
+    const scan = {
+        event_id: eventId,
+        idempotency_key: newKey(),
+        membership_no: membershipNo,
+        scanned_at: new Date().toISOString(),
+    }
+    saveQueue([...loadQueue(), scan])
+    return scan
+}
+
+let flushing = null
+
+// 依活動分批上傳佇列，回傳每筆掃描的結果；失敗（離線）時佇列保留，下次再送
+export function flush() {
+    if (flushing) return flushing
+    flushing = (async () => {
+        const results = []
+        let queue = loadQueue()
+        while (queue.length) {
+            const eventId = queue[0].event_id
+            const batch = queue.filter(s => s.event_id === eventId).slice(0, BATCH_SIZE)
+            const res = await eventApi.checkinBatch(eventId, batch.map(({ event_id, ...scan }) => scan))
+            const sent = new Set(batch.map(s => s.idempotency_key))
+            // 上傳期間可能又有新的掃描，重新讀取後再移除已送出的
+            queue = loadQueue().filter(s => !sent.has(s.idempotency_key))
+            saveQueue(queue)
+            results.push(...res.results)
+        }
+        return results
+    })().finally(() => { flushing = null })
+    return flushing
+}
@@ -0,0 +1,64 @@
+import { syncApi } from './api'
+
+// 本機快取：events / announcements / payments / memberships 透過 /api/sync 只拉取變更
+// 快取依登入者分開存放，避免共用裝置時看到別人的帳單
+const storageKey = () => {
+    const user = JSON.parse(localStorage.getItem('user') || 'null')
+    return `sync:${user?.id ?? 'guest'}`
+}
+
+let memory = null // { key, state }，localStorage 寫不下時仍保留在記憶體
+let pending = null
+
+function load() {
+    const key = storageKey()
+    if (memory?.key === key) return memory.state
+    let state = null
+    try { state = JSON.parse(localStorage.getItem(key) || 'null') } catch {}
+    memory = { key, state: state || { since: 0, tables: {} } }
+    return memory.state
+}
+
+function save(state) {
+    const key = storageKey()
+    memory = { key, state }
+    try { localStorage.setItem(key, JSON.stringify(state)) } catch {}
+}
+
+// 拉取 since 之後的所有變更並合併到快取（同時多個呼叫共用一個請求）
+export function pull() {
+    if (pending) return pending
+    pending = (async () => {
+        const state = load()
+        let res
+        do {
+            res = await syncApi.pull({ since: state.since })
+            for (const [name, delta] of Object.entries(res.tables)) {
+                const rows = state.tables[name] || (state.tables[name] = {})
+                delta.deleted.forEach(id => { delete rows[id] })
+                delta.upserted.forEach(row => { rows[row.id] = row })
+            }
+            state.since = res.next
+        } while (res.has_more)
+        save(state)
+        return state
+    })().finally(() => { pending = null })
+    return pending
+}
+
+// 取得同步後的資料列；離線時退回上次的快取
+export async function syncedRows(table) {
+    let state
+    try {
+        state = await pull()
+    } catch (err) {
+        state = load()
+        if (!state.since) throw err
+    }
+    return Object.values(state.tables[table] || {})
+}
+
+export function clearSyncCache() {
+    localStorage.removeItem(storageKey())
+    memory = null
+}
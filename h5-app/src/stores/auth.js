@@ -1,18 +1,23 @@
 import { defineStore } from 'pinia'
 import { ref, computed } from 'vue'
 import { authApi, userApi, membershipApi } from '@/services/api'
+import { clearSyncCache } from '@/services/sync'
 
 export const useAuthStore = defineStore('auth', () => {
     // 狀態
     const token = ref(localStorage.getItem('token') || '')
     const user = ref(JSON.parse(localStorage.getItem('user') || 'null'))
     const membership = ref(null)
+    // 簽章會員卡 { token, membership_no, expires_at }，存在本機讓離線時也能出示
+    const cardToken = ref(JSON.parse(localStorage.getItem('cardToken') || 'null'))
     const loading = ref(false)
 
     // 計算屬性
     const isLoggedIn = computed(() => !!token.value && !!user.value)
     const currentUser = computed(() => user.value)
     const userId = computed(() => user.value?.id)
+    // 會員卡 QR Code 內容：優先使用簽章 token，尚未取得時退回會員編號
+    const cardQrValue = computed(() => cardToken.value?.token || membership.value?.membership_no || '')
 
     // 用戶級別（根據 membership role 映射）
     const userLevel = computed(() => {
@@ -90,9 +95,12 @@ export const useAuthStore = defineStore('auth', () => {
 
     // 登出
     function logout() {
+        clearSyncCache()
         token.value = ''
         user.value = null
         membership.value = null
+        cardToken.value = null
+        localStorage.removeItem('cardToken')
         localStorage.removeItem('token')
         localStorage.removeItem('user')
     }
@@ -115,11 +123,33 @@ export const useAuthStore = defineStore('auth', () => {
         try {
             const list = await membershipApi.list({ user_id: user.value.id })
             membership.value = list.length > 0 ? list[0] : null
+            await fetchCardToken()
         } catch (err) {
             console.error('獲取會籍失敗', err)
         }
     }
 
+    // 重新取得會員卡 token；離線時沿用本機那張，會籍未生效時清除
+    async function fetchCardToken() {
+        if (!membership.value?.id) return
+        try {
+            cardToken.value = await membershipApi.cardToken(membership.value.id)
+            localStorage.setItem('cardToken', JSON.stringify(cardToken.value))
+        } catch (err) {
+            if (err.response?.status === 400) {
+                cardToken.value = null
+                localStorage.removeItem('cardToken')
+            }
+        }
+    }
+
+    // 停用目前所有會員卡 QR Code（手機遺失等），並換發新卡
+    async function revokeCard() {
+        if (!membership.value?.id) return
+        await membershipApi.revokeCard(membership.value.id)
+        await fetchCardToken()
+    }
+
     // 更新個人資料
     async function updateProfile(data) {
         if (!user.value?.id) return
@@ -137,6 +167,8 @@ export const useAuthStore = defineStore('auth', () => {
         token,
         user,
         membership,
+        cardToken,
+        cardQrValue,
         loading,
         isLoggedIn,
         currentUser,
@@ -150,6 +182,8 @@ export const useAuthStore = defineStore('auth', () => {
         logout,
         fetchProfile,
         fetchMembership,
+        fetchCardToken,
+        revokeCard,
         updateProfile,
     }
 })
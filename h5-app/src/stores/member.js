@@ -1,54 +1,93 @@
 import { defineStore } from 'pinia'
-import { ref, computed } from 'vue'
-import { userApi, membershipApi } from '@/services/api'
+import { ref } from 'vue'
+import { memberApi } from '@/services/api'
+import { datePart } from '@/utils/date'
+
+const PAGE_SIZE = 30
+
+// 後端 /api/members 的一列 -> 畫面使用的會員物件
+function toMember(row) {
+    return {
+        id: row.id,
+        membershipId: row.membership_id,
+        name: row.username,
+        avatar: row.profile_picture || `https://ui-avatars.com/api/?name=${encodeURIComponent(row.username)}&background=1a365d&color=fff`,
+        email: row.email,
+        phone: row.phone,
+        bio: row.bio,
+        skills: row.skills,
+        occupation: row.occupation,
+        joinDate: datePart(row.joined_at) || datePart(row.created_at) || '—',
+        level: row.level,
+        status: row.status,
+        membershipNo: row.membership_no || '',
+        expiryDate: datePart(row.expires_at),
+    }
+}
 
 export const useMemberStore = defineStore('member', () => {
     const members = ref([])
     const loading = ref(false)
+    const finished = ref(false)
+    const stats = ref({ total: 0, active: 0, pending: 0, expired: 0 })
+    let filters = {}
+    let nextCursor = null
+    let requestSeq = 0
 
-    // 從 API 載入會員列表（users + memberships）
-    async function fetchMembers() {
+    // 依篩選條件（status / level 可逗號分隔、q）重新載入第一頁與各狀態統計
+    async function fetchMembers(params = {}) {
+        filters = params
+        nextCursor = null
+        finished.value = false
+        const seq = ++requestSeq
         loading.value = true
         try {
-            const [users, memberships] = await Promise.all([
-                userApi.listUsers(),
-                membershipApi.list(),
-            ])
+            const res = await memberApi.list({ ...filters, limit: PAGE_SIZE, include_summary: true })
+            if (seq !== requestSeq) return // 篩選條件已變更，丟棄舊結果
+            members.value = res.items.map(toMember)
+            stats.value = res.summary
+            nextCursor = res.next_cursor
+            finished.value = !nextCursor
+        } catch (err) {
+            console.error('載入會員列表失敗', err)
+            finished.value = true
+        } finally {
+            if (seq === requestSeq) loading.value = false
+        }
+    }
 
-            // 合併 user + membership 資訊
-            members.value = users.map(user => {
-                const ms = memberships.find(m => m.user_id === user.id)
-                return {
-                    id: user.id,
-                    membershipId: ms?.id,
-                    name: user.username,
-                    avatar: user.profile_picture || `https://ui-avatars.com/api/?name=${encodeURIComponent(user.username)}&background=1a365d&color=fff`,
-                    email: user.email,
-                    phone: user.phone,
-                    bio: user.bio,
-                    skills: user.skills,
-                    occupation: user.occupation,
-                    joinDate: ms?.joined_at?.split('T')[0] || user.created_at?.split('T')[0] || '—',
-                    level: ms?.role === 'admin' ? 'admin' : ms?.role === 'staff' ? 'committee' : ms?.role === 'member' ? 'citizen' : 'friend',
-                    status: ms?.status || 'pending',
-                    membershipNo: ms?.membership_no || '',
-                    expiryDate: ms?.expires_at?.split('T')[0] || '',
-                }
-            })
+    async function loadMore() {
+        if (!nextCursor) {
+            finished.value = true
+            return
+        }
+        const seq = requestSeq
+        loading.value = true
+        try {
+            const res = await memberApi.list({ ...filters, limit: PAGE_SIZE, cursor: nextCursor })
+            if (seq !== requestSeq) return
+            members.value = members.value.concat(res.items.map(toMember))
+            nextCursor = res.next_cursor
+            finished.value = !nextCursor
         } catch (err) {
             console.error('載入會員列表失敗', err)
+            finished.value = true
         } finally {
-            loading.value = false
+            if (seq === requestSeq) loading.value = false
         }
     }
 
-    // 統計
-    const stats = computed(() => ({
-        total: members.value.length,
-        active: members.value.filter(m => m.status === 'active').length,
-        pending: members.value.filter(m => m.status === 'pending').length,
-        expired: members.value.filter(m => m.status === 'expired').length,
-    }))
+    // 載入（或重新整理）單一會員，例如從會員詳情頁直接進入
+    async function fetchMember(id) {
+        const res = await memberApi.list({ user_id: parseInt(id), limit: 1 })
+        const member = res.items[0] ? toMember(res.items[0]) : null
+        if (member) {
+            const index = members.value.findIndex(m => m.id === member.id)
+            if (index >= 0) members.value[index] = member
+            else members.value.push(member)
+        }
+        return member
+    }
 
     // 級別映射
     const membershipTypes = {
@@ -71,10 +110,13 @@ export const useMemberStore = defineStore('member', () => {
     return {
         members,
         loading,
+        finished,
         stats,
         membershipTypes,
         statusTypes,
         fetchMembers,
+        loadMore,
+        fetchMember,
         getMemberById,
     }
 })
@@ -0,0 +1,20 @@
+// 後端時間一律為 'YYYY-MM-DD HH:MM:SS'（UTC，不帶時區）。iOS Safari 的 Date 不接受中間的空格，先換成 'T'；
+// 沒有時區標記的值補上 'Z'，否則瀏覽器會當成本地時間解析。
+const ZONE_SUFFIX = /(Z|[+-]\d\d:?\d\d)$/i
+
+export const parseDate = (value) => {
+  if (!value) return null
+  const iso = String(value).trim().replace(' ', 'T')
+  return new Date(ZONE_SUFFIX.test(iso) || iso.length <= 10 ? iso : `${iso}Z`)
+}
+
+// 本地日期 + 'HH:MM' 轉成帶時區的 ISO 字串（UTC，'Z' 結尾）送給後端
+export const toISOWithZone = (dateStr, timeStr = '00:00') => {
+  if (!dateStr) return null
+  const [y, m, d] = dateStr.split('-').map(Number)
+  const [hh, mm] = timeStr.split(':').map(Number)
+  return new Date(y, m - 1, d, hh || 0, mm || 0).toISOString()
+}
+
+// 只取日期部分 'YYYY-MM-DD'（會籍到期日、繳費期限等純日期欄位）
+export const datePart = (value) => (value ? String(value).slice(0, 10) : '')
@@ -7,52 +7,19 @@ from crewai import Agent, Task, Crew, Process, LLM
 # ✅ 這是新版寫法，必須安裝 crewai-tools
 from crewai_tools import FileReadTool
 
-# date utilities for billing job
-from datetime import datetime, timedelta
-from app import get_db
+# billing job：與 /api/maintenance/generate_due_payments 共用同一個帳單引擎
+from app import run_due_billing
 
 
-def run_due_payment_job(community_id: int = None):
-    db = get_db()
-    cursor = db.cursor()
-    cutoff = datetime.utcnow() + timedelta(days=30)
-    cond = "WHERE expires_at IS NOT NULL AND status = 'active'"
-    params = []
-    if community_id is not None:
-        cond += " AND community_id = ?"
-        params.append(community_id)
-    cursor.execute(f"SELECT * FROM memberships {cond}", params)
-    memberships = cursor.fetchall()
-    created = 0
-    for m in memberships:
-        expires = m['expires_at']
-        if not expires:
-            continue
-        exp_dt = datetime.fromisoformat(expires)
-        if exp_dt <= cutoff:
-            cursor.execute(
-                "SELECT 1 FROM payments WHERE related_type='membership' AND related_id=? AND status='pending'",
-                (m['id'],),
-            )
-            if cursor.fetchone():
-                continue
-            cursor.execute(
-                "INSERT INTO payments (user_id, community_id, description, amount, status, related_type, related_id, due_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    m['user_id'],
-                    m['community_id'],
-                    "會籍續費",
-                    0.0,
-                    "pending",
-                    "membership",
-                    m['id'],
-                    expires,
-                ),
-            )
-            created += 1
-    db.commit()
-    db.close()
-    print(f"自動建立待繳帳單：{created}筆")
+def run_due_payment_job(community_id: int = None, dry_run: bool = False):
+    result = run_due_billing(community_id, dry_run)
+    for cid, count in result["byCommunity"].items():
+        print(f"  社群 {cid}：{count}筆")
+    if dry_run:
+        print(f"試算：將建立待繳帳單 {sum(result['byCommunity'].values())}筆（未寫入）")
+    else:
+        print(f"自動建立待繳帳單：{result['created']}筆")
+    return result
 
 # ==============================================
 # 🔑 設定 OpenRouter API Key
@@ -162,8 +129,11 @@ def create_fix_tasks(feedback, target_file):
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1 and sys.argv[1] in ("due", "generate_due", "auto_billing"):
-        cid = int(sys.argv[2]) if len(sys.argv) > 2 else None
-        run_due_payment_job(cid)
+        options = sys.argv[2:]
+        dry_run = "--dry-run" in options
+        options = [o for o in options if o != "--dry-run"]
+        cid = int(options[0]) if options else None
+        run_due_payment_job(cid, dry_run)
         sys.exit(0)
     print("\n================================================")
     print("🚑 Himac AI 維護團隊 (Bug Fix & Refactor) 已就位")
@@ -0,0 +1,20 @@
+"""Password hashing jobs for the hashing process pool.
+
+Kept out of app.py so spawned worker processes only import passlib,
+not FastAPI / Streamlit.
+"""
+from passlib.context import CryptContext
+
+# bcrypt 只支援 72 bytes，改用 pbkdf2_sha256 並保留舊 bcrypt 相容
+pwd_context = CryptContext(schemes=["pbkdf2_sha256", "bcrypt_sha256", "bcrypt"], deprecated="auto")
+
+
+def hash_job(password):
+    return pwd_context.hash(password)
+
+
+def verify_job(password, hashed_password):
+    """Return (matches, needs_rehash); needs_rehash is True for legacy bcrypt hashes."""
+    if not pwd_context.verify(password, hashed_password):
+        return False, False
+    return True, pwd_context.needs_update(hashed_password)